@@ -0,0 +1,57 @@
+import gzip
+import hashlib
+import json
+
+from flask import Response, request
+
+GZIP_MIN_BYTES = 1024
+
+_BASE = ['id', 'patient_id', 'name', 'mobile_number', 'appointment_date', 'reason', 'booking_type', 'confirmed',
+         'checkin_status', 'checkin_time', 'slot_time', 'provider']
+
+# What each role's UI actually shows; clinical notes such as mind and
+# psychology only go to doctors
+PROJECTIONS = {
+    'receptionist': _BASE + [
+        'age', 'address', 'diagnosis_saved', 'medicines_prescribed', 'medicines', 'next_visit',
+        'consultation_charge', 'medicine_charge', 'courier_charge', 'delivery_type', 'delivered_to',
+        'courier_channel', 'courier_tracking', 'amount_paid', 'payment_date', 'payment_id', 'discount',
+        'medicines_prepared', 'medicines_handed_over', 'couriered', 'checkout_done',
+    ],
+    'doctor': _BASE + [
+        'age', 'chief_complaints', 'symptoms', 'mind', 'psychology', 'diagnosis', 'medicines', 'tests',
+        'next_visit', 'diagnosis_saved', 'medicines_prescribed', 'medicines_prepared', 'checkout_done',
+    ],
+    'pharmacist': _BASE + [
+        'diagnosis', 'medicines', 'medicines_prescribed', 'delivery_type', 'delivered_to', 'courier_channel',
+        'courier_tracking', 'medicines_prepared', 'medicines_handed_over', 'couriered',
+    ],
+}
+
+
+def json_response(payload):
+    # Compact JSON; sqlite3.Row values are written straight out as arrays.
+    # A weak ETag over the uncompressed body lets pollers get a bodiless 304,
+    # and larger bodies are gzipped when the client accepts it.
+    body = json.dumps(payload, separators=(',', ':'), default=tuple).encode()
+    etag = hashlib.sha1(body).hexdigest()
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Accept-Encoding')
+    if request.if_none_match.contains_weak(etag):
+        response.status_code = 304
+        response.set_data(b'')
+        return response
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def rows_payload(columns, rows, page=None):
+    payload = {'columns': columns, 'rows': rows}
+    if page is not None:
+        payload['next'] = page['next_cursor']
+        payload['prev'] = page['prev_cursor']
+    return payload
@@ -1,61 +1,243 @@
 import os
-from flask import Flask, request, render_template_string, jsonify, session, redirect, url_for
-import pandas as pd
 import sqlite3
+import click
+from flask import Flask, Response, request, render_template, jsonify, session, redirect, url_for, get_template_attribute, send_file
+from jinja2 import FileSystemBytecodeCache
 from datetime import datetime
 import uuid
-import hashlib
+from api import PROJECTIONS, json_response, rows_payload
+from archive import ARCHIVE_AFTER_DAYS, MAX_ATTACHED, MaintenanceJob, archive_closed, archived_years, attach, optimize, vacuum
+from auth import authenticate, set_password
+from billing import TransitionError, advance, advance_many
+from bookings import BookingError, book_appointments
+from db import connect, get_db, init_app as init_db_pool
+from dashboards import explain_page_queries, fetch_appointment, fetch_page, page_params, plan_problems
+from downloads import FORMATS, DownloadError, download_query, stream_rows
+from events import ChangeFeed
+from exports import CsvExporter
+from fragments import FragmentCache, cached_response, data_version, templates_digest
+from history import HISTORY_COLUMNS, HistoryCache
+from importer import (SPREADSHEET_EXTENSIONS, create_job, job_status, run_import, spreadsheets_supported,
+                      start_import)
+from metrics import METRICS_TOKEN, init_app as init_metrics, render as render_metrics, timed_export
+from migrations import migrate
+from notifications import NotificationDispatcher, enqueue_message, load_transport
+from patient_queue import PatientQueue
+from pharmacy import (PICK_LIST_COLUMNS, STOCK_COLUMNS, PrescriptionError, StockChangeError, StockError, adjust_stock,
+                      check_items, check_stock_change, parse_items, pick_list, save_items, stock_levels, take_stock)
+from reporting import (CREDIT_COLUMNS, DAILY_COLUMNS, bill_credit, daily_summary, outstanding_credit,
+                       rebuild_summaries, report_range)
+from scheduling import PROVIDERS, SlotIndex
+from search import rebuild_index, search
+from writer import WriteQueue
 
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'fallback-secret-key-1234567890')  # Fallback for local dev
 UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'uploads')  # Default to 'uploads' if not set
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+IMPORT_FOLDER = os.path.join(UPLOAD_FOLDER, 'imports')
+init_db_pool(app)
+# Per-route latency, SQL and template timings for /metrics; see metrics.py
+init_metrics(app)
+# Compiled templates are cached as bytecode on disk so new workers skip parsing
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.getenv('TEMPLATE_CACHE_DIR') or None)
 
-# Initialize SQLite database
+# Initialize SQLite database. Under Gunicorn the master already migrated in
+# on_starting (gunicorn.conf.py), so in a worker this is one PRAGMA read.
 def init_db():
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))  # Default to 'clinic.db'
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS patients (
-        patient_id TEXT PRIMARY KEY, name TEXT, mobile_number TEXT UNIQUE, age INTEGER, address TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS appointments (
-        id TEXT PRIMARY KEY, patient_id TEXT, reason TEXT, booking_date TEXT, appointment_date TEXT, 
-        booking_type TEXT, confirmed INTEGER, checkin_status TEXT, checkin_time TEXT,
-        FOREIGN KEY (patient_id) REFERENCES patients (patient_id)
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS diagnoses (
-        appointment_id TEXT PRIMARY KEY, chief_complaints TEXT, symptoms TEXT, mind TEXT, psychology TEXT, 
-        diagnosis TEXT, medicines TEXT, tests TEXT, next_visit TEXT, diagnosis_saved INTEGER, 
-        medicines_prescribed INTEGER,
-        FOREIGN KEY (appointment_id) REFERENCES appointments (id)
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS billing (
-        appointment_id TEXT PRIMARY KEY, consultation_charge REAL, medicine_charge REAL, courier_charge REAL, 
-        delivery_type TEXT, delivered_to TEXT, courier_channel TEXT, courier_tracking TEXT, 
-        amount_paid REAL, payment_date TEXT, payment_id TEXT, discount REAL, 
-        medicines_prepared INTEGER, medicines_handed_over INTEGER, couriered INTEGER, checkout_done INTEGER,
-        FOREIGN KEY (appointment_id) REFERENCES appointments (id)
-    )''')
-    conn.commit()
+    conn = connect()
+    migrate(conn)
     conn.close()
 
-    # Initialize users.csv for login credentials
-    users = [
-        {'username': 'receptionist', 'password': hashlib.sha256('rec123'.encode()).hexdigest(), 'role': 'receptionist'},
-        {'username': 'doctor', 'password': hashlib.sha256('doc123'.encode()).hexdigest(), 'role': 'doctor'},
-        {'username': 'pharmacist', 'password': hashlib.sha256('pharm123'.encode()).hexdigest(), 'role': 'pharmacist'}
-    ]
-    pd.DataFrame(users).to_csv(os.path.join(UPLOAD_FOLDER, 'users.csv'), index=False)
-
 init_db()
 
+def precompile_templates():
+    # Load every template once at startup so no request pays for compilation
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+precompile_templates()
+
+# CSV mirrors in UPLOAD_FOLDER are refreshed from change_log by a background worker
+csv_exporter = CsvExporter(connect, UPLOAD_FOLDER)
+# WhatsApp messages go through the outbox table; NOTIFICATION_TRANSPORT picks the gateway
+notifier = NotificationDispatcher(connect, load_transport(os.getenv('NOTIFICATION_TRANSPORT', 'console')))
+# Dashboards follow change_log over /events and re-fetch only the rows that changed
+live_feed = ChangeFeed(connect)
+# Free-slot lookups are answered from memory; refreshed from change_log per query
+slot_index = SlotIndex(connect)
+# Patient histories for repeat opens during a consult; see history.HistoryCache
+history_cache = HistoryCache(connect)
+# Workflow writes are group-committed by one writer thread per process; see writer.WriteQueue
+write_queue = WriteQueue(connect)
+# Nightly archiving of closed visits and database upkeep; see archive.py
+maintenance_job = MaintenanceJob(connect)
+
+@app.before_request
+def start_background_jobs():
+    # Gunicorn calls this as each worker boots (post_worker_init), so messages a
+    # restart left in the outbox go out at once; otherwise the first request
+    # starts them. Cheap once started.
+    notifier.ensure_started()
+    maintenance_job.ensure_started()
+
+# Today's waiting patients in seeing order, built on first use and replayed from change_log after
+patient_queue = PatientQueue(connect)
+# Rendered dashboard pages, reused until the next write; see fragments.py
+fragment_cache = FragmentCache(templates_digest(app))
+
 # Helper functions
-def save_to_csv(table_name, data):
-    df = pd.DataFrame(data)
-    df.to_csv(os.path.join(UPLOAD_FOLDER, f'{table_name}.csv'), index=False)
+def schedule_csv_export():
+    csv_exporter.notify()
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    # Fails (exit 1) if a dashboard query would scan a table, sort, or skip the index it is meant to use
+    conn = connect()
+    migrate(conn)
+    failed = False
+    for name, (details, expected) in explain_page_queries(conn).items():
+        problems = plan_problems(details, expected)
+        failed = failed or bool(problems)
+        click.echo(f"{'FAIL' if problems else 'ok  '} {name}")
+        for detail in details:
+            click.echo(f"       {detail}")
+        for problem in problems:
+            if problem not in details:
+                click.echo(f"       {problem}")
+    conn.close()
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    conn = connect()
+    rebuild_index(conn)
+    conn.commit()
+    conn.close()
+
+@app.cli.command('rebuild-reports')
+def rebuild_reports_command():
+    # Recompute the billing summaries from scratch; triggers keep them current otherwise
+    conn = connect()
+    years = archived_years()
+    if len(years) > MAX_ATTACHED:
+        raise click.ClickException(f'{len(years)} archived years; at most {MAX_ATTACHED} can be attached')
+    aliases = attach(conn, years)
+    conn.execute('BEGIN IMMEDIATE')
+    rebuild_summaries(conn, aliases)
+    conn.commit()
+    conn.close()
+
+@app.cli.command('archive')
+@click.option('--days', type=int, default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive checked-out visits older than this many days.')
+def archive_command(days):
+    # Move closed visits to the per-year files in ARCHIVE_FOLDER
+    moved = archive_closed(connect, days)
+    for year, count in sorted(moved.items()):
+        click.echo(f'{year}: {count} visits archived')
+    if not moved:
+        click.echo('Nothing to archive')
+
+@app.cli.command('maintain')
+@click.option('--vacuum', 'full', is_flag=True, help='Also rewrite the whole file, returning free space to the disk.')
+@click.option('--incremental', is_flag=True, help='With --vacuum, switch to incremental vacuum from then on.')
+def maintain_command(full, incremental):
+    # ANALYZE, PRAGMA optimize, incremental vacuum and a WAL checkpoint; what
+    # the nightly job runs after archiving. --vacuum blocks writers while it runs.
+    conn = connect()
+    if full:
+        vacuum(conn, incremental)
+    click.echo(optimize(conn))
+    conn.close()
+
+@app.cli.command('adjust-stock')
+@click.argument('name')
+@click.argument('quantity', type=int)
+@click.option('--unit', help='Unit the quantity is counted in, e.g. bottle.')
+@click.option('--reorder-level', type=int, help='Stock at or below which the medicine shows as low.')
+def adjust_stock_command(name, quantity, unit, reorder_level):
+    # Receive stock (positive QUANTITY) or write it off (negative, after --)
+    conn = connect()
+    try:
+        stock = adjust_stock(conn, name, quantity, unit, reorder_level)
+    except StockError as e:
+        conn.rollback()
+        raise click.ClickException(str(e))
+    conn.commit()
+    conn.close()
+    click.echo(f"{name}: {stock} in stock")
+
+@app.cli.command('set-password')
+@click.argument('username')
+@click.argument('role', type=click.Choice(['receptionist', 'doctor', 'pharmacist']))
+@click.password_option()
+def set_password_command(username, role, password):
+    # Creates the user if needed; hashed with the current PASSWORD_HASH_ITERATIONS
+    conn = connect()
+    set_password(conn, username, password, role)
+    conn.commit()
+    conn.close()
+
+@app.cli.command('export-csv')
+def export_csv_command():
+    # Synchronous flush with waiting updates applied, e.g. before taking a backup of UPLOAD_FOLDER
+    csv_exporter.flush(compact=True)
+
+@app.cli.command('import-bookings')
+@click.argument('path', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--resume', 'job_id', help='Continue an interrupted import job.')
+def import_bookings_command(path, job_id):
+    # Patients, and appointments where a date is given, from a CSV or .xlsx file;
+    # rejected rows are written to PATH.rejects.csv
+    conn = connect()
+    if job_id is None:
+        if path is None:
+            raise click.UsageError('PATH or --resume is required')
+        if path.lower().endswith(SPREADSHEET_EXTENSIONS) and not spreadsheets_supported():
+            raise click.UsageError('Importing .xlsx files needs openpyxl (pip install openpyxl)')
+        path = os.path.abspath(path)
+        job_id = create_job(conn, path, path + '.rejects.csv')
+        conn.commit()
+        click.echo(f"Import job {job_id}")
+    def progress(job):
+        click.echo(f"{job['rows_read']} rows read, {job['patients_added']} new patients, "
+                   f"{job['appointments_added']} appointments, {job['rejected']} rejected")
+    job = run_import(conn, job_id, progress)
+    conn.close()
+    click.echo(f"Import {job['status']}; rejects in {job['reject_file']}" if job['rejected'] else f"Import {job['status']}")
+
+def send_whatsapp_message(conn, mobile, message, dedup_key=None):
+    # Queued in the caller's transaction; the dispatcher delivers it after commit
+    enqueue_message(conn, mobile, message, dedup_key)
+
+def dispatch_notifications():
+    notifier.notify()
+
+def publish_changes():
+    live_feed.notify()
 
-def send_whatsapp_message(mobile, message):
-    print(f"Sending WhatsApp to {mobile}: {message}")
+# Receptionist billing steps (see billing.TRANSITIONS) -> WhatsApp text and outbox dedup suffix
+BILLING_MESSAGES = {
+    'hand_over': ("Medicines handed over", 'handed_over'),
+    'courier': ("Medicines couriered", 'couriered'),
+    'checkout': ("Checkout completed", 'checkout'),
+}
+
+def send_billing_message(conn, mobile, action, id):
+    message, suffix = BILLING_MESSAGES[action]
+    send_whatsapp_message(conn, mobile, message, f'{id}:{suffix}')
+
+def advance_bill(conn, id, action):
+    # A WriteQueue command for one receptionist billing step; returns the
+    # credit the bill is left owing
+    moved = advance(conn, id, action)
+    if not moved:
+        return bill_credit(conn, id)
+    send_billing_message(conn, moved[0], action, id)
+    # Any shortfall is now on the patient's row in patient_credit (same transaction)
+    return moved[1]
 
 # Routes
 @app.route('/', methods=['GET', 'POST'])
@@ -65,38 +247,13 @@ def login():
     error = None
     if request.method == 'POST':
         username = request.form['username']
-        password = hashlib.sha256(request.form['password'].encode()).hexdigest()
-        users = pd.read_csv(os.path.join(UPLOAD_FOLDER, 'users.csv'))
-        user = users[(users['username'] == username) & (users['password'] == password)]
-        if not user.empty:
+        role = authenticate(get_db(), username, request.form['password'], write_queue.submit)
+        if role:
             session['username'] = username
-            session['role'] = user.iloc[0]['role']
+            session['role'] = role
             return redirect(url_for(f"{session['role']}_dashboard"))
         error = "Invalid credentials"
-    return render_template_string("""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Clinic Management - Login</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-</head>
-<body class="bg-gradient-to-r from-blue-500 to-purple-600 min-h-screen flex items-center justify-center">
-    <div class="bg-white p-8 rounded-lg shadow-lg w-full max-w-md">
-        <h1 class="text-3xl font-bold text-center text-gray-800 mb-6">Way2Cure Kharghar Clinic Management System</h1>
-        {% if error %}
-        <p class="text-red-500 text-center">{{ error }}</p>
-        {% endif %}
-        <form method="post" class="space-y-4">
-            <input type="text" name="username" placeholder="Username" class="w-full p-2 border rounded">
-            <input type="password" name="password" placeholder="Password" class="w-full p-2 border rounded">
-            <button type="submit" class="w-full bg-blue-600 text-white py-2 rounded hover:bg-blue-700">Login</button>
-        </form>
-    </div>
-</body>
-</html>
-    """, error=error)
+    return render_template('login.html', error=error)
 
 @app.route('/logout')
 def logout():
@@ -104,6 +261,32 @@ def logout():
     session.pop('role', None)
     return redirect(url_for('login'))
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Prometheus scrape target
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'message': 'Unauthorized'}), 403
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/search', methods=['GET'])
+def search_appointments():
+    if 'role' not in session:
+        return jsonify({'message': 'Unauthorized'}), 403
+    results = search(get_db(), request.args.get('q', ''), request.args.get('limit', 20, type=int))
+    return jsonify({'results': results})
+
+def dashboard_response(template, prescribed_only=False, **context):
+    # The same page at the same data version is rendered once; see fragments.cached_response
+    conn = get_db()
+    params = page_params(request.args)
+    version = data_version(conn)
+
+    def render():
+        appointments, page = fetch_page(conn, params, prescribed_only=prescribed_only)
+        return render_template(template, appointments=appointments, page=page, **context)
+
+    return cached_response(fragment_cache, (template, tuple(sorted(params.items()))), version, render)
+
 @app.route('/receptionist_dashboard', methods=['GET', 'POST'])
 def receptionist_dashboard():
     if 'role' not in session or session['role'] != 'receptionist':
@@ -116,698 +299,291 @@ def receptionist_dashboard():
             'address': request.form['address'],
             'reason': request.form['reason'],
             'appointment_date': request.form['appointment_date'],
-            'booking_type': request.form['booking_type']
+            'booking_type': request.form['booking_type'],
+            'slot_time': request.form.get('slot_time'),
+            'provider': request.form.get('provider'),
         }
-        conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-        c = conn.cursor()
-        # Check for existing patient by mobile number
-        c.execute('SELECT patient_id FROM patients WHERE mobile_number = ?', (data['mobile_number'],))
-        patient = c.fetchone()
-        if patient:
-            patient_id = patient[0]
-            c.execute('UPDATE patients SET name = ?, age = ?, address = ? WHERE patient_id = ?',
-                      (data['name'], data['age'], data['address'], patient_id))
-        else:
-            patient_id = str(uuid.uuid4())
-            c.execute('INSERT INTO patients (patient_id, name, mobile_number, age, address) VALUES (?, ?, ?, ?, ?)',
-                      (patient_id, data['name'], data['mobile_number'], data['age'], data['address']))
-        # Book appointment
-        appointment_id = str(uuid.uuid4())
-        booking_date = datetime.now().strftime('%Y-%m-%d')
-        today = datetime.now().date()
-        appt_date = datetime.strptime(data['appointment_date'], '%Y-%m-%d').date()
-        if appt_date == today and data['booking_type'] == 'Online Direct':
-            conn.close()
-            return render_template_string("""
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Receptionist Dashboard</title>
-                <script src="https://cdn.tailwindcss.com"></script>
-            </head>
-            <body class="bg-gray-100 font-sans">
-                <div class="min-h-screen bg-gradient-to-r from-green-400 to-blue-500 p-4">
-                    <div class="container mx-auto bg-white rounded-lg shadow-lg p-6">
-                        <p class="text-red-500 text-center">Same-day online bookings not allowed</p>
-                        <a href="/receptionist_dashboard" class="text-blue-600">Back to Dashboard</a>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """)
-        c.execute('''INSERT INTO appointments (id, patient_id, reason, booking_date, appointment_date, booking_type, confirmed, checkin_status, checkin_time)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                     (appointment_id, patient_id, data['reason'], booking_date, data['appointment_date'], data['booking_type'], 0, '', ''))
-        c.execute('INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, ?, 0)',
-                  (appointment_id, 'In-Person'))
-        conn.commit()
-        conn.close()
-        send_whatsapp_message(data['mobile_number'], f"Appointment booked for {data['appointment_date']}")
-        if data['booking_type'] != 'Manual In-Clinic':
-            send_whatsapp_message(data['mobile_number'], "Appointment confirmation pending from clinic")
-        save_to_csv('patients', pd.read_sql_query("SELECT * FROM patients", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-        save_to_csv('appointments', pd.read_sql_query("SELECT * FROM appointments", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-        save_to_csv('billing', pd.read_sql_query("SELECT * FROM billing", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
-    c.execute('''SELECT a.*, p.name, p.mobile_number, p.age, p.address, d.chief_complaints, d.symptoms, d.mind, d.psychology, 
-                 d.diagnosis, d.medicines, d.tests, d.next_visit, d.diagnosis_saved, d.medicines_prescribed, 
-                 b.consultation_charge, b.medicine_charge, b.courier_charge, b.delivery_type, b.delivered_to, 
-                 b.courier_channel, b.courier_tracking, b.amount_paid, b.payment_date, b.payment_id, b.discount, 
-                 b.medicines_prepared, b.medicines_handed_over, b.couriered, b.checkout_done
-                 FROM appointments a
-                 JOIN patients p ON a.patient_id = p.patient_id
-                 LEFT JOIN diagnoses d ON a.id = d.appointment_id
-                 LEFT JOIN billing b ON a.id = b.appointment_id''')
-    appointments = c.fetchall()
-    conn.close()
-    return render_template_string("""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Receptionist Dashboard</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-</head>
-<body class="bg-gray-100 font-sans">
-    <div class="min-h-screen bg-gradient-to-r from-green-400 to-blue-500 p-4">
-        <div class="container mx-auto bg-white rounded-lg shadow-lg p-6">
-            <div class="flex justify-between items-center mb-6">
-                <h1 class="text-3xl font-bold text-gray-800">Receptionist Dashboard</h1>
-                <a href="/logout" class="bg-red-600 text-white py-2 px-4 rounded hover:bg-red-700">Logout</a>
-            </div>
-            <!-- Search Bar -->
-            <div class="mb-6">
-                <input type="text" id="searchInput" placeholder="Search by Patient Name, Mobile, or Date" class="w-full p-2 border rounded" onkeyup="searchAppointments()">
-            </div>
-            <!-- Appointment Booking -->
-            <div class="mb-8">
-                <h2 class="text-2xl font-semibold text-gray-700 mb-4">Book Appointment</h2>
-                <form method="post" class="space-y-4">
-                    <input type="hidden" name="booking" value="1">
-                    <div class="grid grid-cols-1 md:grid-cols-2 gap-4">
-                        <input type="text" name="patient_name" placeholder="Patient Name" class="p-2 border rounded">
-                        <input type="text" name="mobile_number" placeholder="Mobile Number" class="p-2 border rounded">
-                        <input type="number" name="age" placeholder="Age" class="p-2 border rounded">
-                        <input type="text" name="address" placeholder="Address" class="p-2 border rounded">
-                        <select name="reason" class="p-2 border rounded">
-                            <option value="Consultation">Consultation</option>
-                            <option value="Collecting Medicine">Collecting Medicine</option>
-                            <option value="Other">Other</option>
-                        </select>
-                        <input type="date" name="appointment_date" class="p-2 border rounded">
-                        <select name="booking_type" class="p-2 border rounded">
-                            <option value="Online Direct">Online Direct</option>
-                            <option value="Online Manual">Online Manual</option>
-                            <option value="Manual In-Clinic">Manual In-Clinic</option>
-                        </select>
-                    </div>
-                    <button type="submit" class="bg-blue-600 text-white py-2 px-4 rounded hover:bg-blue-700">Book Appointment</button>
-                </form>
-            </div>
-            <!-- Appointment List -->
-            <div class="mb-8">
-                <h2 class="text-2xl font-semibold text-gray-700 mb-4">Appointments</h2>
-                <div id="appointmentList" class="overflow-x-auto">
-                    <table class="table-auto w-full border-collapse border border-gray-300">
-                        <thead>
-                            <tr>
-                                <th class="border p-2">Patient</th>
-                                <th class="border p-2">Mobile</th>
-                                <th class="border p-2">Date</th>
-                                <th class="border p-2">Reason</th>
-                                <th class="border p-2">Diagnosis</th>
-                                <th class="border p-2">Medicines</th>
-                                <th class="border p-2">Billing</th>
-                                <th class="border p-2">Status</th>
-                                <th class="border p-2">Actions</th>
-                            </tr>
-                        </thead>
-                        <tbody id="appointmentTableBody">
-                            {% for appt in appointments %}
-                            <tr>
-                                <td class="border p-2">{{ appt[9] }}</td>
-                                <td class="border p-2">{{ appt[10] }}</td>
-                                <td class="border p-2">{{ appt[4] }}</td>
-                                <td class="border p-2">{{ appt[2] }}</td>
-                                <td class="border p-2">
-                                    {% if appt[14] %}
-                                    Complaints: {{ appt[14] }}<br>
-                                    Symptoms: {{ appt[15] }}<br>
-                                    Mind: {{ appt[16] }}<br>
-                                    Psychology: {{ appt[17] }}<br>
-                                    Diagnosis: {{ appt[18] }}<br>
-                                    Tests: {{ appt[20] }}<br>
-                                    Next Visit: {{ appt[21] }}
-                                    {% else %}
-                                    Not Diagnosed
-                                    {% endif %}
-                                </td>
-                                <td class="border p-2">{{ appt[19] if appt[19] else 'None' }}</td>
-                                <td class="border p-2">
-                                    {% if appt[23] is not none %}
-                                    Consultation: ${{ appt[23]|default(0, true) }}<br>
-                                    Medicine: ${{ appt[24]|default(0, true) }}<br>
-                                    Courier: ${{ appt[25]|default(0, true) }}<br>
-                                    Delivery: {{ appt[26]|default('In-Person', true) }}<br>
-                                    Delivered To: {{ appt[27]|default('N/A', true) }}<br>
-                                    Courier Channel: {{ appt[28]|default('N/A', true) }}<br>
-                                    Tracking: {{ appt[29]|default('N/A', true) }}<br>
-                                    Paid: ${{ appt[30]|default(0, true) }}<br>
-                                    Discount: ${{ appt[31]|default(0, true) }}
-                                    {% else %}
-                                    Not Billed
-                                    {% endif %}
-                                </td>
-                                <td class="border p-2">
-                                    {% if appt[7] %}✅ Check-In: {{ appt[7] }} @ {{ appt[8] }}{% endif %}
-                                    {% if appt[22] %}📝 Diagnosis Saved{% endif %}
-                                    {% if appt[23] %}💊 Medicines Prescribed{% endif %}
-                                    {% if appt[32] %}📦 Medicines Prepared{% endif %}
-                                    {% if appt[33] %}🚚 Handed Over{% endif %}
-                                    {% if appt[34] %}📬 Couriered{% endif %}
-                                    {% if appt[35] %}✔️ Checked Out{% endif %}
-                                </td>
-                                <td class="border p-2">
-                                    {% if not appt[7] %}
-                                    <button onclick="checkIn('{{ appt[0] }}', 'Scheduled')" class="bg-blue-500 text-white px-2 py-1 rounded">Check-In</button>
-                                    {% endif %}
-                                    <button onclick="showBillingForm('{{ appt[0] }}')" class="bg-purple-500 text-white px-2 py-1 rounded">Billing</button>
-                                    {% if appt[32] and not appt[33] %}
-                                    <button onclick="handOverMedicine('{{ appt[0] }}')" class="bg-green-500 text-white px-2 py-1 rounded">Hand Over Medicine</button>
-                                    {% endif %}
-                                    {% if appt[32] and not appt[34] and appt[26] == 'Courier' %}
-                                    <button onclick="courierDone('{{ appt[0] }}')" class="bg-purple-600 text-white px-2 py-1 rounded">Courier Done</button>
-                                    {% endif %}
-                                    {% if appt[33] or appt[34] %}
-                                    <button onclick="completeCheckout('{{ appt[0] }}')" class="bg-red-600 text-white px-2 py-1 rounded">Complete Checkout</button>
-                                    {% endif %}
-                                </td>
-                            </tr>
-                            {% endfor %}
-                        </tbody>
-                    </table>
-                </div>
-            </div>
-            <!-- Billing Form -->
-            <div class="mb-8">
-                <h2 class="text-2xl font-semibold text-gray-700 mb-4">Billing & Handover</h2>
-                <div id="billingForm" class="space-y-4 hidden">
-                    <input type="hidden" id="billingAppointmentId">
-                    <input type="number" id="consultationCharge" placeholder="Consultation Charge" class="p-2 border rounded">
-                    <input type="number" id="medicineCharge" placeholder="Medicine Charge" class="p-2 border rounded">
-                    <input type="number" id="courierCharge" placeholder="Courier Charge" class="p-2 border rounded">
-                    <select id="deliveryType" class="p-2 border rounded">
-                        <option value="In-Person">In-Person</option>
-                        <option value="Courier">Courier</option>
-                    </select>
-                    <input type="text" id="deliveredTo" placeholder="Delivered To (for In-Person)" class="p-2 border rounded">
-                    <select id="courierChannel" class="p-2 border rounded">
-                        <option value="Rapido">Rapido</option>
-                        <option value="Porter">Porter</option>
-                        <option value="India Post">India Post</option>
-                        <option value="DTDC">DTDC</option>
-                        <option value="BlueDart">BlueDart</option>
-                        <option value="Others">Others</option>
-                    </select>
-                    <input type="text" id="courierTracking" placeholder="Courier Tracking ID" class="p-2 border rounded">
-                    <input type="number" id="amountPaid" placeholder="Amount Paid" class="p-2 border rounded">
-                    <input type="date" id="paymentDate" placeholder="Payment Date" class="p-2 border rounded">
-                    <input type="text" id="paymentId" placeholder="Payment ID" class="p-2 border rounded">
-                    <input type="number" id="discount" placeholder="Discount (if any)" class="p-2 border rounded">
-                    <button onclick="saveBilling()" class="bg-blue-600 text-white py-2 px-4 rounded hover:bg-blue-700">Save Billing</button>
-                </div>
-            </div>
-        </div>
-    </div>
-    <script>
-        async function checkIn(id, status) {
-            await fetch(`/check_in/${id}/${status}`, { method: 'POST' });
-            alert(`Checked in as ${status}`);
-            location.reload();
-        }
-        async function showBillingForm(id) {
-            const response = await fetch(`/billing/${id}`);
-            const data = await response.json();
-            document.getElementById('billingAppointmentId').value = id;
-            document.getElementById('consultationCharge').value = data.consultation_charge || 0;
-            document.getElementById('medicineCharge').value = data.medicine_charge || 0;
-            document.getElementById('courierCharge').value = data.courier_charge || 0;
-            document.getElementById('deliveryType').value = data.delivery_type || 'In-Person';
-            document.getElementById('deliveredTo').value = data.delivered_to || '';
-            document.getElementById('courierChannel').value = data.courier_channel || 'Rapido';
-            document.getElementById('courierTracking').value = data.courier_tracking || '';
-            document.getElementById('amountPaid').value = data.amount_paid || 0;
-            document.getElementById('paymentDate').value = data.payment_date || '';
-            document.getElementById('paymentId').value = data.payment_id || '';
-            document.getElementById('discount').value = data.discount || 0;
-            document.getElementById('billingForm').classList.remove('hidden');
-        }
-        async function saveBilling() {
-            const id = document.getElementById('billingAppointmentId').value;
-            const data = {
-                consultation_charge: parseFloat(document.getElementById('consultationCharge').value) || 0,
-                medicine_charge: parseFloat(document.getElementById('medicineCharge').value) || 0,
-                courier_charge: parseFloat(document.getElementById('courierCharge').value) || 0,
-                delivery_type: document.getElementById('deliveryType').value,
-                delivered_to: document.getElementById('deliveredTo').value,
-                courier_channel: document.getElementById('courierChannel').value,
-                courier_tracking: document.getElementById('courierTracking').value,
-                amount_paid: parseFloat(document.getElementById('amountPaid').value) || 0,
-                payment_date: document.getElementById('paymentDate').value,
-                payment_id: document.getElementById('paymentId').value,
-                discount: parseFloat(document.getElementById('discount').value) || 0
-            };
-            await fetch(`/billing_prepare/${id}`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(data)
-            });
-            alert('Billing saved');
-            location.reload();
-        }
-        async function handOverMedicine(id) {
-            await fetch(`/hand_over_medicine/${id}`, { method: 'POST' });
-            alert('Medicine handed over');
-            location.reload();
-        }
-        async function courierDone(id) {
-            await fetch(`/courier_done/${id}`, { method: 'POST' });
-            alert('Courier done');
-            location.reload();
-        }
-        async function completeCheckout(id) {
-            await fetch(`/complete_checkout/${id}`, { method: 'POST' });
-            alert('Checkout completed');
-            location.reload();
-        }
-        function searchAppointments() {
-            const input = document.getElementById('searchInput').value.toLowerCase();
-            const rows = document.getElementById('appointmentTableBody').getElementsByTagName('tr');
-            for (let row of rows) {
-                const patient = row.cells[0].textContent.toLowerCase();
-                const mobile = row.cells[1].textContent.toLowerCase();
-                const date = row.cells[2].textContent.toLowerCase();
-                row.style.display = (patient.includes(input) || mobile.includes(input) || date.includes(input)) ? '' : 'none';
-            }
-        }
-    </script>
-</body>
-</html>
-    """, appointments=appointments)
+        try:
+            write_queue.submit(lambda conn: book_appointments(conn, [data]))
+        except BookingError as e:
+            return render_template('booking_error.html', message=str(e))
+        dispatch_notifications()
+        schedule_csv_export()
+        publish_changes()
+    return dashboard_response('receptionist_dashboard.html', role='receptionist', providers=PROVIDERS)
 
 @app.route('/doctor_dashboard', methods=['GET'])
 def doctor_dashboard():
     if 'role' not in session or session['role'] != 'doctor':
         return redirect(url_for('login'))
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
-    c.execute('''SELECT a.*, p.name, p.mobile_number, p.age, p.address, d.chief_complaints, d.symptoms, d.mind, d.psychology, 
-                 d.diagnosis, d.medicines, d.tests, d.next_visit, d.diagnosis_saved, d.medicines_prescribed, 
-                 b.consultation_charge, b.medicine_charge, b.courier_charge, b.delivery_type, b.delivered_to, 
-                 b.courier_channel, b.courier_tracking, b.amount_paid, b.payment_date, b.payment_id, b.discount, 
-                 b.medicines_prepared, b.medicines_handed_over, b.couriered, b.checkout_done
-                 FROM appointments a
-                 JOIN patients p ON a.patient_id = p.patient_id
-                 LEFT JOIN diagnoses d ON a.id = d.appointment_id
-                 LEFT JOIN billing b ON a.id = b.appointment_id''')
-    appointments = c.fetchall()
-    conn.close()
-    return render_template_string("""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Doctor Dashboard</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-</head>
-<body class="bg-gray-100 font-sans">
-    <div class="min-h-screen bg-gradient-to-r from-purple-400 to-pink-500 p-4">
-        <div class="container mx-auto bg-white rounded-lg shadow-lg p-6">
-            <div class="flex justify-between items-center mb-6">
-                <h1 class="text-3xl font-bold text-gray-800">Doctor Dashboard</h1>
-                <a href="/logout" class="bg-red-600 text-white py-2 px-4 rounded hover:bg-red-700">Logout</a>
-            </div>
-            <!-- Search Bar -->
-            <div class="mb-6">
-                <input type="text" id="searchInput" placeholder="Search by Patient Name, Mobile, or Date" class="w-full p-2 border rounded" onkeyup="searchAppointments()">
-            </div>
-            <!-- Appointment List -->
-            <div class="mb-8">
-                <h2 class="text-2xl font-semibold text-gray-700 mb-4">Appointments</h2>
-                <div id="appointmentList" class="overflow-x-auto">
-                    <table class="table-auto w-full border-collapse border border-gray-300">
-                        <thead>
-                            <tr>
-                                <th class="border p-2">Patient</th>
-                                <th class="border p-2">Mobile</th>
-                                <th class="border p-2">Date</th>
-                                <th class="border p-2">Reason</th>
-                                <th class="border p-2">Diagnosis</th>
-                                <th class="border p-2">Medicines</th>
-                                <th class="border p-2">Billing</th>
-                                <th class="border p-2">Status</th>
-                                <th class="border p-2">Actions</th>
-                            </tr>
-                        </thead>
-                        <tbody id="appointmentTableBody">
-                            {% for appt in appointments %}
-                            <tr>
-                                <td class="border p-2">{{ appt[9] }}</td>
-                                <td class="border p-2">{{ appt[10] }}</td>
-                                <td class="border p-2">{{ appt[4] }}</td>
-                                <td class="border p-2">{{ appt[2] }}</td>
-                                <td class="border p-2">
-                                    {% if appt[14] %}
-                                    Complaints: {{ appt[14] }}<br>
-                                    Symptoms: {{ appt[15] }}<br>
-                                    Mind: {{ appt[16] }}<br>
-                                    Psychology: {{ appt[17] }}<br>
-                                    Diagnosis: {{ appt[18] }}<br>
-                                    Tests: {{ appt[20] }}<br>
-                                    Next Visit: {{ appt[21] }}
-                                    {% else %}
-                                    Not Diagnosed
-                                    {% endif %}
-                                </td>
-                                <td class="border p-2">{{ appt[19] if appt[19] else 'None' }}</td>
-                                <td class="border p-2">
-                                    {% if appt[23] is not none %}
-                                    Consultation: ${{ appt[23]|default(0, true) }}<br>
-                                    Medicine: ${{ appt[24]|default(0, true) }}<br>
-                                    Courier: ${{ appt[25]|default(0, true) }}<br>
-                                    Delivery: {{ appt[26]|default('In-Person', true) }}<br>
-                                    Delivered To: {{ appt[27]|default('N/A', true) }}<br>
-                                    Courier Channel: {{ appt[28]|default('N/A', true) }}<br>
-                                    Tracking: {{ appt[29]|default('N/A', true) }}<br>
-                                    Paid: ${{ appt[30]|default(0, true) }}<br>
-                                    Discount: ${{ appt[31]|default(0, true) }}
-                                    {% else %}
-                                    Not Billed
-                                    {% endif %}
-                                </td>
-                                <td class="border p-2">
-                                    {% if appt[7] %}✅ Check-In: {{ appt[7] }} @ {{ appt[8] }}{% endif %}
-                                    {% if appt[22] %}📝 Diagnosis Saved{% endif %}
-                                    {% if appt[23] %}💊 Medicines Prescribed{% endif %}
-                                    {% if appt[32] %}📦 Medicines Prepared{% endif %}
-                                    {% if appt[33] %}🚚 Handed Over{% endif %}
-                                    {% if appt[34] %}📬 Couriered{% endif %}
-                                    {% if appt[35] %}✔️ Checked Out{% endif %}
-                                </td>
-                                <td class="border p-2">
-                                    <button onclick="showDoctorForm('{{ appt[0] }}')" class="bg-green-500 text-white px-2 py-1 rounded">View/Edit Diagnosis</button>
-                                </td>
-                            </tr>
-                            {% endfor %}
-                        </tbody>
-                    </table>
-                </div>
-            </div>
-            <!-- Doctor Form -->
-            <div class="mb-8">
-                <h2 class="text-2xl font-semibold text-gray-700 mb-4">Diagnosis & Prescription</h2>
-                <div id="doctorForm" class="space-y-4 hidden">
-                    <input type="hidden" id="appointmentId">
-                    <textarea id="chiefComplaints" placeholder="Chief Complaints" class="p-2 border rounded w-full h-24"></textarea>
-                    <textarea id="symptoms" placeholder="Symptoms Observed" class="p-2 border rounded w-full h-24"></textarea>
-                    <textarea id="mind" placeholder="Mind" class="p-2 border rounded w-full h-24"></textarea>
-                    <textarea id="psychology" placeholder="Psychology" class="p-2 border rounded w-full h-24"></textarea>
-                    <textarea id="diagnosis" placeholder="Diagnosis" class="p-2 border rounded w-full h-24"></textarea>
-                    <textarea id="medicines" placeholder="Medicines Prescribed" class="p-2 border rounded w-full h-24"></textarea>
-                    <textarea id="tests" placeholder="Tests Prescribed" class="p-2 border rounded w-full h-24"></textarea>
-                    <input type="date" id="nextVisit" placeholder="Next Visit" class="p-2 border rounded">
-                    <button onclick="saveDiagnosis()" class="bg-green-600 text-white py-2 px-4 rounded hover:bg-green-700">Save</button>
-                </div>
-            </div>
-        </div>
-    </div>
-    <script>
-        async function showDoctorForm(id) {
-            const response = await fetch(`/diagnosis/${id}`);
-            const data = await response.json();
-            document.getElementById('appointmentId').value = id;
-            document.getElementById('chiefComplaints').value = data.chief_complaints || '';
-            document.getElementById('symptoms').value = data.symptoms || '';
-            document.getElementById('mind').value = data.mind || '';
-            document.getElementById('psychology').value = data.psychology || '';
-            document.getElementById('diagnosis').value = data.diagnosis || '';
-            document.getElementById('medicines').value = data.medicines || '';
-            document.getElementById('tests').value = data.tests || '';
-            document.getElementById('nextVisit').value = data.next_visit || '';
-            document.getElementById('doctorForm').classList.remove('hidden');
-        }
-        async function saveDiagnosis() {
-            const id = document.getElementById('appointmentId').value;
-            const data = {
-                chief_complaints: document.getElementById('chiefComplaints').value,
-                symptoms: document.getElementById('symptoms').value,
-                mind: document.getElementById('mind').value,
-                psychology: document.getElementById('psychology').value,
-                diagnosis: document.getElementById('diagnosis').value,
-                medicines: document.getElementById('medicines').value,
-                tests: document.getElementById('tests').value,
-                next_visit: document.getElementById('nextVisit').value
-            };
-            await fetch(`/save_diagnosis/${id}`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(data)
-            });
-            alert('Diagnosis and prescription saved');
-            location.reload();
-        }
-        function searchAppointments() {
-            const input = document.getElementById('searchInput').value.toLowerCase();
-            const rows = document.getElementById('appointmentTableBody').getElementsByTagName('tr');
-            for (let row of rows) {
-                const patient = row.cells[0].textContent.toLowerCase();
-                const mobile = row.cells[1].textContent.toLowerCase();
-                const date = row.cells[2].textContent.toLowerCase();
-                row.style.display = (patient.includes(input) || mobile.includes(input) || date.includes(input)) ? '' : 'none';
-            }
-        }
-    </script>
-</body>
-</html>
-    """, appointments=appointments)
+    return dashboard_response('doctor_dashboard.html', role='doctor')
 
 @app.route('/pharmacist_dashboard', methods=['GET'])
 def pharmacist_dashboard():
     if 'role' not in session or session['role'] != 'pharmacist':
         return redirect(url_for('login'))
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
-    c.execute('''SELECT a.*, p.name, p.mobile_number, p.age, p.address, d.chief_complaints, d.symptoms, d.mind, d.psychology, 
-                 d.diagnosis, d.medicines, d.tests, d.next_visit, d.diagnosis_saved, d.medicines_prescribed, 
-                 b.consultation_charge, b.medicine_charge, b.courier_charge, b.delivery_type, b.delivered_to, 
-                 b.courier_channel, b.courier_tracking, b.amount_paid, b.payment_date, b.payment_id, b.discount, 
-                 b.medicines_prepared, b.medicines_handed_over, b.couriered, b.checkout_done
-                 FROM appointments a
-                 JOIN patients p ON a.patient_id = p.patient_id
-                 LEFT JOIN diagnoses d ON a.id = d.appointment_id
-                 LEFT JOIN billing b ON a.id = b.appointment_id
-                 WHERE d.medicines_prescribed = 1''')
-    appointments = c.fetchall()
-    conn.close()
-    return render_template_string("""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Pharmacist Dashboard</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-</head>
-<body class="bg-gray-100 font-sans">
-    <div class="min-h-screen bg-gradient-to-r from-teal-400 to-blue-500 p-4">
-        <div class="container mx-auto bg-white rounded-lg shadow-lg p-6">
-            <div class="flex justify-between items-center mb-6">
-                <h1 class="text-3xl font-bold text-gray-800">Pharmacist Dashboard</h1>
-                <a href="/logout" class="bg-red-600 text-white py-2 px-4 rounded hover:bg-red-700">Logout</a>
-            </div>
-            <!-- Search Bar -->
-            <div class="mb-6">
-                <input type="text" id="searchInput" placeholder="Search by Patient Name or Mobile" class="w-full p-2 border rounded" onkeyup="searchAppointments()">
-            </div>
-            <!-- Medicine Preparation -->
-            <div class="mb-8">
-                <h2 class="text-2xl font-semibold text-gray-700 mb-4">Medicine Preparation</h2>
-                <div class="overflow-x-auto">
-                    <table class="table-auto w-full border-collapse border border-gray-300">
-                        <thead>
-                            <tr>
-                                <th class="border p-2">Patient</th>
-                                <th class="border p-2">Mobile</th>
-                                <th class="border p-2">Date</th>
-                                <th class="border p-2">Medicines</th>
-                                <th class="border p-2">Diagnosis</th>
-                                <th class="border p-2">Billing</th>
-                                <th class="border p-2">Status</th>
-                                <th class="border p-2">Action</th>
-                            </tr>
-                        </thead>
-                        <tbody id="appointmentTableBody">
-                            {% for appt in appointments %}
-                            <tr>
-                                <td class="border p-2">{{ appt[9] }}</td>
-                                <td class="border p-2">{{ appt[10] }}</td>
-                                <td class="border p-2">{{ appt[4] }}</td>
-                                <td class="border p-2">{{ appt[19] if appt[19] else 'None' }}</td>
-                                <td class="border p-2">
-                                    {% if appt[14] %}
-                                    Complaints: {{ appt[14] }}<br>
-                                    Symptoms: {{ appt[15] }}<br>
-                                    Mind: {{ appt[16] }}<br>
-                                    Psychology: {{ appt[17] }}<br>
-                                    Diagnosis: {{ appt[18] }}<br>
-                                    Tests: {{ appt[20] }}<br>
-                                    Next Visit: {{ appt[21] }}
-                                    {% else %}
-                                    Not Diagnosed
-                                    {% endif %}
-                                </td>
-                                <td class="border p-2">
-                                    {% if appt[23] is not none %}
-                                    Consultation: ${{ appt[23]|default(0, true) }}<br>
-                                    Medicine: ${{ appt[24]|default(0, true) }}<br>
-                                    Courier: ${{ appt[25]|default(0, true) }}<br>
-                                    Delivery: {{ appt[26]|default('In-Person', true) }}<br>
-                                    Delivered To: {{ appt[27]|default('N/A', true) }}<br>
-                                    Courier Channel: {{ appt[28]|default('N/A', true) }}<br>
-                                    Tracking: {{ appt[29]|default('N/A', true) }}<br>
-                                    Paid: ${{ appt[30]|default(0, true) }}<br>
-                                    Discount: ${{ appt[31]|default(0, true) }}
-                                    {% else %}
-                                    Not Billed
-                                    {% endif %}
-                                </td>
-                                <td class="border p-2">
-                                    {% if appt[7] %}✅ Check-In: {{ appt[7] }} @ {{ appt[8] }}{% endif %}
-                                    {% if appt[22] %}📝 Diagnosis Saved{% endif %}
-                                    {% if appt[23] %}💊 Medicines Prescribed{% endif %}
-                                    {% if appt[32] %}📦 Medicines Prepared{% endif %}
-                                    {% if appt[33] %}🚚 Handed Over{% endif %}
-                                    {% if appt[34] %}📬 Couriered{% endif %}
-                                    {% if appt[35] %}✔️ Checked Out{% endif %}
-                                </td>
-                                <td class="border p-2">
-                                    {% if not appt[32] %}
-                                    <button onclick="prepareMedicine('{{ appt[0] }}')" class="bg-blue-500 text-white px-2 py-1 rounded">Prepare Medicine</button>
-                                    {% endif %}
-                                </td>
-                            </tr>
-                            {% endfor %}
-                        </tbody>
-                    </table>
-                </div>
-            </div>
-        </div>
-    </div>
-    <script>
-        async function prepareMedicine(id) {
-            await fetch(`/prepare_medicine/${id}`, { method: 'POST' });
-            alert('Medicines prepared');
-            location.reload();
-        }
-        function searchAppointments() {
-            const input = document.getElementById('searchInput').value.toLowerCase();
-            const rows = document.getElementById('appointmentTableBody').getElementsByTagName('tr');
-            for (let row of rows) {
-                const patient = row.cells[0].textContent.toLowerCase();
-                const mobile = row.cells[1].textContent.toLowerCase();
-                row.style.display = (patient.includes(input) || mobile.includes(input)) ? '' : 'none';
-            }
-        }
-    </script>
-</body>
-</html>
-    """, appointments=appointments)
+    return dashboard_response('pharmacist_dashboard.html', prescribed_only=True, role='pharmacist')
+
+def queue_payload(patients):
+    return {'date': patient_queue.day, 'waiting': len(patient_queue),
+            'average_consult_minutes': round(patient_queue.average_consult() / 60, 1), 'patients': patients}
+
+@app.route('/queue', methods=['GET'])
+def queue():
+    # Today's checked-in patients not yet diagnosed, in the order they will be
+    # seen, with estimated waits; answered from memory, see patient_queue.py
+    if 'role' not in session or session['role'] not in ('doctor', 'receptionist'):
+        return jsonify({'message': 'Unauthorized'}), 403
+    patient_queue.refresh(get_db())
+    return jsonify(queue_payload(patient_queue.snapshot()))
+
+@app.route('/queue/next', methods=['GET'])
+def queue_next():
+    if 'role' not in session or session['role'] not in ('doctor', 'receptionist'):
+        return jsonify({'message': 'Unauthorized'}), 403
+    patient_queue.refresh(get_db())
+    following = patient_queue.next()
+    return jsonify(queue_payload([following] if following else []))
+
+@app.route('/queue/<id>/priority', methods=['POST'])
+def queue_priority(id):
+    # {"priority": n}; higher is seen sooner
+    if 'role' not in session or session['role'] not in ('doctor', 'receptionist'):
+        return jsonify({'message': 'Unauthorized'}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        priority = int(data['priority'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'message': 'priority must be an integer'}), 400
+    updated = write_queue.submit(lambda conn: conn.execute(
+        'UPDATE appointments SET priority = ? WHERE id = ?', (priority, id)).rowcount)
+    if not updated:
+        return jsonify({'message': 'Appointment not found'}), 404
+    patient_queue.refresh(get_db())
+    schedule_csv_export()
+    publish_changes()
+    return jsonify({'message': 'Priority updated'})
+
+@app.route('/events', methods=['GET'])
+def events():
+    if 'role' not in session:
+        return jsonify({'message': 'Unauthorized'}), 403
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    return Response(live_feed.stream(last_event_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/appointment_row/<id>', methods=['GET'])
+def appointment_row(id):
+    # One dashboard row, rendered exactly as the full page renders it
+    if 'role' not in session:
+        return jsonify({'message': 'Unauthorized'}), 403
+    role = session['role']
+    appt = fetch_appointment(get_db(), id)
+    if appt is None or (role == 'pharmacist' and not appt['medicines_prescribed']):
+        return '', 404
+    return get_template_attribute('partials/rows.html', 'appointment_row')(appt, role)
+
+@app.route('/api/v1/appointments', methods=['GET'])
+def api_appointments():
+    columns = PROJECTIONS.get(session.get('role'))
+    if columns is None:
+        return jsonify({'message': 'Unauthorized'}), 403
+    appointments, page = fetch_page(get_db(), page_params(request.args),
+                                    prescribed_only=session['role'] == 'pharmacist', columns=columns)
+    return json_response(rows_payload(columns, appointments, page))
+
+@app.route('/api/v1/appointments/<id>', methods=['GET'])
+def api_appointment(id):
+    columns = PROJECTIONS.get(session.get('role'))
+    if columns is None:
+        return jsonify({'message': 'Unauthorized'}), 403
+    appointment = fetch_appointment(get_db(), id, columns)
+    if appointment is None:
+        return jsonify({'message': 'Appointment not found'}), 404
+    return json_response(rows_payload(columns, [appointment]))
+
+@app.route('/api/v1/reports/daily', methods=['GET'])
+def api_daily_report():
+    if 'role' not in session or session['role'] != 'receptionist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    report = report_range(request.args)
+    if report is None:
+        return jsonify({'message': 'start/end must be YYYY-MM-DD and at most a year apart'}), 400
+    return json_response(rows_payload(DAILY_COLUMNS, daily_summary(get_db(), *report)))
+
+@app.route('/api/v1/reports/credit', methods=['GET'])
+def api_credit_report():
+    if 'role' not in session or session['role'] != 'receptionist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    limit = max(1, min(1000, request.args.get('limit', 100, type=int)))
+    return json_response(rows_payload(CREDIT_COLUMNS, outstanding_credit(get_db(), limit)))
+
+@app.route('/api/v1/slots', methods=['GET'])
+def api_free_slots():
+    # Next free slots from now (or ?date=YYYY-MM-DD), optionally for one ?provider=
+    if 'role' not in session or session['role'] != 'receptionist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    start = None
+    if request.args.get('date'):
+        try:
+            start = max(datetime.strptime(request.args['date'], '%Y-%m-%d'), datetime.now())
+        except ValueError:
+            return jsonify({'message': 'date must be YYYY-MM-DD'}), 400
+    provider = request.args.get('provider')
+    if provider and provider not in PROVIDERS:
+        return jsonify({'message': f'Unknown provider {provider}'}), 400
+    count = max(1, min(100, request.args.get('n', 10, type=int)))
+    slot_index.refresh(get_db())
+    slots = slot_index.next_free(count, start, [provider] if provider else None)
+    return jsonify({'slots': [{'date': day, 'slot_time': time, 'provider': name} for day, time, name in slots]})
+
+def history_response(patient_id):
+    columns = PROJECTIONS.get(session.get('role'))
+    if columns is None:
+        return jsonify({'message': 'Unauthorized'}), 403
+    history = history_cache.get(get_db(), patient_id)
+    if history is None:
+        return jsonify({'message': 'Patient not found'}), 404
+    patient, visits = history
+    shown = [column for column in HISTORY_COLUMNS if column in columns]
+    positions = [HISTORY_COLUMNS.index(column) for column in shown]
+    payload = rows_payload(shown, [[visit[i] for i in positions] for visit in visits])
+    payload['patient'] = patient
+    return json_response(payload)
+
+@app.route('/api/v1/patients/<patient_id>/history', methods=['GET'])
+def api_patient_history(patient_id):
+    return history_response(patient_id)
+
+@app.route('/api/v1/appointments/<id>/history', methods=['GET'])
+def api_appointment_history(id):
+    # The history of whichever patient this appointment belongs to
+    if 'role' not in session:
+        return jsonify({'message': 'Unauthorized'}), 403
+    c = get_db().cursor()
+    c.execute('SELECT patient_id FROM appointments WHERE id = ?', (id,))
+    appointment = c.fetchone()
+    if appointment is None:
+        return jsonify({'message': 'Appointment not found'}), 404
+    return history_response(appointment[0])
 
 @app.route('/book_appointment', methods=['POST'])
 def book_appointment():
     if 'role' not in session or session['role'] != 'receptionist':
         return jsonify({'message': 'Unauthorized'}), 403
+    # A single booking object, or a list of them booked in one transaction
     data = request.json
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
-    # Check for existing patient
-    c.execute('SELECT patient_id FROM patients WHERE mobile_number = ?', (data['mobile_number'],))
-    patient = c.fetchone()
-    if patient:
-        patient_id = patient[0]
-        c.execute('UPDATE patients SET name = ?, age = ?, address = ? WHERE patient_id = ?',
-                  (data['name'], data['age'], data['address'], patient_id))
-    else:
-        patient_id = str(uuid.uuid4())
-        c.execute('INSERT INTO patients (patient_id, name, mobile_number, age, address) VALUES (?, ?, ?, ?, ?)',
-                  (patient_id, data['name'], data['mobile_number'], data['age'], data['address']))
-    # Book appointment
-    appointment_id = str(uuid.uuid4())
-    booking_date = datetime.now().strftime('%Y-%m-%d')
-    today = datetime.now().date()
-    appt_date = datetime.strptime(data['appointment_date'], '%Y-%m-%d').date()
-    if appt_date == today and data['booking_type'] == 'Online Direct':
-        conn.close()
-        return jsonify({'message': 'Same-day online bookings not allowed'}), 400
-    c.execute('''INSERT INTO appointments (id, patient_id, reason, booking_date, appointment_date, booking_type, confirmed, checkin_status, checkin_time)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                 (appointment_id, patient_id, data['reason'], booking_date, data['appointment_date'], data['booking_type'], 0, '', ''))
-    c.execute('INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, ?, 0)',
-              (appointment_id, 'In-Person'))
-    conn.commit()
-    conn.close()
-    send_whatsapp_message(data['mobile_number'], f"Appointment booked for {data['appointment_date']}")
-    if data['booking_type'] != 'Manual In-Clinic':
-        send_whatsapp_message(data['mobile_number'], "Appointment confirmation pending from clinic")
-    save_to_csv('patients', pd.read_sql_query("SELECT * FROM patients", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-    save_to_csv('appointments', pd.read_sql_query("SELECT * FROM appointments", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-    save_to_csv('billing', pd.read_sql_query("SELECT * FROM billing", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-    return jsonify({'message': 'Appointment booked'})
+    bookings = data if isinstance(data, list) else [data]
+    try:
+        appointment_ids = write_queue.submit(lambda conn: book_appointments(conn, bookings))
+    except BookingError as e:
+        return jsonify({'message': str(e)}), 400
+    dispatch_notifications()
+    schedule_csv_export()
+    publish_changes()
+    if isinstance(data, list):
+        return jsonify({'message': f'{len(appointment_ids)} appointments booked', 'appointment_ids': appointment_ids})
+    return jsonify({'message': 'Appointment booked', 'appointment_id': appointment_ids[0]})
+
+@app.route('/download', methods=['GET'])
+def download():
+    # e.g. /download?dataset=billing&month=2025-03&format=excel
+    if 'role' not in session or session['role'] != 'receptionist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    dataset = request.args.get('dataset', 'appointments')
+    fmt = request.args.get('format', 'csv')
+    if fmt not in FORMATS:
+        return jsonify({'message': f"format must be one of {', '.join(FORMATS)}"}), 400
+    try:
+        sql, args, columns, label, years = download_query(dataset, request.args)
+    except DownloadError as e:
+        return jsonify({'message': str(e)}), 400
+    writer, mimetype, extension = FORMATS[fmt]
+    # No Content-Length, so the body goes out with chunked transfer as it is generated
+    body = timed_export(f'download_{fmt}', writer(columns, stream_rows(connect, sql, args, years)))
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{label}.{extension}"'})
+
+@app.route('/import', methods=['POST'])
+def import_upload():
+    if 'role' not in session or session['role'] != 'receptionist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'message': 'No file uploaded'}), 400
+    extension = os.path.splitext(upload.filename)[1].lower()
+    if extension not in ('.csv',) + SPREADSHEET_EXTENSIONS:
+        return jsonify({'message': 'Upload a .csv or .xlsx file'}), 400
+    if extension in SPREADSHEET_EXTENSIONS and not spreadsheets_supported():
+        return jsonify({'message': 'This server cannot read .xlsx files; upload a .csv file'}), 400
+    os.makedirs(IMPORT_FOLDER, exist_ok=True)
+    source = os.path.join(IMPORT_FOLDER, uuid.uuid4().hex + extension)
+    upload.save(source)
+    job_id = write_queue.submit(lambda conn: create_job(conn, source, source + '.rejects.csv'))
+    def imported():
+        schedule_csv_export()
+        publish_changes()
+    start_import(connect, job_id, on_done=imported)
+    return jsonify({'message': 'Import started', 'job_id': job_id}), 202
+
+@app.route('/import/<job_id>', methods=['GET'])
+def import_progress(job_id):
+    if 'role' not in session or session['role'] != 'receptionist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    job = job_status(get_db(), job_id)
+    if job is None:
+        return jsonify({'message': 'Import not found'}), 404
+    del job['source'], job['reject_file']
+    return jsonify(job)
+
+@app.route('/import/<job_id>/rejects', methods=['GET'])
+def import_rejects(job_id):
+    if 'role' not in session or session['role'] != 'receptionist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    job = job_status(get_db(), job_id)
+    if job is None or not job['rejected'] or not os.path.exists(job['reject_file']):
+        return jsonify({'message': 'No rejected rows'}), 404
+    return send_file(job['reject_file'], mimetype='text/csv', as_attachment=True, download_name=f'rejects-{job_id}.csv')
 
 @app.route('/check_in/<id>/<status>', methods=['POST'])
 def check_in(id, status):
     if 'role' not in session or session['role'] != 'receptionist':
         return jsonify({'message': 'Unauthorized'}), 403
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
+    checkin_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    # ?priority= puts the patient ahead in today's queue (higher goes first)
+    priority = request.args.get('priority', type=int)
     # Only update check-in status and time, no new entries
-    c.execute('UPDATE appointments SET checkin_status = ?, checkin_time = ? WHERE id = ?',
-              (status, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), id))
-    c.execute('SELECT patient_id FROM appointments WHERE id = ?', (id,))
-    patient_id = c.fetchone()
-    if not patient_id:
-        conn.close()
+    updated = write_queue.submit(lambda conn: conn.execute(
+        'UPDATE appointments SET checkin_status = ?, checkin_time = ?, priority = COALESCE(?, priority) WHERE id = ?',
+        (status, checkin_time, priority, id)).rowcount)
+    if not updated:
         return jsonify({'message': 'Appointment not found'}), 404
-    conn.commit()
-    conn.close()
-    save_to_csv('appointments', pd.read_sql_query("SELECT * FROM appointments", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
+    patient_queue.refresh(get_db())
+    schedule_csv_export()
+    publish_changes()
     return jsonify({'message': 'Checked in'})
 
 @app.route('/diagnosis/<id>', methods=['GET'])
 def get_diagnosis(id):
     if 'role' not in session or session['role'] != 'doctor':
         return jsonify({'message': 'Unauthorized'}), 403
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
+    conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT * FROM diagnoses WHERE appointment_id = ?', (id,))
+    c.row_factory = sqlite3.Row
+    c.execute('''SELECT chief_complaints, symptoms, mind, psychology, diagnosis, medicines, tests, next_visit,
+                 diagnosis_saved, medicines_prescribed FROM diagnoses WHERE appointment_id = ?''', (id,))
     diagnosis = c.fetchone()
-    conn.close()
     return jsonify({
-        'chief_complaints': diagnosis[1] if diagnosis else '',
-        'symptoms': diagnosis[2] if diagnosis else '',
-        'mind': diagnosis[3] if diagnosis else '',
-        'psychology': diagnosis[4] if diagnosis else '',
-        'diagnosis': diagnosis[5] if diagnosis else '',
-        'medicines': diagnosis[6] if diagnosis else '',
-        'tests': diagnosis[7] if diagnosis else '',
-        'next_visit': diagnosis[8] if diagnosis else '',
-        'diagnosis_saved': diagnosis[9] if diagnosis else 0,
-        'medicines_prescribed': diagnosis[10] if diagnosis else 0
+        'chief_complaints': diagnosis['chief_complaints'] if diagnosis else '',
+        'symptoms': diagnosis['symptoms'] if diagnosis else '',
+        'mind': diagnosis['mind'] if diagnosis else '',
+        'psychology': diagnosis['psychology'] if diagnosis else '',
+        'diagnosis': diagnosis['diagnosis'] if diagnosis else '',
+        'medicines': diagnosis['medicines'] if diagnosis else '',
+        'tests': diagnosis['tests'] if diagnosis else '',
+        'next_visit': diagnosis['next_visit'] if diagnosis else '',
+        'diagnosis_saved': diagnosis['diagnosis_saved'] if diagnosis else 0,
+        'medicines_prescribed': diagnosis['medicines_prescribed'] if diagnosis else 0
     })
 
 @app.route('/save_diagnosis/<id>', methods=['POST'])
@@ -816,68 +592,116 @@ def save_diagnosis(id):
         return jsonify({'message': 'Unauthorized'}), 403
     data = request.json
     medicines_prescribed = 1 if data['medicines'].strip() else 0
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
+    # Structured line items if the client sends them, else parsed from the free text
+    if data.get('items'):
+        try:
+            items = check_items(data['items'])
+        except PrescriptionError as e:
+            return jsonify({'message': str(e)}), 400
+    else:
+        items = parse_items(data['medicines'])
+    write_queue.submit(lambda conn: store_diagnosis(conn, id, data, medicines_prescribed, items))
+    history_cache.invalidate_appointment(id)
+    patient_queue.refresh(get_db())
+    dispatch_notifications()
+    schedule_csv_export()
+    publish_changes()
+    return jsonify({'message': 'Diagnosis and prescription saved'})
+
+def store_diagnosis(conn, id, data, medicines_prescribed, items):
+    # WriteQueue command for save_diagnosis
     c = conn.cursor()
-    c.execute('''INSERT OR REPLACE INTO diagnoses (appointment_id, chief_complaints, symptoms, mind, psychology, diagnosis, medicines, tests, next_visit, diagnosis_saved, medicines_prescribed)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                 (id, data['chief_complaints'], data['symptoms'], data['mind'], data['psychology'], data['diagnosis'], data['medicines'], data['tests'], data['next_visit'], 1, medicines_prescribed))
+    # saved_at keeps the first save, when the consult ended; later edits leave it
+    c.execute('''INSERT INTO diagnoses (appointment_id, chief_complaints, symptoms, mind, psychology, diagnosis, medicines, tests, next_visit, diagnosis_saved, medicines_prescribed, saved_at)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 ON CONFLICT(appointment_id) DO UPDATE SET
+                 chief_complaints = excluded.chief_complaints, symptoms = excluded.symptoms, mind = excluded.mind,
+                 psychology = excluded.psychology, diagnosis = excluded.diagnosis, medicines = excluded.medicines,
+                 tests = excluded.tests, next_visit = excluded.next_visit, diagnosis_saved = excluded.diagnosis_saved,
+                 medicines_prescribed = excluded.medicines_prescribed, saved_at = COALESCE(diagnoses.saved_at, excluded.saved_at)''',
+                 (id, data['chief_complaints'], data['symptoms'], data['mind'], data['psychology'], data['diagnosis'], data['medicines'], data['tests'], data['next_visit'], 1, medicines_prescribed,
+                  datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    save_items(conn, id, items)
     c.execute('INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, ?, 0)',
               (id, 'In-Person'))
-    conn.commit()
     if medicines_prescribed:
         c.execute('SELECT p.mobile_number FROM appointments a JOIN patients p ON a.patient_id = p.patient_id WHERE a.id = ?', (id,))
         mobile = c.fetchone()[0]
-        send_whatsapp_message(mobile, "Medicines prescribed")
-    conn.close()
-    save_to_csv('diagnoses', pd.read_sql_query("SELECT * FROM diagnoses", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-    save_to_csv('billing', pd.read_sql_query("SELECT * FROM billing", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-    return jsonify({'message': 'Diagnosis and prescription saved'})
+        send_whatsapp_message(conn, mobile, "Medicines prescribed", f'{id}:medicines_prescribed')
 
 @app.route('/prepare_medicine/<id>', methods=['POST'])
 def prepare_medicine(id):
     if 'role' not in session or session['role'] != 'pharmacist':
         return jsonify({'message': 'Unauthorized'}), 403
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, ?, 0)',
-              (id, 'In-Person'))
-    c.execute('UPDATE billing SET medicines_prepared = 1 WHERE appointment_id = ?', (id,))
-    c.execute('SELECT p.mobile_number FROM appointments a JOIN patients p ON a.patient_id = p.patient_id WHERE a.id = ?', (id,))
-    mobile = c.fetchone()[0]
-    conn.commit()
-    conn.close()
-    send_whatsapp_message(mobile, "Medicines prepared")
-    save_to_csv('billing', pd.read_sql_query("SELECT * FROM billing", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
+
+    def command(conn):
+        moved = advance(conn, id, 'prepare')
+        # Stock only leaves the shelf the first time; a repeated click changes nothing
+        if moved:
+            take_stock(conn, id)
+            send_whatsapp_message(conn, moved[0], "Medicines prepared", f'{id}:medicines_prepared')
+    try:
+        write_queue.submit(command)
+    except TransitionError as e:
+        return jsonify({'message': str(e)}), e.status
+    except StockError as e:
+        return jsonify({'message': str(e)}), 409
+    dispatch_notifications()
+    schedule_csv_export()
+    publish_changes()
     return jsonify({'message': 'Medicines prepared'})
 
+@app.route('/api/v1/pharmacy/pick_list', methods=['GET'])
+def pharmacy_pick_list():
+    if 'role' not in session or session['role'] != 'pharmacist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    day = request.args.get('date') or datetime.now().strftime('%Y-%m-%d')
+    return json_response(rows_payload(PICK_LIST_COLUMNS, pick_list(get_db(), day)))
+
+@app.route('/api/v1/pharmacy/stock', methods=['GET', 'POST'])
+def pharmacy_stock():
+    if 'role' not in session or session['role'] != 'pharmacist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    if request.method == 'POST':
+        try:
+            name, quantity, unit, reorder_level = check_stock_change(request.get_json(silent=True))
+        except StockChangeError as e:
+            return jsonify({'message': str(e)}), 400
+        try:
+            write_queue.submit(lambda conn: adjust_stock(conn, name, quantity, unit, reorder_level))
+        except StockError as e:
+            return jsonify({'message': str(e)}), 409
+    return json_response(rows_payload(STOCK_COLUMNS, stock_levels(get_db(), request.args.get('low') == '1')))
+
 @app.route('/billing/<id>', methods=['GET'])
 def get_billing(id):
     if 'role' not in session or session['role'] != 'receptionist':
         return jsonify({'message': 'Unauthorized'}), 403
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, ?, 0)',
-              (id, 'In-Person'))
-    c.execute('SELECT * FROM billing WHERE appointment_id = ?', (id,))
+    # Read-only: bookings create the billing row, and store_billing and
+    # advance_bill create it if missing, so until then this shows the defaults
+    c = get_db().cursor()
+    c.row_factory = sqlite3.Row
+    c.execute('''SELECT consultation_charge, medicine_charge, courier_charge, delivery_type, delivered_to,
+                 courier_channel, courier_tracking, amount_paid, payment_date, payment_id, discount,
+                 medicines_prepared, medicines_handed_over, couriered, checkout_done
+                 FROM billing WHERE appointment_id = ?''', (id,))
     billing = c.fetchone()
-    conn.commit()
-    conn.close()
     return jsonify({
-        'consultation_charge': float(billing[1]) if billing and billing[1] is not None else 0.0,
-        'medicine_charge': float(billing[2]) if billing and billing[2] is not None else 0.0,
-        'courier_charge': float(billing[3]) if billing and billing[3] is not None else 0.0,
-        'delivery_type': billing[4] if billing and billing[4] is not None else 'In-Person',
-        'delivered_to': billing[5] if billing and billing[5] is not None else '',
-        'courier_channel': billing[6] if billing and billing[6] is not None else '',
-        'courier_tracking': billing[7] if billing and billing[7] is not None else '',
-        'amount_paid': float(billing[8]) if billing and billing[8] is not None else 0.0,
-        'payment_date': billing[9] if billing and billing[9] is not None else '',
-        'payment_id': billing[10] if billing and billing[10] is not None else '',
-        'discount': float(billing[11]) if billing and billing[11] is not None else 0.0,
-        'medicines_prepared': billing[12] if billing and billing[12] is not None else 0,
-        'medicines_handed_over': billing[13] if billing and billing[13] is not None else 0,
-        'couriered': billing[14] if billing and billing[14] is not None else 0,
-        'checkout_done': billing[15] if billing and billing[15] is not None else 0
+        'consultation_charge': float(billing['consultation_charge']) if billing and billing['consultation_charge'] is not None else 0.0,
+        'medicine_charge': float(billing['medicine_charge']) if billing and billing['medicine_charge'] is not None else 0.0,
+        'courier_charge': float(billing['courier_charge']) if billing and billing['courier_charge'] is not None else 0.0,
+        'delivery_type': billing['delivery_type'] if billing and billing['delivery_type'] is not None else 'In-Person',
+        'delivered_to': billing['delivered_to'] if billing and billing['delivered_to'] is not None else '',
+        'courier_channel': billing['courier_channel'] if billing and billing['courier_channel'] is not None else '',
+        'courier_tracking': billing['courier_tracking'] if billing and billing['courier_tracking'] is not None else '',
+        'amount_paid': float(billing['amount_paid']) if billing and billing['amount_paid'] is not None else 0.0,
+        'payment_date': billing['payment_date'] if billing and billing['payment_date'] is not None else '',
+        'payment_id': billing['payment_id'] if billing and billing['payment_id'] is not None else '',
+        'discount': float(billing['discount']) if billing and billing['discount'] is not None else 0.0,
+        'medicines_prepared': billing['medicines_prepared'] if billing and billing['medicines_prepared'] is not None else 0,
+        'medicines_handed_over': billing['medicines_handed_over'] if billing and billing['medicines_handed_over'] is not None else 0,
+        'couriered': billing['couriered'] if billing and billing['couriered'] is not None else 0,
+        'checkout_done': billing['checkout_done'] if billing and billing['checkout_done'] is not None else 0
     })
 
 @app.route('/billing_prepare/<id>', methods=['POST'])
@@ -885,7 +709,14 @@ def billing_prepare(id):
     if 'role' not in session or session['role'] != 'receptionist':
         return jsonify({'message': 'Unauthorized'}), 403
     data = request.json
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
+    write_queue.submit(lambda conn: store_billing(conn, id, data))
+    history_cache.invalidate_appointment(id)
+    schedule_csv_export()
+    publish_changes()
+    return jsonify({'message': 'Billing saved'})
+
+def store_billing(conn, id, data):
+    # WriteQueue command for billing_prepare
     c = conn.cursor()
     c.execute('INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, ?, 0)',
               (id, 'In-Person'))
@@ -906,82 +737,76 @@ def billing_prepare(id):
                   data['payment_id'] or '',
                   float(data['discount']) if data['discount'] else 0.0,
                   id))
-    conn.commit()
-    conn.close()
-    save_to_csv('billing', pd.read_sql_query("SELECT * FROM billing", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-    return jsonify({'message': 'Billing saved'})
 
 @app.route('/hand_over_medicine/<id>', methods=['POST'])
 def hand_over_medicine(id):
     if 'role' not in session or session['role'] != 'receptionist':
         return jsonify({'message': 'Unauthorized'}), 403
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, ?, 0)',
-              (id, 'In-Person'))
-    c.execute('SELECT medicines_prepared FROM billing WHERE appointment_id = ?', (id,))
-    prepared = c.fetchone()
-    if not prepared or not prepared[0]:
-        conn.close()
-        return jsonify({'message': 'Medicines not prepared yet'}), 400
-    c.execute('UPDATE billing SET medicines_handed_over = 1 WHERE appointment_id = ?', (id,))
-    c.execute('SELECT p.mobile_number FROM appointments a JOIN patients p ON a.patient_id = p.patient_id WHERE a.id = ?', (id,))
-    mobile = c.fetchone()[0]
-    conn.commit()
-    conn.close()
-    send_whatsapp_message(mobile, "Medicines handed over")
-    save_to_csv('billing', pd.read_sql_query("SELECT * FROM billing", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
+    try:
+        write_queue.submit(lambda conn: advance_bill(conn, id, 'hand_over'))
+    except TransitionError as e:
+        return jsonify({'message': str(e)}), e.status
+    dispatch_notifications()
+    schedule_csv_export()
+    publish_changes()
     return jsonify({'message': 'Medicine handed over'})
 
 @app.route('/courier_done/<id>', methods=['POST'])
 def courier_done(id):
     if 'role' not in session or session['role'] != 'receptionist':
         return jsonify({'message': 'Unauthorized'}), 403
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, ?, 0)',
-              (id, 'In-Person'))
-    c.execute('SELECT medicines_prepared, delivery_type FROM billing WHERE appointment_id = ?', (id,))
-    billing = c.fetchone()
-    if not billing or not billing[0]:
-        conn.close()
-        return jsonify({'message': 'Medicines not prepared yet'}), 400
-    if billing[1] != 'Courier':
-        conn.close()
-        return jsonify({'message': 'Delivery type is not Courier'}), 400
-    c.execute('UPDATE billing SET couriered = 1 WHERE appointment_id = ?', (id,))
-    c.execute('SELECT p.mobile_number FROM appointments a JOIN patients p ON a.patient_id = p.patient_id WHERE a.id = ?', (id,))
-    mobile = c.fetchone()[0]
-    conn.commit()
-    conn.close()
-    send_whatsapp_message(mobile, "Medicines couriered")
-    save_to_csv('billing', pd.read_sql_query("SELECT * FROM billing", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
+    try:
+        write_queue.submit(lambda conn: advance_bill(conn, id, 'courier'))
+    except TransitionError as e:
+        return jsonify({'message': str(e)}), e.status
+    dispatch_notifications()
+    schedule_csv_export()
+    publish_changes()
     return jsonify({'message': 'Courier done'})
 
 @app.route('/complete_checkout/<id>', methods=['POST'])
 def complete_checkout(id):
     if 'role' not in session or session['role'] != 'receptionist':
         return jsonify({'message': 'Unauthorized'}), 403
-    conn = sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, ?, 0)',
-              (id, 'In-Person'))
-    c.execute('SELECT medicines_prepared, medicines_handed_over, couriered, consultation_charge, medicine_charge, courier_charge, amount_paid, discount FROM billing WHERE appointment_id = ?', (id,))
-    billing = c.fetchone()
-    if not billing or (not billing[1] and not billing[2]):
-        conn.close()
-        return jsonify({'message': 'Medicines not handed over or couriered'}), 400
-    c.execute('UPDATE billing SET checkout_done = 1 WHERE appointment_id = ?', (id,))
-    total_due = (billing[3] or 0) + (billing[4] or 0) + (billing[5] or 0) - (billing[7] or 0)
-    if billing[6] < total_due:
-        print(f"Credit due for appointment {id}: {total_due - billing[6]}")
-    c.execute('SELECT p.mobile_number FROM appointments a JOIN patients p ON a.patient_id = p.patient_id WHERE a.id = ?', (id,))
-    mobile = c.fetchone()[0]
-    conn.commit()
-    conn.close()
-    send_whatsapp_message(mobile, "Checkout completed")
-    save_to_csv('billing', pd.read_sql_query("SELECT * FROM billing", sqlite3.connect(os.getenv('DATABASE_PATH', 'clinic.db'))).to_dict('records'))
-    return jsonify({'message': 'Checkout completed'})
+    try:
+        credit_due = write_queue.submit(lambda conn: advance_bill(conn, id, 'checkout'))
+    except TransitionError as e:
+        return jsonify({'message': str(e)}), e.status
+    dispatch_notifications()
+    schedule_csv_export()
+    publish_changes()
+    return jsonify({'message': 'Checkout completed', 'credit_due': credit_due})
+
+@app.route('/billing_advance', methods=['POST'])
+def billing_advance():
+    # Moves many bills one step at once, e.g. {"action": "courier", "appointment_ids": [...]}
+    # for the end-of-day courier run; bills that cannot move are listed, not fatal
+    if 'role' not in session or session['role'] != 'receptionist':
+        return jsonify({'message': 'Unauthorized'}), 403
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'message': 'Expected a JSON object'}), 400
+    action = data.get('action')
+    if action not in BILLING_MESSAGES:
+        return jsonify({'message': f"action must be one of {', '.join(BILLING_MESSAGES)}"}), 400
+    # Appointment ids are UUID strings
+    appointment_ids = data.get('appointment_ids') or []
+    if not isinstance(appointment_ids, list) or not all(isinstance(i, str) and i for i in appointment_ids):
+        return jsonify({'message': 'appointment_ids must be a list of appointment ids'}), 400
+    appointment_ids = list(dict.fromkeys(appointment_ids))
+
+    def command(conn):
+        moved, skipped = advance_many(conn, appointment_ids, action)
+        for appointment_id, (mobile, _) in moved.items():
+            send_billing_message(conn, mobile, action, appointment_id)
+        return moved, skipped
+    moved, skipped = write_queue.submit(command)
+    if moved:
+        dispatch_notifications()
+        schedule_csv_export()
+        publish_changes()
+    return jsonify({'message': f'{len(moved)} of {len(appointment_ids)} updated', 'updated': list(moved),
+                    'skipped': skipped})
 
 # No app.run() for production; Gunicorn handles server startup
 
@@ -0,0 +1,261 @@
+import collections
+import glob
+import logging
+import os
+import re
+import time
+from datetime import date, datetime, timedelta
+
+from background import BackgroundThread
+from search import rebuild_index
+
+logger = logging.getLogger(__name__)
+
+# Closed visits (checked out, older than ARCHIVE_AFTER_DAYS) move out of the
+# live database into one SQLite file per appointment year under ARCHIVE_FOLDER,
+# so the live file, and the pages the workflow touches, stay small. Patients
+# stay live; archived_visits says which years hold a patient's old visits, and
+# history, downloads and report rebuilds ATTACH just those files when asked.
+ARCHIVE_FOLDER = os.getenv('ARCHIVE_FOLDER', 'archive')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '730'))
+BATCH_SIZE = 500
+# SQLite attaches at most 10 databases by default, and one of those is the live file
+MAX_ATTACHED = 9
+# Local hour at which a worker runs the nightly archive and maintenance; empty
+# turns the in-process job off (run 'flask archive' and 'flask maintain' from cron)
+MAINTENANCE_HOUR = os.getenv('MAINTENANCE_HOUR', '2')
+CHECK_SECONDS = 600
+# ANALYZE samples about this many rows per index rather than reading them all
+ANALYSIS_LIMIT = int(os.getenv('ANALYSIS_LIMIT', '1000'))
+
+# Tables moved with a visit, children first, by their appointment key
+ARCHIVED_TABLES = [('prescription_items', 'appointment_id'), ('diagnoses', 'appointment_id'),
+                   ('billing', 'appointment_id'), ('appointments', 'id')]
+# Archives are read by patient (history) and by date (downloads, report rebuilds)
+ARCHIVE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_appointments_patient_date ON appointments (patient_id, appointment_date)',
+    'CREATE INDEX IF NOT EXISTS idx_appointments_date_id ON appointments (appointment_date, id)',
+    'CREATE INDEX IF NOT EXISTS idx_billing_payment_date ON billing (payment_date)',
+]
+# A crash between the archive commit and the live delete leaves a visit in
+# both; until the next run moves it again, the live copy is the one shown
+NOT_LIVE = 'NOT EXISTS (SELECT 1 FROM main.appointments live WHERE live.id = a.id)'
+
+
+def archive_schema():
+    return [
+        '''CREATE TABLE IF NOT EXISTS archived_visits (
+            patient_id TEXT NOT NULL, year TEXT NOT NULL, visits INTEGER NOT NULL,
+            PRIMARY KEY (patient_id, year)
+        ) WITHOUT ROWID''',
+        # One row per scheduled job, so only one worker runs it each night
+        '''CREATE TABLE IF NOT EXISTS maintenance_runs (
+            job TEXT PRIMARY KEY, last_run TEXT NOT NULL
+        )''',
+    ]
+
+
+def archive_path(year):
+    return os.path.join(ARCHIVE_FOLDER, f'clinic-{year}.db')
+
+
+def archived_years():
+    years = []
+    for path in glob.glob(os.path.join(ARCHIVE_FOLDER, 'clinic-*.db')):
+        match = re.fullmatch(r'clinic-(\d{4})\.db', os.path.basename(path))
+        if match:
+            years.append(match.group(1))
+    return sorted(years)
+
+
+def attach(conn, years):
+    # Attaches the archive of each year that has one, as archive_<year>, and
+    # returns those aliases. Not inside a transaction; see detach().
+    aliases = []
+    for year in years:
+        if not re.fullmatch(r'\d{4}', year) or not os.path.exists(archive_path(year)):
+            continue
+        alias = f'archive_{year}'
+        conn.execute(f'ATTACH DATABASE ? AS {alias}', (archive_path(year),))
+        aliases.append(alias)
+    return aliases
+
+
+def detach(conn, aliases):
+    # Pooled connections must go back without them
+    for alias in aliases:
+        conn.execute(f'DETACH DATABASE {alias}')
+
+
+def _open_archive(connect, year, live_path):
+    # The year's file with the live tables' current shape: created from their
+    # CREATE statements, then any column added live since is added here too
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+    conn = connect(archive_path(year))
+    conn.execute('ATTACH DATABASE ? AS live', (live_path,))
+    c = conn.cursor()
+    for table, _ in ARCHIVED_TABLES:
+        c.execute("SELECT sql FROM live.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        create = re.sub(r'^CREATE TABLE\s+(IF NOT EXISTS\s+)?', 'CREATE TABLE IF NOT EXISTS ', c.fetchone()[0])
+        c.execute(create)
+        c.execute(f'PRAGMA main.table_info({table})')
+        present = {row[1] for row in c.fetchall()}
+        c.execute(f'PRAGMA live.table_info({table})')
+        for _, column, kind, _, default, _ in c.fetchall():
+            if column not in present:
+                c.execute(f'ALTER TABLE main.{table} ADD COLUMN {column} {kind}'
+                          + (f' DEFAULT {default}' if default is not None else ''))
+    for statement in ARCHIVE_INDEXES:
+        c.execute(statement)
+    return conn
+
+
+def _copy(conn, appointment_ids):
+    placeholders = ','.join('?' * len(appointment_ids))
+    conn.execute('BEGIN')
+    try:
+        for table, key in ARCHIVED_TABLES:
+            columns = ', '.join(row[1] for row in conn.execute(f'PRAGMA live.table_info({table})').fetchall())
+            conn.execute(f'''INSERT OR REPLACE INTO main.{table} ({columns})
+                             SELECT {columns} FROM live.{table} WHERE {key} IN ({placeholders})''', appointment_ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def archive_closed(connect, days=ARCHIVE_AFTER_DAYS, batch_size=BATCH_SIZE):
+    # Moves checked-out visits from before today - days, a batch at a time.
+    # Each batch is copied and committed in its year's file while the live
+    # database's write lock is held, then deleted live in one transaction; two
+    # commits rather than one across files, since SQLite only makes
+    # multi-database commits atomic outside WAL mode. Returns {year: visits moved}.
+    cutoff = (date.today() - timedelta(days=days)).isoformat()
+    live = connect()
+    live_path = live.execute('PRAGMA database_list').fetchone()[2]
+    archives = {}
+    moved = collections.Counter()
+    try:
+        while True:
+            live.execute('BEGIN IMMEDIATE')
+            try:
+                c = live.cursor()
+                c.execute('''SELECT a.id, a.patient_id, substr(a.appointment_date, 1, 4) FROM appointments a
+                             JOIN billing b ON b.appointment_id = a.id
+                             WHERE a.appointment_date < ? AND a.appointment_date GLOB '[0-9][0-9][0-9][0-9]-*'
+                               AND b.checkout_done = 1
+                             LIMIT ?''', (cutoff, batch_size))
+                visits = c.fetchall()
+                if not visits:
+                    live.rollback()
+                    break
+                by_year = collections.defaultdict(list)
+                for appointment_id, _, year in visits:
+                    by_year[year].append(appointment_id)
+                for year, appointment_ids in by_year.items():
+                    if year not in archives:
+                        archives[year] = _open_archive(connect, year, live_path)
+                    _copy(archives[year], appointment_ids)
+                appointment_ids = [visit[0] for visit in visits]
+                placeholders = ','.join('?' * len(appointment_ids))
+                for table, key in ARCHIVED_TABLES:
+                    c.execute(f'DELETE FROM {table} WHERE {key} IN ({placeholders})', appointment_ids)
+                counts = collections.Counter((patient_id, year) for _, patient_id, year in visits)
+                c.executemany('''INSERT INTO archived_visits (patient_id, year, visits) VALUES (?, ?, ?)
+                                 ON CONFLICT (patient_id, year) DO UPDATE SET visits = visits + excluded.visits''',
+                              [(patient_id, year, count) for (patient_id, year), count in counts.items()])
+                live.commit()
+            except Exception:
+                live.rollback()
+                raise
+            for year, appointment_ids in by_year.items():
+                moved[year] += len(appointment_ids)
+    finally:
+        for conn in archives.values():
+            conn.close()
+        live.close()
+    return dict(moved)
+
+
+def optimize(conn):
+    # Fresh planner statistics, then free pages handed back to the file system
+    # when the database allows it, then the WAL checkpointed and truncated.
+    # Returns {'freed_pages': n, 'auto_vacuum': mode} for the log.
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA optimize')
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    # Only a database switched to auto_vacuum = INCREMENTAL (2) by 'flask
+    # maintain --vacuum --incremental' shrinks here; otherwise the pages the
+    # archiver frees are reused by new rows. execute() would stop after the
+    # first page freed; executescript() steps the pragma to the end.
+    if mode == 2 and free:
+        conn.executescript('PRAGMA incremental_vacuum')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    return {'freed_pages': free - conn.execute('PRAGMA freelist_count').fetchone()[0], 'auto_vacuum': mode}
+
+
+def claim_run(conn, job, day):
+    # True for the one caller that gets to run job today
+    c = conn.execute('''INSERT INTO maintenance_runs (job, last_run) VALUES (?, ?)
+                        ON CONFLICT (job) DO UPDATE SET last_run = excluded.last_run WHERE last_run < excluded.last_run
+                        RETURNING job''', (job, day))
+    claimed = c.fetchone() is not None
+    conn.commit()
+    return claimed
+
+
+def run_maintenance(connect):
+    moved = archive_closed(connect)
+    conn = connect()
+    try:
+        result = optimize(conn)
+    finally:
+        conn.close()
+    return moved, result
+
+
+class MaintenanceJob:
+    # Every worker checks every CHECK_SECONDS; during MAINTENANCE_HOUR the first
+    # to claim today's run in maintenance_runs archives and optimizes
+    def __init__(self, connect, hour=MAINTENANCE_HOUR, interval=CHECK_SECONDS):
+        self.connect = connect
+        self.hour = int(hour) if hour != '' else None
+        self.interval = interval
+        self._worker = BackgroundThread(self._run, 'maintenance')
+
+    def ensure_started(self):
+        if self.hour is not None:
+            self._worker.ensure_started()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = datetime.now()
+            if now.hour != self.hour:
+                continue
+            try:
+                conn = self.connect()
+                try:
+                    claimed = claim_run(conn, 'nightly', now.date().isoformat())
+                finally:
+                    conn.close()
+                if claimed:
+                    moved, result = run_maintenance(self.connect)
+                    logger.info('Nightly maintenance: archived %s, %s', moved or 'nothing', result)
+            except Exception:
+                logger.exception('Nightly maintenance failed')
+
+
+def vacuum(conn, incremental=False):
+    # Rewrites the whole file at its smallest, optionally switching it to
+    # incremental vacuum (which optimize() then runs nightly, at some cost to
+    # every write: about 1.5x on the workflow benchmark). VACUUM may renumber
+    # the appointments rowids the search index is keyed on, so it is re-derived.
+    if incremental:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    conn.execute('BEGIN IMMEDIATE')
+    rebuild_index(conn)
+    conn.commit()
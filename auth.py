@@ -0,0 +1,78 @@
+import csv
+import hashlib
+import hmac
+import os
+
+# PBKDF2 work factor for new hashes; stored hashes carry their own count and
+# are upgraded on the next successful login when this changes
+PASSWORD_HASH_ITERATIONS = int(os.getenv('PASSWORD_HASH_ITERATIONS', '260000'))
+
+DEFAULT_USERS = [
+    ('receptionist', 'rec123', 'receptionist'),
+    ('doctor', 'doc123', 'doctor'),
+    ('pharmacist', 'pharm123', 'pharmacist'),
+]
+
+
+def hash_password(password, iterations=None):
+    iterations = iterations or PASSWORD_HASH_ITERATIONS
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f'pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}'
+
+
+def verify_password(password, stored):
+    if stored.startswith('pbkdf2_sha256$'):
+        _, iterations, salt, digest = stored.split('$')
+        candidate = hashlib.pbkdf2_hmac('sha256', password.encode(), bytes.fromhex(salt), int(iterations))
+        return hmac.compare_digest(candidate.hex(), digest)
+    # Unsalted SHA-256 hex digests carried over from users.csv
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+
+def needs_rehash(stored):
+    return not stored.startswith(f'pbkdf2_sha256${PASSWORD_HASH_ITERATIONS}$')
+
+
+def authenticate(conn, username, password, submit):
+    # Returns the user's role, or None if the credentials do not match. An
+    # outdated hash is replaced through submit (writer.WriteQueue.submit); it
+    # is computed here first so the writer never waits on PBKDF2, and only
+    # replaces the hash it was checked against.
+    c = conn.cursor()
+    c.execute('SELECT password_hash, role FROM users WHERE username = ?', (username,))
+    user = c.fetchone()
+    if not user or not verify_password(password, user[0]):
+        return None
+    if needs_rehash(user[0]):
+        new_hash = hash_password(password)
+        submit(lambda conn: conn.execute('UPDATE users SET password_hash = ? WHERE username = ? AND password_hash = ?',
+                                         (new_hash, username, user[0])))
+    return user[1]
+
+
+def set_password(conn, username, password, role):
+    conn.execute('''INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)
+                    ON CONFLICT(username) DO UPDATE SET password_hash = excluded.password_hash, role = excluded.role''',
+                 (username, hash_password(password), role))
+
+
+def seed_users(conn):
+    # Keep whatever accounts users.csv held (their SHA-256 hashes are upgraded
+    # at next login); only fall back to the stock accounts on a fresh install
+    path = os.path.join(os.getenv('UPLOAD_FOLDER', 'uploads'), 'users.csv')
+    if os.path.exists(path):
+        with open(path, newline='') as f:
+            rows = [(row['username'], row['password'], row['role']) for row in csv.DictReader(f)]
+    else:
+        rows = [(username, hash_password(password), role) for username, password, role in DEFAULT_USERS]
+    conn.executemany('INSERT OR IGNORE INTO users (username, password_hash, role) VALUES (?, ?, ?)', rows)
+
+
+def users_schema():
+    return [
+        '''CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY, password_hash TEXT NOT NULL, role TEXT NOT NULL
+        )''',
+        seed_users,
+    ]
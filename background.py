@@ -0,0 +1,32 @@
+import os
+import threading
+
+
+class BackgroundThread:
+    # A daemon thread running target, at most one per process. Threads do not
+    # survive a fork, so ensure_started() starts a fresh one in each Gunicorn
+    # worker, first calling on_start (under the lock) to reset any state the
+    # worker inherited from its parent.
+    def __init__(self, target, name, on_start=None):
+        self.target = target
+        self.name = name
+        self.on_start = on_start
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def ensure_started(self):
+        # Cheap once running, so callers can call it on every use
+        if self.is_running():
+            return
+        with self._lock:
+            if self.is_running():
+                return
+            self._pid = os.getpid()
+            if self.on_start is not None:
+                self.on_start()
+            self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self._thread.start()
@@ -0,0 +1,93 @@
+# Synthetic clinic database: patients with visits spread over the past
+# --years (closed out: diagnosed, prepared, billed, checked out) plus the
+# coming week's bookings, written through the real schema and triggers.
+#
+#   python benchmarks/seed.py PATH [--patients 2000] [--appointments 20000] [--years 3]
+import argparse
+import os
+import random
+import sys
+import uuid
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import connect  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+REASONS = ['Consultation', 'Collecting Medicine', 'Other']
+BOOKING_TYPES = ['Online Direct', 'Online Manual', 'Manual In-Clinic']
+MEDICINES = ['Arnica 30', 'Belladonna 200', 'Nux Vomica 30', 'Pulsatilla 200', 'Rhus Tox 30', 'Bryonia 30']
+BATCH_SIZE = 5000
+
+
+def seed(path, patients=2000, appointments=20000, years=3, rng=None):
+    rng = rng or random.Random(0)
+    conn = connect(path)
+    migrate(conn)
+    today = date.today()
+    patient_ids = [str(uuid.uuid4()) for _ in range(patients)]
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany('INSERT INTO patients (patient_id, name, mobile_number, age, address) VALUES (?, ?, ?, ?, ?)',
+                     [(patient_id, f'Patient {n}', f'8{n:09d}', rng.randint(1, 90), f'{n} Main Road')
+                      for n, patient_id in enumerate(patient_ids)])
+    conn.executemany("INSERT INTO medicines (name, unit, stock, reorder_level) VALUES (?, 'bottle', ?, 20)",
+                     [(name, 10 ** 6) for name in MEDICINES])
+    conn.commit()
+    for start in range(0, appointments, BATCH_SIZE):
+        visits, diagnoses, bills, items = [], [], [], []
+        for _ in range(min(BATCH_SIZE, appointments - start)):
+            appointment_id = str(uuid.uuid4())
+            # One in twenty is still upcoming; the rest are history
+            if rng.random() < 0.05:
+                day = today + timedelta(days=rng.randint(1, 7))
+                visits.append((appointment_id, rng.choice(patient_ids), rng.choice(REASONS),
+                               (day - timedelta(days=3)).isoformat(), day.isoformat(), rng.choice(BOOKING_TYPES),
+                               0, '', ''))
+                bills.append((appointment_id, 0, 0, 0, '', '', '', '', 0, '', '', 0, 0, 0, 0, 0, 'open'))
+                continue
+            day = today - timedelta(days=rng.randint(1, 365 * years))
+            visits.append((appointment_id, rng.choice(patient_ids), rng.choice(REASONS),
+                           (day - timedelta(days=3)).isoformat(), day.isoformat(), rng.choice(BOOKING_TYPES),
+                           1, 'Scheduled', f'{day.isoformat()} 10:00:00'))
+            medicine = rng.choice(MEDICINES)
+            diagnoses.append((appointment_id, 'Headache', 'Throbbing', 'Calm', 'Anxious', 'Migraine',
+                              f'{medicine} x 2 - twice daily', '', '', 1, 1))
+            items.append((appointment_id, 1, medicine, 2, 'twice daily'))
+            charge = rng.choice([300, 500, 800])
+            bills.append((appointment_id, charge, 200, 0, 'In-Person', 'self', '', '', charge + 200,
+                          day.isoformat(), f'pay-{appointment_id[:8]}', 0, 1, 1, 0, 1, 'checked_out'))
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('''INSERT INTO appointments (id, patient_id, reason, booking_date, appointment_date,
+                                booking_type, confirmed, checkin_status, checkin_time)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', visits)
+        conn.executemany('''INSERT INTO diagnoses (appointment_id, chief_complaints, symptoms, mind, psychology,
+                                diagnosis, medicines, tests, next_visit, diagnosis_saved, medicines_prescribed)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', diagnoses)
+        conn.executemany('''INSERT INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge,
+                                delivery_type, delivered_to, courier_channel, courier_tracking, amount_paid,
+                                payment_date, payment_id, discount, medicines_prepared, medicines_handed_over,
+                                couriered, checkout_done, state)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', bills)
+        conn.executemany('''INSERT INTO prescription_items (appointment_id, line, medicine_name, medicine_id, quantity, dosage)
+                            VALUES (?1, ?2, ?3, (SELECT id FROM medicines WHERE name = ?3), ?4, ?5)''', items)
+        conn.commit()
+    # Seeding is not the workload; start the benchmark from an exported state
+    conn.execute('DELETE FROM change_log')
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--appointments', type=int, default=20000)
+    parser.add_argument('--years', type=int, default=3)
+    args = parser.parse_args()
+    seed(args.path, args.patients, args.appointments, args.years)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Worker cold start: time to import app in a fresh interpreter and the peak RSS
+# of that process, against an already-migrated database as Gunicorn workers see
+# it. Exits non-zero if the median is over budget.
+#
+#   python benchmarks/startup.py [--runs 10] [--budget-ms 400] [--budget-mb 45]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'import_ms': elapsed * 1000, 'rss_mb': rss_kb / 1024}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=400)
+    parser.add_argument('--budget-mb', type=float, default=45)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as folder:
+        env = dict(os.environ, DATABASE_PATH=os.path.join(folder, 'startup.db'), UPLOAD_FOLDER=folder,
+                   TEMPLATE_CACHE_DIR=folder)
+        # First import migrates and fills the template bytecode cache, as the
+        # Gunicorn master does once before forking workers
+        subprocess.run([sys.executable, '-c', CHILD, ROOT], env=env, check=True, stdout=subprocess.DEVNULL)
+        samples = []
+        for _ in range(args.runs):
+            out = subprocess.run([sys.executable, '-c', CHILD, ROOT], env=env, check=True, capture_output=True, text=True)
+            samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    import_ms = statistics.median(sample['import_ms'] for sample in samples)
+    rss_mb = statistics.median(sample['rss_mb'] for sample in samples)
+    print(f'import app: median {import_ms:.0f} ms, max {max(s["import_ms"] for s in samples):.0f} ms '
+          f'(budget {args.budget_ms:.0f} ms)')
+    print(f'peak RSS:   median {rss_mb:.1f} MB (budget {args.budget_mb:.0f} MB)')
+    if import_ms > args.budget_ms or rss_mb > args.budget_mb:
+        print('over budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
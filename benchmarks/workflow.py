@@ -0,0 +1,287 @@
+# Clinic workflow load test: seeds a synthetic database (benchmarks/seed.py),
+# then each simulated visit goes book -> check in -> diagnose -> prepare
+# medicines -> bill -> hand over -> check out, with dashboard loads in
+# between. Reports p50/p99 latency and throughput per route and compares them
+# with the stored baseline; exits non-zero on a regression.
+#
+#   python benchmarks/workflow.py [--visits 200] [--concurrency 1] [--gunicorn [--workers 4]]
+#                                 [--patients 2000] [--appointments 20000] [--years 3]
+#                                 [--save-baseline] [--tolerance 0.3] [--p99-tolerance 1.0]
+#
+# In-process runs use the Flask test client, so they measure the application
+# and SQLite only; --gunicorn starts a local server and goes over HTTP.
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.seed import seed  # noqa: E402
+
+BASELINE_DIR = os.path.join(ROOT, 'benchmarks', 'baselines')
+USERS = {'receptionist': 'rec123', 'doctor': 'doc123', 'pharmacist': 'pharm123'}
+# Dashboards and list APIs are loaded once every this many visits
+DASHBOARD_EVERY = 5
+# Below this many samples p99 is just the slowest request, too noisy to gate on
+MIN_P99_SAMPLES = 100
+
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json_body=None, form=None):
+        response = self.client.open(path, method=method, json=json_body, data=form)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, json_body=None, form=None):
+        headers, body = {}, None
+        if json_body is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(json_body).encode()
+        elif form is not None:
+            body = urllib.parse.urlencode(form).encode()
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(req) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Recorder:
+    # Latency samples per route template, e.g. 'POST /check_in/<id>/<status>'
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def call(self, client, route, method, path, expect=(200,), **kwargs):
+        started = time.perf_counter()
+        status, body = client.request(method, path, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.samples.setdefault(route, []).append(elapsed)
+            if status not in expect:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return json.loads(body) if body[:1] == b'{' else None
+
+
+def login(client, role):
+    status, _ = client.request('POST', '/', form={'username': role, 'password': USERS[role]})
+    if status not in (200, 302):
+        raise SystemExit(f'login as {role} failed: {status}')
+
+
+def visit(clients, recorder, n):
+    rc, dc, pc = clients['receptionist'], clients['doctor'], clients['pharmacist']
+    today = date.today().isoformat()
+    booking = {'name': f'Bench {n}', 'mobile_number': f'7{n:09d}', 'age': 30 + n % 50, 'address': 'Bench Street',
+               'reason': 'Consultation', 'appointment_date': today, 'booking_type': 'Manual In-Clinic'}
+    result = recorder.call(rc, 'POST /book_appointment', 'POST', '/book_appointment', json_body=booking)
+    if not result or 'appointment_id' not in result:
+        return
+    appointment_id = result['appointment_id']
+    recorder.call(rc, 'POST /check_in/<id>/<status>', 'POST', f'/check_in/{appointment_id}/Scheduled')
+    recorder.call(dc, 'GET /diagnosis/<id>', 'GET', f'/diagnosis/{appointment_id}')
+    recorder.call(dc, 'POST /save_diagnosis/<id>', 'POST', f'/save_diagnosis/{appointment_id}', json_body={
+        'chief_complaints': 'Headache', 'symptoms': 'Throbbing', 'mind': 'Calm', 'psychology': 'Anxious',
+        'diagnosis': 'Migraine', 'medicines': 'Arnica 30 x 2 - twice daily\nBryonia 30', 'tests': '',
+        'next_visit': ''})
+    recorder.call(pc, 'POST /prepare_medicine/<id>', 'POST', f'/prepare_medicine/{appointment_id}')
+    recorder.call(rc, 'POST /billing_prepare/<id>', 'POST', f'/billing_prepare/{appointment_id}', json_body={
+        'consultation_charge': 500, 'medicine_charge': 200, 'courier_charge': 0, 'delivery_type': 'In-Person',
+        'delivered_to': 'self', 'courier_channel': '', 'courier_tracking': '', 'amount_paid': 650,
+        'payment_date': today, 'payment_id': f'bench-{n}', 'discount': 0})
+    recorder.call(rc, 'POST /hand_over_medicine/<id>', 'POST', f'/hand_over_medicine/{appointment_id}')
+    recorder.call(rc, 'POST /complete_checkout/<id>', 'POST', f'/complete_checkout/{appointment_id}')
+    if n % DASHBOARD_EVERY == 0:
+        recorder.call(rc, 'GET /receptionist_dashboard', 'GET', '/receptionist_dashboard')
+        recorder.call(dc, 'GET /doctor_dashboard', 'GET', '/doctor_dashboard')
+        recorder.call(pc, 'GET /pharmacist_dashboard', 'GET', '/pharmacist_dashboard')
+        recorder.call(rc, 'GET /api/v1/appointments', 'GET', '/api/v1/appointments')
+        recorder.call(rc, 'GET /api/v1/reports/daily', 'GET', '/api/v1/reports/daily')
+
+
+def percentile(ordered, q):
+    # Nearest rank
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def summarize(recorder, elapsed):
+    routes = {}
+    for route, samples in sorted(recorder.samples.items()):
+        ordered = sorted(samples)
+        routes[route] = {
+            'count': len(ordered),
+            'errors': recorder.errors.get(route, 0),
+            'p50_ms': round(percentile(ordered, 0.50) * 1000, 2),
+            'p99_ms': round(percentile(ordered, 0.99) * 1000, 2),
+            'rps': round(len(ordered) / elapsed, 1),
+        }
+    return routes
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(env, workers):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+                               'app:app'], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, f'http://127.0.0.1:{port}'
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit('gunicorn exited during startup')
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit('gunicorn did not start listening')
+
+
+def compare(routes, baseline, tolerance, p99_tolerance):
+    regressions = []
+    for route, base in baseline['routes'].items():
+        current = routes.get(route)
+        if current is None:
+            continue
+        if current['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{route}: p50 {current['p50_ms']} ms vs {base['p50_ms']} ms")
+        if current['count'] >= MIN_P99_SAMPLES and current['p99_ms'] > base['p99_ms'] * (1 + p99_tolerance):
+            regressions.append(f"{route}: p99 {current['p99_ms']} ms vs {base['p99_ms']} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--visits', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--gunicorn', action='store_true', help='Drive a local Gunicorn over HTTP.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--appointments', type=int, default=20000)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--baseline', help='Baseline file (default benchmarks/baselines/workflow-<mode>.json).')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='Allowed p50 slowdown, as a fraction.')
+    parser.add_argument('--p99-tolerance', type=float, default=1.0, help='Allowed p99 slowdown, as a fraction.')
+    args = parser.parse_args()
+    mode = 'gunicorn' if args.gunicorn else 'testclient'
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR, f'workflow-{mode}.json')
+
+    with tempfile.TemporaryDirectory() as folder:
+        env = dict(os.environ, DATABASE_PATH=os.path.join(folder, 'bench.db'), UPLOAD_FOLDER=folder,
+                   TEMPLATE_CACHE_DIR=folder, NOTIFICATION_TRANSPORT='fake')
+        print(f'seeding {args.patients} patients, {args.appointments} appointments over {args.years} years')
+        started = time.perf_counter()
+        os.environ.update(env)
+        seed(env['DATABASE_PATH'], args.patients, args.appointments, args.years)
+        print(f'seeded in {time.perf_counter() - started:.1f} s')
+
+        server = None
+        if args.gunicorn:
+            server, base_url = start_gunicorn(env, args.workers)
+
+            def make_client():
+                return HttpClient(base_url)
+        else:
+            from app import app
+
+            def make_client():
+                return TestClient(app)
+
+        recorder = Recorder()
+        sessions = []
+        for _ in range(args.concurrency):
+            clients = {role: make_client() for role in USERS}
+            for role, client in clients.items():
+                login(client, role)
+            sessions.append(clients)
+
+        def run(worker):
+            for n in range(worker, args.visits, args.concurrency):
+                visit(sessions[worker], recorder, n)
+
+        try:
+            started = time.perf_counter()
+            threads = [threading.Thread(target=run, args=(worker,)) for worker in range(args.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    routes = summarize(recorder, elapsed)
+    print(f'{args.visits} visits in {elapsed:.1f} s ({args.visits / elapsed:.1f} visits/s, {mode}, '
+          f'concurrency {args.concurrency})')
+    print(f"{'route':40} {'count':>6} {'err':>4} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>7}")
+    for route, stats in routes.items():
+        print(f"{route:40} {stats['count']:6} {stats['errors']:4} {stats['p50_ms']:8.2f} {stats['p99_ms']:8.2f} "
+              f"{stats['rps']:7.1f}")
+
+    result = {
+        'config': {'visits': args.visits, 'concurrency': args.concurrency, 'mode': mode, 'workers': args.workers
+                   if args.gunicorn else None, 'patients': args.patients, 'appointments': args.appointments,
+                   'years': args.years},
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                        'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'routes': routes,
+    }
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'baseline saved to {baseline_path}')
+        return
+    failed = any(stats['errors'] for stats in routes.values())
+    if failed:
+        print('some requests failed')
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline['config'] != result['config']:
+            print(f'baseline {baseline_path} was recorded with {baseline["config"]}; not comparing')
+        else:
+            regressions = compare(routes, baseline, args.tolerance, args.p99_tolerance)
+            for regression in regressions:
+                print(f'regression: {regression}')
+            failed = failed or bool(regressions)
+    else:
+        print(f'no baseline at {baseline_path}; run with --save-baseline to record one')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+from reporting import credit_sql
+
+# A bill moves open -> prepared -> handed_over or couriered -> checked_out.
+# billing.state is the authority; the legacy flag columns are still set by the
+# same statements so dashboards, exports and the summaries keep working.
+STATES = ('open', 'prepared', 'handed_over', 'couriered', 'checked_out')
+_RANK = {'open': 0, 'prepared': 1, 'handed_over': 2, 'couriered': 2, 'checked_out': 3}
+
+# action -> (from states, to state, legacy flag, extra guard, refusal while still short of the from states)
+TRANSITIONS = {
+    'prepare': (('open',), 'prepared', 'medicines_prepared', '', None),
+    'hand_over': (('prepared',), 'handed_over', 'medicines_handed_over', '', 'Medicines not prepared yet'),
+    'courier': (('prepared',), 'couriered', 'couriered', "AND delivery_type = 'Courier'", 'Medicines not prepared yet'),
+    'checkout': (('handed_over', 'couriered'), 'checked_out', 'checkout_done', '',
+                 'Medicines not handed over or couriered'),
+}
+BATCH_LIMIT = 500
+
+_MOBILE = '''(SELECT p.mobile_number FROM appointments a JOIN patients p ON a.patient_id = p.patient_id
+              WHERE a.id = billing.appointment_id)'''
+
+
+class TransitionError(ValueError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def billing_state_schema():
+    return [
+        "ALTER TABLE billing ADD COLUMN state TEXT NOT NULL DEFAULT 'open' "
+        "CHECK (state IN ('open', 'prepared', 'handed_over', 'couriered', 'checked_out'))",
+        '''UPDATE billing SET state = CASE
+               WHEN checkout_done = 1 THEN 'checked_out'
+               WHEN couriered = 1 THEN 'couriered'
+               WHEN medicines_handed_over = 1 THEN 'handed_over'
+               WHEN medicines_prepared = 1 THEN 'prepared'
+               ELSE 'open' END''',
+    ]
+
+
+def _update_sql(action, where):
+    sources, target, flag, guard, _ = TRANSITIONS[action]
+    return f'''UPDATE billing SET state = '{target}', {flag} = 1
+               WHERE {where} AND state IN ({', '.join(f"'{state}'" for state in sources)}) {guard}
+               RETURNING appointment_id, {_MOBILE}, {credit_sql('billing')}'''
+
+
+def _refusal(action, appointment_id, current, delivery_type):
+    # Why a transition did not apply; None when the bill is already there
+    sources, target, _, _, too_early = TRANSITIONS[action]
+    if current == target or _RANK[current] > _RANK[target]:
+        return None
+    if _RANK[current] < _RANK[sources[0]]:
+        return TransitionError(too_early)
+    if action == 'courier' and delivery_type != 'Courier':
+        return TransitionError('Delivery type is not Courier')
+    return TransitionError(f"Appointment {appointment_id} is already {current.replace('_', ' ')}", 409)
+
+
+def advance(conn, appointment_id, action):
+    # One guarded UPDATE in the caller's transaction. Returns (mobile, credit
+    # due) when this call moved the bill, None when it was already past the
+    # step (a repeated click); raises TransitionError otherwise.
+    c = conn.cursor()
+    c.execute(_update_sql(action, 'appointment_id = ?'), (appointment_id,))
+    row = c.fetchone()
+    if row:
+        return row[1], row[2]
+    # Only the failure path pays for a second look
+    c.execute('SELECT state, delivery_type FROM billing WHERE appointment_id = ?', (appointment_id,))
+    found = c.fetchone()
+    if found is None:
+        # Bills predating booking-time billing rows are created on first touch
+        if action != 'prepare':
+            raise TransitionError(TRANSITIONS[action][4])
+        c.execute('''INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge,
+                         delivery_type, medicines_prepared) VALUES (?, 0, 0, 0, 'In-Person', 0)''', (appointment_id,))
+        return advance(conn, appointment_id, action)
+    error = _refusal(action, appointment_id, *found)
+    if error:
+        raise error
+    return None
+
+
+def advance_many(conn, appointment_ids, action):
+    # Batch form of advance(): one UPDATE per chunk of ids. Returns
+    # ({id: (mobile, credit due)} for bills moved, {id: reason} for the rest);
+    # ids already past the step are reported as skipped, not as errors.
+    c = conn.cursor()
+    moved, skipped = {}, {}
+    for i in range(0, len(appointment_ids), BATCH_LIMIT):
+        chunk = appointment_ids[i:i + BATCH_LIMIT]
+        c.execute(_update_sql(action, f"appointment_id IN ({','.join('?' * len(chunk))})"), chunk)
+        for appointment_id, mobile, credit in c.fetchall():
+            moved[appointment_id] = (mobile, credit)
+        rest = [appointment_id for appointment_id in chunk if appointment_id not in moved]
+        if not rest:
+            continue
+        c.execute(f"SELECT appointment_id, state, delivery_type FROM billing WHERE appointment_id IN ({','.join('?' * len(rest))})",
+                  rest)
+        found = {appointment_id: (state, delivery_type) for appointment_id, state, delivery_type in c.fetchall()}
+        for appointment_id in rest:
+            if appointment_id not in found:
+                skipped[appointment_id] = 'No bill for this appointment'
+                continue
+            error = _refusal(action, appointment_id, *found[appointment_id])
+            skipped[appointment_id] = str(error) if error else f"Already {found[appointment_id][0].replace('_', ' ')}"
+    return moved, skipped
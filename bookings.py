@@ -0,0 +1,82 @@
+import sqlite3
+import uuid
+from datetime import datetime
+
+from notifications import enqueue_message
+from scheduling import PROVIDERS, slot_index
+
+BOOKING_FIELDS = ('name', 'mobile_number', 'age', 'address', 'reason', 'appointment_date', 'booking_type')
+
+
+class BookingError(ValueError):
+    pass
+
+
+def validate_booking(booking, now=None):
+    now = now or datetime.now()
+    today = now.date()
+    if not isinstance(booking, dict):
+        raise BookingError('Each booking must be an object')
+    missing = [field for field in BOOKING_FIELDS if field not in booking]
+    if missing:
+        raise BookingError(f"Missing booking fields: {', '.join(missing)}")
+    try:
+        appt_date = datetime.strptime(booking['appointment_date'], '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise BookingError('Invalid appointment date')
+    if appt_date == today and booking['booking_type'] == 'Online Direct':
+        raise BookingError('Same-day online bookings not allowed')
+    # Optional fixed slot; the unique slot index rejects double bookings on insert
+    if booking.get('slot_time'):
+        if slot_index(booking['slot_time']) is None:
+            raise BookingError(f"{booking['slot_time']} is not a bookable slot")
+        # A form's empty select and a JSON null both mean the default provider
+        booking['provider'] = booking.get('provider') or PROVIDERS[0]
+        if booking['provider'] not in PROVIDERS:
+            raise BookingError(f"Unknown provider {booking['provider']}")
+        if datetime.combine(appt_date, datetime.strptime(booking['slot_time'], '%H:%M').time()) <= now:
+            raise BookingError(f"{booking['appointment_date']} {booking['slot_time']} has already passed")
+
+
+def book_appointments(conn, bookings):
+    # Books every entry or none, in the caller's transaction (a WriteQueue
+    # command): patient upserts, appointments, billing rows and outbox
+    # messages. Returns the new appointment ids in input order.
+    now = datetime.now()
+    today = now.date()
+    for booking in bookings:
+        validate_booking(booking, now)
+    booking_date = today.strftime('%Y-%m-%d')
+    c = conn.cursor()
+    # One upsert per mobile number; the last booking's details win
+    patients = {booking['mobile_number']: booking for booking in bookings}
+    patient_ids = {}
+    for mobile, booking in patients.items():
+        c.execute('''INSERT INTO patients (patient_id, name, mobile_number, age, address) VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT(mobile_number) DO UPDATE
+                     SET name = excluded.name, age = excluded.age, address = excluded.address
+                     RETURNING patient_id''',
+                  (str(uuid.uuid4()), booking['name'], mobile, booking['age'], booking['address']))
+        patient_ids[mobile] = c.fetchone()[0]
+    appointment_ids = [str(uuid.uuid4()) for _ in bookings]
+    try:
+        c.executemany('''INSERT INTO appointments (id, patient_id, reason, booking_date, appointment_date, booking_type, confirmed, checkin_status, checkin_time, slot_time, provider)
+                         VALUES (?, ?, ?, ?, ?, ?, 0, '', '', ?, ?)''',
+                      [(appointment_id, patient_ids[booking['mobile_number']], booking['reason'], booking_date,
+                        booking['appointment_date'], booking['booking_type'], booking.get('slot_time') or None,
+                        booking.get('provider') if booking.get('slot_time') else None)
+                       for appointment_id, booking in zip(appointment_ids, bookings)])
+    except sqlite3.IntegrityError as e:
+        if 'appointments.provider' in str(e):
+            raise BookingError('That slot has just been booked; pick another')
+        raise
+    c.executemany('''INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared)
+                     VALUES (?, 0, 0, 0, 'In-Person', 0)''',
+                  [(appointment_id,) for appointment_id in appointment_ids])
+    for appointment_id, booking in zip(appointment_ids, bookings):
+        enqueue_message(conn, booking['mobile_number'], f"Appointment booked for {booking['appointment_date']}",
+                        f'{appointment_id}:booked')
+        if booking['booking_type'] != 'Manual In-Clinic':
+            enqueue_message(conn, booking['mobile_number'], "Appointment confirmation pending from clinic",
+                            f'{appointment_id}:confirmation_pending')
+    return appointment_ids
@@ -0,0 +1,170 @@
+import os
+import sqlite3
+from datetime import date, datetime, timedelta
+
+from flask import request, url_for
+
+DEFAULT_WINDOW_DAYS = int(os.getenv('DASHBOARD_WINDOW_DAYS', '7'))
+MAX_WINDOW_DAYS = int(os.getenv('DASHBOARD_MAX_WINDOW_DAYS', '90'))
+DEFAULT_PAGE_SIZE = int(os.getenv('DASHBOARD_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = int(os.getenv('DASHBOARD_MAX_PAGE_SIZE', '200'))
+
+# Every column a dashboard row or API projection can select, by result name
+APPOINTMENT_COLUMNS = {
+    'id': 'a.id', 'patient_id': 'a.patient_id', 'reason': 'a.reason', 'booking_date': 'a.booking_date',
+    'appointment_date': 'a.appointment_date', 'booking_type': 'a.booking_type', 'confirmed': 'a.confirmed',
+    'checkin_status': 'a.checkin_status', 'checkin_time': 'a.checkin_time', 'slot_time': 'a.slot_time',
+    'provider': 'a.provider',
+    'name': 'p.name', 'mobile_number': 'p.mobile_number', 'age': 'p.age', 'address': 'p.address',
+    'chief_complaints': 'd.chief_complaints', 'symptoms': 'd.symptoms', 'mind': 'd.mind', 'psychology': 'd.psychology',
+    'diagnosis': 'd.diagnosis', 'medicines': 'd.medicines', 'tests': 'd.tests', 'next_visit': 'd.next_visit',
+    'diagnosis_saved': 'd.diagnosis_saved', 'medicines_prescribed': 'd.medicines_prescribed',
+    'consultation_charge': 'b.consultation_charge', 'medicine_charge': 'b.medicine_charge',
+    'courier_charge': 'b.courier_charge', 'delivery_type': 'b.delivery_type', 'delivered_to': 'b.delivered_to',
+    'courier_channel': 'b.courier_channel', 'courier_tracking': 'b.courier_tracking', 'amount_paid': 'b.amount_paid',
+    'payment_date': 'b.payment_date', 'payment_id': 'b.payment_id', 'discount': 'b.discount',
+    'medicines_prepared': 'b.medicines_prepared', 'medicines_handed_over': 'b.medicines_handed_over',
+    'couriered': 'b.couriered', 'checkout_done': 'b.checkout_done',
+}
+
+DASHBOARD_COLUMNS = list(APPOINTMENT_COLUMNS)
+
+APPOINTMENT_FROM = '''FROM {schema}appointments a
+                 JOIN patients p ON a.patient_id = p.patient_id
+                 LEFT JOIN {schema}diagnoses d ON a.id = d.appointment_id
+                 LEFT JOIN {schema}billing b ON a.id = b.appointment_id'''
+
+
+def select_sql(columns, schema=None):
+    # Paging needs id and appointment_date in every projection. schema reads the
+    # visits of an attached archive instead (see archive.py); patients are always live.
+    return ('SELECT ' + ', '.join(f'{APPOINTMENT_COLUMNS[column]} AS {column}' for column in columns) + '\n'
+            + APPOINTMENT_FROM.format(schema=f'{schema}.' if schema else ''))
+
+
+def _parse_int(value, default, low, high):
+    try:
+        return max(low, min(high, int(value)))
+    except (TypeError, ValueError):
+        return default
+
+
+def _parse_cursor(value):
+    # Cursors are "<appointment_date>|<appointment id>" taken from a boundary row
+    if not value or '|' not in value:
+        return None
+    appointment_date, appointment_id = value.split('|', 1)
+    return appointment_date, appointment_id
+
+
+def page_params(args):
+    try:
+        center = datetime.strptime(args.get('center', ''), '%Y-%m-%d').date()
+    except ValueError:
+        center = date.today()
+    days = _parse_int(args.get('days'), DEFAULT_WINDOW_DAYS, 0, MAX_WINDOW_DAYS)
+    return {
+        'center': center.isoformat(),
+        'days': days,
+        'start': (center - timedelta(days=days)).isoformat(),
+        'end': (center + timedelta(days=days)).isoformat(),
+        'limit': _parse_int(args.get('limit'), DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE),
+        'after': _parse_cursor(args.get('after')),
+        'before': _parse_cursor(args.get('before')),
+        'max_days': MAX_WINDOW_DAYS,
+    }
+
+
+def _page_sql(params, prescribed_only, columns=DASHBOARD_COLUMNS):
+    sql = select_sql(columns) + ' WHERE a.appointment_date BETWEEN ? AND ?'
+    args = [params['start'], params['end']]
+    if prescribed_only:
+        sql += ' AND d.medicines_prescribed = 1'
+    backwards = params['before'] is not None and params['after'] is None
+    if backwards:
+        sql += ' AND (a.appointment_date, a.id) < (?, ?) ORDER BY a.appointment_date DESC, a.id DESC'
+        args.extend(params['before'])
+    elif params['after'] is not None:
+        sql += ' AND (a.appointment_date, a.id) > (?, ?) ORDER BY a.appointment_date, a.id'
+        args.extend(params['after'])
+    else:
+        sql += ' ORDER BY a.appointment_date, a.id'
+    sql += ' LIMIT ?'
+    args.append(params['limit'] + 1)
+    return sql, args, backwards
+
+
+def fetch_page(conn, params, prescribed_only=False, columns=DASHBOARD_COLUMNS):
+    # Keyset pagination on (appointment_date, id) inside a bounded date window, so
+    # the cost of a page does not depend on how much history the clinic has
+    sql, args, backwards = _page_sql(params, prescribed_only, columns)
+    c = conn.cursor()
+    c.row_factory = sqlite3.Row
+    c.execute(sql, args)
+    rows = c.fetchall()
+    has_more = len(rows) > params['limit']
+    rows = rows[:params['limit']]
+    if backwards:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = params['after'] is not None, has_more
+    page = dict(params)
+    page['prev_cursor'] = _cursor(rows[0]) if rows and has_prev else None
+    page['next_cursor'] = _cursor(rows[-1]) if rows and has_next else None
+    page['prev_url'] = _page_url(params, before=page['prev_cursor']) if page['prev_cursor'] else None
+    page['next_url'] = _page_url(params, after=page['next_cursor']) if page['next_cursor'] else None
+    return rows, page
+
+
+def fetch_appointment(conn, appointment_id, columns=DASHBOARD_COLUMNS):
+    c = conn.cursor()
+    c.row_factory = sqlite3.Row
+    c.execute(select_sql(columns) + ' WHERE a.id = ?', (appointment_id,))
+    return c.fetchone()
+
+
+def _cursor(row):
+    return f"{row['appointment_date']}|{row['id']}"
+
+
+def _page_url(params, after=None, before=None):
+    query = {'center': params['center'], 'days': params['days'], 'limit': params['limit']}
+    if after is not None:
+        query['after'] = after
+    if before is not None:
+        query['before'] = before
+    return url_for(request.endpoint, **query)
+
+
+def explain_page_queries(conn):
+    # EXPLAIN QUERY PLAN for every statement shape fetch_page() can issue, with
+    # the indexes each shape is meant to be served from
+    cursor = ('2000-01-01', '')
+    shapes = {
+        'first page': {},
+        'next page': {'after': cursor},
+        'previous page': {'before': cursor},
+    }
+    plans = {}
+    for prescribed_only in (False, True):
+        for name, cursors in shapes.items():
+            params = {'start': '2000-01-01', 'end': '2000-01-15', 'limit': DEFAULT_PAGE_SIZE,
+                      'after': None, 'before': None}
+            params.update(cursors)
+            sql, args, _ = _page_sql(params, prescribed_only)
+            label = f"{'pharmacist' if prescribed_only else 'appointments'} {name}"
+            # Both dashboards walk the date window in keyset order
+            plans[label] = ([row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, args)],
+                            ['idx_appointments_date_id'])
+    return plans
+
+
+def plan_problems(details, expected=()):
+    # Full scans and sorts are what make a page cost grow with table size; an
+    # expected index the planner passed over is a slower plan or a dead index
+    problems = [detail for detail in details if detail.startswith('SCAN') or 'TEMP B-TREE' in detail]
+    for index in expected:
+        if not any(f'INDEX {index} ' in detail or detail.endswith(f'INDEX {index}') for detail in details):
+            problems.append(f'{index} not used')
+    return problems
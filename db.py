@@ -0,0 +1,96 @@
+import os
+import queue
+import sqlite3
+import threading
+
+from flask import g
+
+from metrics import TimedConnection
+
+BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '16384'))
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+
+
+def database_path():
+    return os.getenv('DATABASE_PATH', 'clinic.db')  # Default to 'clinic.db'
+
+
+def connect(path=None):
+    # Pooled connections may be handed to a different request thread, so the
+    # same-thread check is off; a connection is only ever used by one request at a time
+    # TimedConnection feeds every statement's duration to /metrics
+    conn = sqlite3.connect(path or database_path(), timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           factory=TimedConnection)
+    # WAL lets dashboard readers run alongside front-desk writers
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+class ConnectionPool:
+    # Per-process pool; a fork (Gunicorn worker boot) starts from an empty pool
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._path = database_path()
+        self._idle = queue.LifoQueue(maxsize=self.size)
+
+    def _check_owner(self):
+        if self._pid != os.getpid() or self._path != database_path():
+            with self._lock:
+                if self._pid != os.getpid() or self._path != database_path():
+                    self._reset()
+
+    def acquire(self):
+        self._check_owner()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self._path)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._pid != os.getpid() or self._path != database_path():
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+pool = ConnectionPool()
+
+
+def get_db():
+    if 'db' not in g:
+        g.db = pool.acquire()
+    return g.db
+
+
+def close_db(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
@@ -0,0 +1,167 @@
+import csv
+import io
+import re
+from datetime import date, datetime, timedelta
+from xml.sax.saxutils import escape
+
+from archive import MAX_ATTACHED, NOT_LIVE, archived_years, attach
+from dashboards import select_sql
+
+CHUNK_SIZE = 1000
+
+# Date-ranged downloads: the columns each one carries and the dates it can be
+# filtered on (the first is the default)
+DATASETS = {
+    'appointments': {
+        'columns': ['id', 'name', 'mobile_number', 'age', 'address', 'reason', 'booking_date', 'appointment_date',
+                    'slot_time', 'provider', 'booking_type', 'confirmed', 'checkin_status', 'checkin_time'],
+        'dates': {'appointment_date': 'a.appointment_date'},
+    },
+    'billing': {
+        'columns': ['id', 'name', 'mobile_number', 'appointment_date', 'consultation_charge', 'medicine_charge',
+                    'courier_charge', 'discount', 'amount_paid', 'payment_date', 'payment_id', 'delivery_type',
+                    'delivered_to', 'courier_channel', 'courier_tracking', 'medicines_prepared',
+                    'medicines_handed_over', 'couriered', 'checkout_done'],
+        'dates': {'payment_date': 'b.payment_date', 'appointment_date': 'a.appointment_date'},
+    },
+}
+
+
+class DownloadError(ValueError):
+    pass
+
+
+def _parse_date(value, name):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise DownloadError(f'{name} must be YYYY-MM-DD')
+
+
+def date_range(args):
+    # ?month=2025-03, or ?start=&end= (inclusive, either may be omitted).
+    # Returns (start, end, label) with ISO strings or None for an open end.
+    if args.get('month'):
+        try:
+            first = datetime.strptime(args['month'], '%Y-%m').date()
+        except ValueError:
+            raise DownloadError('month must be YYYY-MM')
+        last = (first.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        return first.isoformat(), last.isoformat(), args['month']
+    start = _parse_date(args['start'], 'start').isoformat() if args.get('start') else None
+    end = _parse_date(args['end'], 'end').isoformat() if args.get('end') else None
+    if start and end and start > end:
+        raise DownloadError('start is after end')
+    return start, end, f"{start or 'all'}_{end or date.today().isoformat()}"
+
+
+def download_query(dataset, args):
+    # Returns (sql, args, columns, label, archive years) for one dataset,
+    # filtered and ordered on an indexed date column so rows stream in index
+    # order without a sort. Archived years in the range are read too, through
+    # a UNION ALL that does need sorting, for stream_rows() to attach.
+    if dataset not in DATASETS:
+        raise DownloadError(f'Unknown dataset {dataset!r}')
+    spec = DATASETS[dataset]
+    by = args.get('by') or next(iter(spec['dates']))
+    if by not in spec['dates']:
+        raise DownloadError(f"{dataset} can be filtered by {', '.join(spec['dates'])}")
+    column = spec['dates'][by]
+    start, end, label = date_range(args)
+    conditions, params = [], []
+    if start:
+        conditions.append(f'{column} >= ?')
+        params.append(start)
+    if end:
+        # Dates may carry a time part, so compare against the next day
+        conditions.append(f'{column} < ?')
+        params.append((date.fromisoformat(end) + timedelta(days=1)).isoformat())
+    if not conditions:
+        conditions.append(f'{column} IS NOT NULL')
+    where = ' WHERE ' + ' AND '.join(conditions)
+    # Archives go by visit year; a bill can be paid the year after its visit
+    first = str(int(start[:4]) - (by != 'appointment_date')) if start else None
+    years = [year for year in archived_years() if (not first or year >= first) and (not end or year <= end[:4])]
+    if len(years) > MAX_ATTACHED:
+        raise DownloadError(f'The range covers {len(years)} archived years; at most {MAX_ATTACHED} per download')
+    label = f'{dataset}-{by}-{label}'
+    if not years:
+        return select_sql(spec['columns']) + where + f' ORDER BY {column}', params, spec['columns'], label, years
+    parts = [select_sql(spec['columns']) + where]
+    parts += [select_sql(spec['columns'], f'archive_{year}') + where + f' AND {NOT_LIVE}' for year in years]
+    return ' UNION ALL '.join(parts) + f' ORDER BY {by}', params * len(parts), spec['columns'], label, years
+
+
+def stream_rows(connect, sql, args, archive_years=(), chunk_size=CHUNK_SIZE):
+    # Batches of rows straight off the SQLite cursor, read from one snapshot on
+    # a connection of its own that lives exactly as long as the download
+    conn = connect()
+    try:
+        attach(conn, archive_years)
+        conn.execute('BEGIN')
+        c = conn.execute(sql, args)
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+# A text cell starting with one of these is run as a formula by spreadsheet
+# programs; patient-entered text gets a leading ' so it is shown as typed
+_FORMULA_START = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _defuse(value):
+    if isinstance(value, str) and value.startswith(_FORMULA_START):
+        return "'" + value
+    return value
+
+
+def stream_csv(columns, batches):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows([_defuse(value) for value in row] for row in rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+# Characters XML 1.0 cannot carry even escaped
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _cell(value):
+    if value is None:
+        return '<Cell/>'
+    if isinstance(value, (int, float)):
+        return f'<Cell><Data ss:Type="Number">{value}</Data></Cell>'
+    return f'<Cell><Data ss:Type="String">{escape(_XML_INVALID.sub("", str(_defuse(value))))}</Data></Cell>'
+
+
+def stream_spreadsheet(columns, batches, sheet='Export'):
+    # Excel 2003 XML spreadsheet: plain text Excel opens directly, so unlike
+    # .xlsx (a zip archive) it can be written row by row. Saved as .xml, since
+    # Excel warns that an .xls holding anything but the binary format is unsafe.
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<?mso-application progid="Excel.Sheet"?>\n'
+           '<Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet" '
+           'xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet">\n'
+           f'<Worksheet ss:Name="{escape(sheet[:31])}"><Table>\n'
+           '<Row>' + ''.join(_cell(column) for column in columns) + '</Row>\n')
+    for rows in batches:
+        yield ''.join('<Row>' + ''.join(_cell(value) for value in row) + '</Row>\n' for row in rows)
+    yield '</Table></Worksheet>\n</Workbook>\n'
+
+
+# format -> (writer, mimetype, file extension)
+FORMATS = {
+    'csv': (stream_csv, 'text/csv', 'csv'),
+    'excel': (stream_spreadsheet, 'application/vnd.ms-excel', 'xml'),
+}
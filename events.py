@@ -0,0 +1,151 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from background import BackgroundThread
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', '1.0'))
+# Each /events request is a short long-poll: it waits at most STREAM_SECONDS,
+# sends whatever changed and ends, and the browser reconnects RETRY_MS later
+# with Last-Event-ID. An open tab holds a request thread for a fraction of
+# the time instead of for minutes (see gunicorn.conf.py for the thread count).
+STREAM_SECONDS = float(os.getenv('EVENTS_STREAM_SECONDS', '2'))
+RETRY_MS = int(os.getenv('EVENTS_RETRY_MS', '3000'))
+BATCH_SIZE = 500
+BACKLOG = 256
+
+# change_log tables whose row_key is an appointment id
+_APPOINTMENT_KEYED = ('appointments', 'diagnoses', 'billing')
+
+
+def read_changes(conn, after, limit=BATCH_SIZE):
+    # Returns (last seq read, sorted appointment ids touched, whether the batch
+    # was full) for change_log entries after `after`; patient edits fan out to
+    # that patient's appointments
+    c = conn.cursor()
+    c.execute('SELECT seq, table_name, row_key FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?', (after, limit))
+    rows = c.fetchall()
+    ids = set()
+    patients = set()
+    for _, table, key in rows:
+        if table in _APPOINTMENT_KEYED:
+            ids.add(key)
+        elif table == 'patients':
+            patients.add(key)
+    for patient_id in patients:
+        c.execute('SELECT id FROM appointments WHERE patient_id = ?', (patient_id,))
+        ids.update(row[0] for row in c.fetchall())
+    return (rows[-1][0] if rows else after), sorted(ids), len(rows) == limit
+
+
+class ChangeFeed:
+    # One poller per process tails change_log, which every worker's writes
+    # land in, and fans the touched appointment ids out to SSE streams
+    def __init__(self, connect, interval=POLL_INTERVAL, backlog=BACKLOG):
+        self.connect = connect
+        self.interval = interval
+        self._events = collections.deque(maxlen=backlog)
+        self._last_seq = None
+        self._floor = None
+        self._changed = threading.Condition()
+        self._wake = threading.Event()
+        self._worker = BackgroundThread(self._run, 'change-feed', on_start=self._reset)
+
+    def _reset(self):
+        # What a forked worker inherited describes its parent's poller
+        self._events.clear()
+        self._last_seq = None
+        self._floor = None
+
+    def notify(self):
+        self._worker.ensure_started()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll_once()
+            except Exception:
+                logger.exception('Change feed poll failed')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def poll_once(self):
+        conn = self.connect()
+        try:
+            if self._last_seq is None:
+                c = conn.cursor()
+                c.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+                with self._changed:
+                    self._last_seq = self._floor = c.fetchone()[0]
+                    self._changed.notify_all()
+                return
+            more = True
+            while more:
+                last_seq, ids, more = read_changes(conn, self._last_seq)
+                if last_seq == self._last_seq:
+                    return
+                with self._changed:
+                    self._last_seq = last_seq
+                    if ids:
+                        if len(self._events) == self._events.maxlen:
+                            self._floor = self._events[0][0]
+                        self._events.append((last_seq, ids))
+                    self._changed.notify_all()
+        finally:
+            conn.close()
+
+    def _since(self, seq):
+        # Events after seq from the in-memory backlog, or None if older events
+        # have already been dropped from it
+        if seq < self._floor:
+            return None
+        return [event for event in self._events if event[0] > seq]
+
+    def _catch_up(self, seq):
+        # Read straight from change_log; None if the client is too far behind
+        conn = self.connect()
+        try:
+            last_seq, ids, more = read_changes(conn, seq, BATCH_SIZE * 4)
+        finally:
+            conn.close()
+        return None if more else (last_seq, ids)
+
+    def stream(self, last_event_id=None, timeout=STREAM_SECONDS):
+        # Server-Sent Events: an 'appointments' event per batch of changes whose
+        # data is the JSON array of touched appointment ids, or 'resync' when
+        # the client missed too much and should reload the page. Ends after the
+        # first delivery or after timeout, whichever is sooner.
+        self._worker.ensure_started()
+        deadline = time.monotonic() + timeout
+        yield f'retry: {RETRY_MS}\n\n'
+        with self._changed:
+            self._changed.wait_for(lambda: self._last_seq is not None, timeout)
+            seq = self._last_seq
+        if seq is None:
+            return
+        if last_event_id is not None and last_event_id < seq:
+            seq = last_event_id
+        # An id with no data sets the browser's Last-Event-ID without an event,
+        # so changes made while it is reconnecting are not lost
+        yield f'id: {seq}\n\n'
+        with self._changed:
+            self._changed.wait_for(lambda: self._last_seq > seq, max(0, deadline - time.monotonic()))
+            latest = self._last_seq
+            events = self._since(seq) if latest > seq else []
+        if events is None:
+            caught_up = self._catch_up(seq)
+            if caught_up is None:
+                yield f'id: {latest}\nevent: resync\ndata: {{}}\n\n'
+                return
+            events = [caught_up] if caught_up[1] else []
+            latest = caught_up[0]
+        for event_seq, ids in events:
+            yield f'id: {event_seq}\nevent: appointments\ndata: {json.dumps(ids)}\n\n'
+        if latest > seq and (not events or events[-1][0] < latest):
+            yield f'id: {latest}\n\n'
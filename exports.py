@@ -0,0 +1,192 @@
+import csv
+import fcntl
+import io
+import logging
+import os
+import threading
+import time
+
+from background import BackgroundThread
+from metrics import observe_export
+
+logger = logging.getLogger(__name__)
+
+# Tables mirrored to UPLOAD_FOLDER/<table>.csv and the column that identifies a row
+EXPORT_TABLES = {
+    'patients': 'patient_id',
+    'appointments': 'id',
+    'diagnoses': 'appointment_id',
+    'billing': 'appointment_id',
+}
+
+CHUNK_SIZE = 500
+# Updates and deletes can't be applied to a CSV in place, so they wait for the
+# next rewrite of the file, done once this many rows are waiting on one or the
+# oldest has waited this long; inserts are still appended as they come
+COMPACT_ROWS = int(os.getenv('EXPORT_COMPACT_ROWS', '1000'))
+COMPACT_SECONDS = int(os.getenv('EXPORT_COMPACT_SECONDS', '300'))
+
+
+def change_log_schema():
+    # Every write to an exported table leaves a row in change_log from inside the
+    # writing transaction, so the exporter never has to diff whole tables
+    statements = [
+        '''CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, row_key TEXT NOT NULL,
+            op TEXT NOT NULL, changed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_change_log_table_seq ON change_log (table_name, seq)',
+        '''CREATE TABLE IF NOT EXISTS export_state (
+            table_name TEXT PRIMARY KEY, last_seq INTEGER NOT NULL
+        )''',
+    ]
+    for table, key in EXPORT_TABLES.items():
+        for op, ref in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            statements.append(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_{op.lower()}_log AFTER {op} ON {table}
+                BEGIN
+                    INSERT INTO change_log (table_name, row_key, op) VALUES ('{table}', {ref}.{key}, '{op}');
+                END''')
+    return statements
+
+
+def export_cursor_schema():
+    # last_seq is how far a table's mirror is complete; appended_seq how far its
+    # inserts have been appended while updates and deletes wait for compaction
+    return ['ALTER TABLE export_state ADD COLUMN appended_seq INTEGER']
+
+
+class CsvExporter:
+    # Background worker that folds change_log entries into the CSV mirrors.
+    # Inserts are appended to the existing file; updates and deletes are left
+    # for a compaction that rewrites the file to a temp name and os.replace()s
+    # it, run once compact_rows rows are waiting or after compact_seconds.
+    def __init__(self, connect, export_folder, debounce=0.5, interval=30.0, retention=86400,
+                 compact_rows=COMPACT_ROWS, compact_seconds=COMPACT_SECONDS):
+        self.connect = connect
+        self.export_folder = export_folder
+        self.debounce = debounce
+        self.interval = interval
+        self.retention = retention
+        self.compact_rows = compact_rows
+        self.compact_seconds = compact_seconds
+        self._wake = threading.Event()
+        self._worker = BackgroundThread(self._run, 'csv-exporter')
+
+    def notify(self):
+        self._worker.ensure_started()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            time.sleep(self.debounce)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('CSV export failed')
+
+    def flush(self, compact=False):
+        # compact=True applies waiting updates and deletes now
+        os.makedirs(self.export_folder, exist_ok=True)
+        with open(os.path.join(self.export_folder, '.export.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            started = time.perf_counter()
+            conn = self.connect()
+            try:
+                for table, key in EXPORT_TABLES.items():
+                    self._flush_table(conn, table, key, compact)
+                self._prune(conn)
+            finally:
+                conn.close()
+                observe_export('csv_mirror', time.perf_counter() - started)
+
+    def _flush_table(self, conn, table, key, compact=False):
+        path = os.path.join(self.export_folder, f'{table}.csv')
+        # The cursor and the rows it covers are read from one snapshot
+        conn.execute('BEGIN')
+        try:
+            c = conn.cursor()
+            c.execute('SELECT last_seq, COALESCE(appended_seq, last_seq) FROM export_state WHERE table_name = ?',
+                      (table,))
+            state = c.fetchone()
+            if state is None or not os.path.exists(path) or compact or self._should_compact(conn, table, state[0]):
+                c.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+                last_seq = appended_seq = c.fetchone()[0]
+                self._compact(conn, table, path)
+            else:
+                last_seq, appended_seq = state
+                appended_seq = self._append(conn, table, key, path, appended_seq)
+                if appended_seq == state[1]:
+                    return
+        finally:
+            conn.rollback()
+        self._save_cursor(conn, table, last_seq, appended_seq)
+
+    def _should_compact(self, conn, table, last_seq):
+        # Walks idx_change_log_table_seq over just the entries not yet compacted
+        rows, overdue = conn.execute('''SELECT COUNT(DISTINCT row_key), MIN(changed_at) <= datetime('now', ?)
+                                        FROM change_log WHERE table_name = ? AND seq > ? AND op != 'INSERT' ''',
+                                     (f'-{int(self.compact_seconds)} seconds', table, last_seq)).fetchone()
+        return rows >= self.compact_rows or overdue == 1
+
+    def _save_cursor(self, conn, table, last_seq, appended_seq):
+        conn.execute('INSERT INTO export_state (table_name, last_seq, appended_seq) VALUES (?, ?, ?) '
+                     'ON CONFLICT(table_name) DO UPDATE SET last_seq = excluded.last_seq, '
+                     'appended_seq = excluded.appended_seq', (table, last_seq, appended_seq))
+        conn.commit()
+
+    def _compact(self, conn, table, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        c = conn.cursor()
+        c.execute(f'SELECT * FROM {table}')
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([col[0] for col in c.description])
+            while True:
+                rows = c.fetchmany(CHUNK_SIZE)
+                if not rows:
+                    break
+                writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _append(self, conn, table, key, path, appended_seq):
+        # Appends the rows inserted since appended_seq, CHUNK_SIZE change_log
+        # entries at a time, and returns the seq appended up to
+        changes = conn.cursor()
+        changes.execute("SELECT seq, row_key FROM change_log WHERE table_name = ? AND seq > ? AND op = 'INSERT' "
+                        'ORDER BY seq', (table, appended_seq))
+        c = conn.cursor()
+        fd = None
+        try:
+            while True:
+                chunk = changes.fetchmany(CHUNK_SIZE)
+                if not chunk:
+                    break
+                appended_seq = chunk[-1][0]
+                row_keys = list(dict.fromkeys(row_key for _, row_key in chunk))
+                c.execute(f'SELECT * FROM {table} WHERE {key} IN ({",".join("?" * len(row_keys))})', row_keys)
+                buf = io.StringIO()
+                csv.writer(buf).writerows(c.fetchall())
+                if fd is None:
+                    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+                # One O_APPEND write per chunk so readers never see half a row
+                os.write(fd, buf.getvalue().encode())
+            if fd is not None:
+                os.fsync(fd)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        return appended_seq
+
+    def _prune(self, conn):
+        c = conn.cursor()
+        c.execute('SELECT MIN(last_seq) FROM export_state')
+        low_water = c.fetchone()[0]
+        if low_water is None:
+            return
+        c.execute("DELETE FROM change_log WHERE seq <= ? AND changed_at < datetime('now', ?)",
+                  (low_water, f'-{int(self.retention)} seconds'))
+        conn.commit()
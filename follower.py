@@ -0,0 +1,75 @@
+import threading
+from datetime import date
+
+# Past this many unseen changes, rebuilding is cheaper than replaying them
+CATCH_UP_LIMIT = 5000
+
+
+class ChangeFollower:
+    # Base for per-process views of today's or future rows kept current by
+    # replaying change_log, so any worker sees every worker's writes. The view
+    # is rebuilt on first use, on a new day, when entries it never saw have
+    # been pruned, or when more than CATCH_UP_LIMIT are waiting; otherwise
+    # only the rows named by new entries of TABLES are re-read.
+    TABLES = ()
+
+    def __init__(self, connect):
+        self.connect = connect
+        self._lock = threading.Lock()
+        self._seq = None
+        self._built_for = None
+
+    def _load(self, conn):
+        # Replace the whole view from the database, as of self._built_for
+        raise NotImplementedError
+
+    def _reload(self, conn, row_keys):
+        # Bring these rows of the view up to date
+        raise NotImplementedError
+
+    def _rebuild(self, conn):
+        c = conn.cursor()
+        c.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+        seq = c.fetchone()[0]
+        self._built_for = date.today().isoformat()
+        self._load(conn)
+        self._seq = seq
+
+    def _catch_up(self, conn):
+        c = conn.cursor()
+        c.execute('SELECT MIN(seq) FROM change_log')
+        oldest = c.fetchone()[0]
+        if oldest is None:
+            # An empty log may have been pruned past us; AUTOINCREMENT's
+            # counter still says how far it got
+            c.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'change_log'")
+            oldest = c.fetchone()[0] + 1
+        if oldest > self._seq + 1:
+            # Entries we never saw have been pruned
+            self._rebuild(conn)
+            return
+        c.execute(f'''SELECT seq, row_key FROM change_log WHERE table_name IN ({','.join('?' * len(self.TABLES))})
+                      AND seq > ? ORDER BY seq LIMIT ?''', list(self.TABLES) + [self._seq, CATCH_UP_LIMIT + 1])
+        changes = c.fetchall()
+        if len(changes) > CATCH_UP_LIMIT:
+            self._rebuild(conn)
+            return
+        if not changes:
+            return
+        self._reload(conn, list({row_key for _, row_key in changes}))
+        self._seq = changes[-1][0]
+
+    def refresh(self, conn=None):
+        # Cheap when nothing changed: one lookup on change_log's primary key
+        # and one on its (table_name, seq) index
+        own = conn is None
+        conn = conn or self.connect()
+        try:
+            with self._lock:
+                if self._seq is None or self._built_for != date.today().isoformat():
+                    self._rebuild(conn)
+                else:
+                    self._catch_up(conn)
+        finally:
+            if own:
+                conn.close()
@@ -0,0 +1,80 @@
+import collections
+import hashlib
+import os
+import threading
+
+from flask import Response, request
+
+from metrics import registry
+
+CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', '64'))
+
+
+def data_version(conn):
+    # change_log's AUTOINCREMENT counter. Every write to patients, appointments,
+    # diagnoses or billing bumps it inside the writing transaction (through the
+    # change_log triggers), whichever route or worker made it, and pruning the
+    # log never winds it back. One row read, no join.
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    return row[0] if row else 0
+
+
+def templates_digest(app):
+    # Part of every ETag, so browsers revalidating after a deploy that changed
+    # a template get the new page rather than a 304
+    digest = hashlib.sha1()
+    for name in sorted(app.jinja_env.list_templates()):
+        source = app.jinja_env.loader.get_source(app.jinja_env, name)[0]
+        digest.update(f'{name}\0{source}\0'.encode())
+    return digest.hexdigest()
+
+
+class FragmentCache:
+    # LRU of rendered pages by key (template and page parameters), each kept
+    # with the data version it was rendered at and only served at that version.
+    # Per process; ETags depend only on key and version, so a page rendered by
+    # one Gunicorn worker is still a 304 when the next refresh lands on another.
+    def __init__(self, digest, size=CACHE_SIZE):
+        self.digest = digest
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def etag(self, key, version):
+        return hashlib.sha1(f'{self.digest}|{key!r}|{version}'.encode()).hexdigest()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, body):
+        with self._lock:
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+def cached_response(cache, key, version, render):
+    # A GET from a browser already holding this page at this version gets a
+    # bodiless 304; otherwise the body comes from the cache or from render().
+    # Read the version before the data render() reads, so a page is never
+    # filed under a version newer than what it shows.
+    etag = cache.etag(key, version)
+    if request.method == 'GET' and request.if_none_match.contains_weak(etag):
+        registry.inc('clinic_fragment_cache_total', (('result', 'not_modified'),))
+        response = Response(status=304)
+    else:
+        body = cache.get(key, version)
+        registry.inc('clinic_fragment_cache_total', (('result', 'miss' if body is None else 'hit'),))
+        if body is None:
+            body = render()
+            cache.put(key, version, body)
+        response = Response(body, mimetype='text/html')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,35 @@
+# Picked up automatically by `gunicorn app:app` when run from this directory.
+import os
+
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+# Request threads per worker. Their writes share the worker's group-commit
+# writer (writer.WriteQueue), which only batches what arrives concurrently.
+# Every open dashboard tab also polls /events, holding a thread for up to
+# EVENTS_STREAM_SECONDS (2) out of every 5 or so seconds; with the defaults,
+# about workers * threads * 5 / 2 = 20 open tabs
+# occupy every thread and other requests start to queue.
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+
+def on_starting(server):
+    # Migrate once in the master, before any worker forks; each worker's own
+    # init_db() then finds PRAGMA user_version current and does no DDL
+    from db import connect
+    from metrics import clear_snapshots
+    from migrations import migrate
+
+    conn = connect()
+    try:
+        applied = migrate(conn)
+    finally:
+        conn.close()
+    for version, description in applied:
+        server.log.info('Applied migration %s: %s', version, description)
+    clear_snapshots()
+
+
+def post_worker_init(worker):
+    # Threads do not survive the fork, so each worker starts its own once the app is loaded
+    from app import start_background_jobs
+
+    start_background_jobs()
@@ -0,0 +1,125 @@
+import collections
+import os
+import sqlite3
+
+from archive import NOT_LIVE, attach, detach
+from dashboards import APPOINTMENT_COLUMNS, select_sql
+from follower import ChangeFollower
+
+CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', '256'))
+
+PATIENT_FIELDS = ('patient_id', 'name', 'mobile_number', 'age', 'address')
+# One row per visit: the appointment with its diagnosis and billing
+HISTORY_COLUMNS = [column for column in APPOINTMENT_COLUMNS if column not in PATIENT_FIELDS]
+_DATE = HISTORY_COLUMNS.index('appointment_date')
+
+_HISTORY_SQL = select_sql(HISTORY_COLUMNS) + '''
+    WHERE a.patient_id = ? ORDER BY a.appointment_date DESC'''
+
+
+def load_history(conn, patient_id):
+    # Returns (patient dict, visit rows newest first) or None; the live visits
+    # come from one query walking idx_appointments_patient_date, archived ones
+    # from the years archived_visits lists for the patient
+    c = conn.cursor()
+    c.execute(f"SELECT {', '.join(PATIENT_FIELDS)} FROM patients WHERE patient_id = ?", (patient_id,))
+    patient = c.fetchone()
+    if patient is None:
+        return None
+    c.row_factory = sqlite3.Row
+    c.execute(_HISTORY_SQL, (patient_id,))
+    visits = [tuple(row) for row in c.fetchall()]
+    c.execute('SELECT year FROM archived_visits WHERE patient_id = ?', (patient_id,))
+    years = [year for (year,) in c.fetchall()]
+    if years:
+        visits += _archived_visits(conn, patient_id, years)
+        visits.sort(key=lambda visit: visit[_DATE] or '', reverse=True)
+    return dict(zip(PATIENT_FIELDS, patient)), visits
+
+
+def _archived_visits(conn, patient_id, years):
+    # One year file attached at a time, so any number of years fits
+    visits = []
+    for year in years:
+        aliases = attach(conn, [year])
+        try:
+            for alias in aliases:
+                rows = conn.execute(select_sql(HISTORY_COLUMNS, alias) + f' WHERE a.patient_id = ? AND {NOT_LIVE}',
+                                    (patient_id,)).fetchall()
+                visits += [tuple(row) for row in rows]
+        finally:
+            detach(conn, aliases)
+    return visits
+
+
+class HistoryCache(ChangeFollower):
+    # LRU of load_history() results by patient. The owning worker drops an
+    # entry as soon as it writes; other workers' writes are picked up from
+    # change_log before every lookup (see follower.ChangeFollower). Whenever
+    # the follower would rebuild (entries pruned unseen, a bulk import, a new
+    # day) the cache is just cleared.
+    TABLES = ('patients', 'appointments', 'diagnoses', 'billing')
+
+    def __init__(self, connect, size=CACHE_SIZE):
+        super().__init__(connect)
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._patients = {}
+
+    def _drop(self, patient_id):
+        entry = self._entries.pop(patient_id, None)
+        if entry:
+            for row in entry[1]:
+                self._patients.pop(row[0], None)
+
+    def invalidate(self, patient_id):
+        with self._lock:
+            self._drop(patient_id)
+
+    def invalidate_appointment(self, appointment_id):
+        with self._lock:
+            patient_id = self._patients.get(appointment_id)
+            if patient_id:
+                self._drop(patient_id)
+
+    def _load(self, conn):
+        self._entries.clear()
+        self._patients.clear()
+
+    def _reload(self, conn, row_keys):
+        # Keys are patient ids (patients) or appointment ids (the rest), both
+        # UUIDs. One not yet cached may be a new visit of a cached patient.
+        if not self._entries:
+            return
+        unknown = []
+        for key in row_keys:
+            if key in self._entries:
+                self._drop(key)
+            elif key in self._patients:
+                self._drop(self._patients[key])
+            else:
+                unknown.append(key)
+        c = conn.cursor()
+        for i in range(0, len(unknown), 500):
+            chunk = unknown[i:i + 500]
+            c.execute(f"SELECT DISTINCT patient_id FROM appointments WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            for (patient_id,) in c.fetchall():
+                self._drop(patient_id)
+
+    def get(self, conn, patient_id):
+        self.refresh(conn)
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is not None:
+                self._entries.move_to_end(patient_id)
+                return entry
+        entry = load_history(conn, patient_id)
+        if entry is None:
+            return None
+        with self._lock:
+            self._entries[patient_id] = entry
+            for row in entry[1]:
+                self._patients[row[0]] = patient_id
+            while len(self._entries) > self.size:
+                self._drop(next(iter(self._entries)))
+        return entry
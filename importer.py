@@ -0,0 +1,262 @@
+import csv
+import importlib.util
+import logging
+import os
+import re
+import threading
+import uuid
+from datetime import date, datetime
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '5000'))
+# Numbers are stored as national significant numbers; a leading trunk 0 or
+# this country code is stripped
+COUNTRY_CODE = os.getenv('IMPORT_COUNTRY_CODE', '91')
+SPREADSHEET_EXTENSIONS = ('.xlsx', '.xlsm')
+MOBILE_DIGITS = int(os.getenv('IMPORT_MOBILE_DIGITS', '10'))
+
+BOOKING_TYPES = ('Online Direct', 'Online Manual', 'Manual In-Clinic')
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y')
+
+# Header spellings seen in other clinic systems' exports
+HEADER_ALIASES = {
+    'patient_name': 'name', 'patient': 'name',
+    'mobile': 'mobile_number', 'phone': 'mobile_number', 'phone_number': 'mobile_number',
+    'date': 'appointment_date', 'visit_date': 'appointment_date',
+}
+
+
+def import_jobs_schema():
+    return [
+        '''CREATE TABLE IF NOT EXISTS import_jobs (
+            id TEXT PRIMARY KEY, source TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'running',
+            rows_read INTEGER NOT NULL DEFAULT 0, patients_added INTEGER NOT NULL DEFAULT 0,
+            appointments_added INTEGER NOT NULL DEFAULT 0, rejected INTEGER NOT NULL DEFAULT 0,
+            reject_file TEXT, error TEXT,
+            started_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP, finished_at TEXT
+        )''',
+    ]
+
+
+class RowError(ValueError):
+    pass
+
+
+def normalize_mobile(raw):
+    digits = re.sub(r'\D', '', str(raw or ''))
+    if len(digits) == MOBILE_DIGITS + len(COUNTRY_CODE) and digits.startswith(COUNTRY_CODE):
+        digits = digits[len(COUNTRY_CODE):]
+    elif len(digits) == MOBILE_DIGITS + 1 and digits.startswith('0'):
+        digits = digits[1:]
+    if len(digits) != MOBILE_DIGITS:
+        raise RowError(f'invalid mobile number {raw!r}')
+    return digits
+
+
+def _normalize_date(raw):
+    if isinstance(raw, (date, datetime)):
+        return raw.strftime('%Y-%m-%d')
+    raw = str(raw).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(raw, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise RowError(f'invalid appointment date {raw!r}')
+
+
+def normalize_row(row):
+    # Returns (patient tuple, appointment tuple or None); raises RowError
+    name = str(row.get('name') or '').strip()
+    if not name:
+        raise RowError('missing name')
+    mobile = normalize_mobile(row.get('mobile_number'))
+    age = row.get('age')
+    if age in (None, ''):
+        age = None
+    else:
+        try:
+            age = int(float(age))
+        except (TypeError, ValueError):
+            raise RowError(f'invalid age {age!r}')
+    address = str(row.get('address') or '').strip()
+    appointment = None
+    if row.get('appointment_date') not in (None, ''):
+        booking_type = str(row.get('booking_type') or 'Manual In-Clinic').strip()
+        if booking_type not in BOOKING_TYPES:
+            raise RowError(f'unknown booking type {booking_type!r}')
+        appointment_date = _normalize_date(row['appointment_date'])
+        reason = str(row.get('reason') or 'Consultation').strip()
+        appointment = (str(uuid.uuid4()), reason, appointment_date, booking_type, mobile)
+    return (str(uuid.uuid4()), name, mobile, age, address), appointment
+
+
+def _header(cells):
+    keys = [re.sub(r'\W+', '_', str(cell or '').strip().lower()).strip('_') for cell in cells]
+    return [HEADER_ALIASES.get(key, key) for key in keys]
+
+
+def _csv_rows(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        yield header
+        yield from reader
+
+
+def spreadsheets_supported():
+    # openpyxl is optional and not in requirements.txt; without it only CSV
+    # files can be imported, so callers turn spreadsheets away up front
+    return importlib.util.find_spec('openpyxl') is not None
+
+
+def _xlsx_rows(path):
+    try:
+        import openpyxl
+    except ImportError:
+        raise RuntimeError('Importing .xlsx files needs openpyxl (pip install openpyxl)')
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def read_rows(path):
+    # Streams (dict keyed by normalized header names, raw cells, raw header)
+    # for every non-blank row after the header
+    rows = _xlsx_rows(path) if path.lower().endswith(SPREADSHEET_EXTENSIONS) else _csv_rows(path)
+    header = next(rows, None)
+    if header is None:
+        return
+    raw_header = [str(cell or '') for cell in header]
+    header = _header(header)
+    for cells in rows:
+        cells = list(cells)
+        if not any(cell not in (None, '') for cell in cells):
+            continue
+        yield dict(zip(header, cells)), cells, raw_header
+
+
+_PATIENT_SQL = '''INSERT INTO patients (patient_id, name, mobile_number, age, address) VALUES (?, ?, ?, ?, ?)
+                  ON CONFLICT(mobile_number) DO NOTHING'''
+# Appointments already present for the same patient, date and reason are
+# skipped, so an interrupted or repeated import can simply be run again
+_APPOINTMENT_SQL = '''INSERT INTO appointments (id, patient_id, reason, booking_date, appointment_date, booking_type, confirmed, checkin_status, checkin_time)
+                      SELECT ?1, p.patient_id, ?2, ?6, ?3, ?4, 0, '', '' FROM patients p
+                      WHERE p.mobile_number = ?5 AND NOT EXISTS (
+                          SELECT 1 FROM appointments a
+                          WHERE a.patient_id = p.patient_id AND a.appointment_date = ?3 AND a.reason = ?2
+                      )'''
+_BILLING_SQL = '''INSERT OR IGNORE INTO billing (appointment_id, consultation_charge, medicine_charge, courier_charge, delivery_type, medicines_prepared)
+                  SELECT id, 0, 0, 0, 'In-Person', 0 FROM appointments WHERE id = ?'''
+
+
+def _load_chunk(conn, job_id, rows_read, patients, appointments, rejected):
+    # One transaction per chunk, progress included, so a crash loses at most
+    # the chunk in flight and rows_read says where to resume
+    booking_date = date.today().strftime('%Y-%m-%d')
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        c = conn.cursor()
+        c.executemany(_PATIENT_SQL, patients)
+        patients_added = c.rowcount
+        c.executemany(_APPOINTMENT_SQL, [appointment + (booking_date,) for appointment in appointments])
+        appointments_added = c.rowcount
+        c.executemany(_BILLING_SQL, [(appointment[0],) for appointment in appointments])
+        c.execute('''UPDATE import_jobs SET rows_read = ?, patients_added = patients_added + ?,
+                     appointments_added = appointments_added + ?, rejected = rejected + ? WHERE id = ?''',
+                  (rows_read, patients_added, appointments_added, rejected, job_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def create_job(conn, source, reject_file):
+    # In the caller's transaction
+    job_id = str(uuid.uuid4())
+    conn.execute('INSERT INTO import_jobs (id, source, reject_file) VALUES (?, ?, ?)', (job_id, source, reject_file))
+    return job_id
+
+
+def job_status(conn, job_id):
+    c = conn.cursor()
+    c.execute('''SELECT id, source, status, rows_read, patients_added, appointments_added, rejected, reject_file, error,
+                        started_at, finished_at FROM import_jobs WHERE id = ?''', (job_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in c.description], row))
+
+
+def run_import(conn, job_id, progress=None, chunk_size=CHUNK_SIZE):
+    # Streams the job's source file into the database chunk by chunk. Rows that
+    # fail validation go to the job's reject file with an 'error' column.
+    # Resumes after rows_read if the job was interrupted.
+    conn.execute("UPDATE import_jobs SET status = 'running', error = NULL, finished_at = NULL WHERE id = ?", (job_id,))
+    conn.commit()
+    job = job_status(conn, job_id)
+    skip = job['rows_read']
+    rows = read_rows(job['source'])
+    for _ in islice(rows, skip):
+        pass
+    rows_read = skip
+    with open(job['reject_file'], 'a', newline='') as reject_file:
+        reject_writer = csv.writer(reject_file)
+        try:
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                patients, appointments, rejects = [], [], []
+                for row, cells, header in chunk:
+                    try:
+                        patient, appointment = normalize_row(row)
+                    except RowError as e:
+                        rejects.append(cells + [str(e)])
+                        continue
+                    patients.append(patient)
+                    if appointment:
+                        appointments.append(appointment)
+                rows_read += len(chunk)
+                _load_chunk(conn, job_id, rows_read, patients, appointments, len(rejects))
+                # Written only once the chunk is committed, so a resumed job
+                # never repeats a reject
+                if rejects:
+                    if reject_file.tell() == 0:
+                        reject_writer.writerow(header + ['error'])
+                    reject_writer.writerows(rejects)
+                    reject_file.flush()
+                if progress:
+                    progress(job_status(conn, job_id))
+        except Exception as e:
+            conn.execute("UPDATE import_jobs SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                         (str(e), job_id))
+            conn.commit()
+            raise
+    conn.execute("UPDATE import_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+    conn.commit()
+    return job_status(conn, job_id)
+
+
+def start_import(connect, job_id, on_done=None):
+    # Upload route entry point: runs the job on a background thread with its
+    # own connection; callers poll job_status() for progress
+    def run():
+        conn = connect()
+        try:
+            run_import(conn, job_id)
+        except Exception:
+            logger.exception('Import %s failed', job_id)
+        finally:
+            conn.close()
+            if on_done:
+                on_done()
+    thread = threading.Thread(target=run, name=f'import-{job_id}', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,333 @@
+import cProfile
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+
+from flask import before_render_template, g, request, template_rendered
+
+logger = logging.getLogger(__name__)
+
+# A histogram's bucket layout is fixed per metric (BUCKETS, in seconds, unless
+# METRICS says otherwise), so snapshots from different workers sum bucket by bucket
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# Under Gunicorn each worker counts on its own. With METRICS_DIR set they also
+# write snapshots there and /metrics sums them, so any worker can answer a scrape.
+METRICS_DIR = os.getenv('METRICS_DIR')
+FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '5'))
+# Profiling is off unless PROFILE_TOKEN is set; a request carrying
+# 'X-Profile: <token>' is then run under cProfile and dumped to PROFILE_DIR
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+# If set, /metrics wants 'Authorization: Bearer <token>'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# name -> (type, help[, buckets if not BUCKETS])
+METRICS = {
+    'clinic_requests_total': ('counter', 'Requests by route, method and status.'),
+    'clinic_request_duration_seconds': ('histogram', 'Time to produce a response (streamed bodies excluded).'),
+    'clinic_sql_statements_total': ('counter', 'SQL statements executed, by route and statement kind.'),
+    'clinic_sql_seconds_total': ('counter', 'Time spent executing SQL statements, by route and statement kind.'),
+    'clinic_sql_duration_seconds': ('histogram', 'Time to execute one SQL statement, by statement kind.'),
+    'clinic_template_render_seconds': ('histogram', 'Time to render a template, by template.'),
+    'clinic_export_seconds': ('histogram', 'Time to produce an export, by kind.'),
+    'clinic_write_batch_size': ('histogram', 'Commands committed together by the group-commit writer.', SIZE_BUCKETS),
+    'clinic_write_queue_wait_seconds': ('histogram', 'Time a write command waited for its batch to start.'),
+    'clinic_write_transaction_seconds': ('histogram', 'Time from BEGIN to COMMIT of a write batch, retries included.'),
+    'clinic_write_busy_retries_total': ('counter', 'Write batches retried after SQLITE_BUSY.'),
+    'clinic_fragment_cache_total': ('counter', 'Dashboard pages by outcome: not_modified (304), hit or miss.'),
+}
+
+SQL_KINDS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA'}
+BACKGROUND = 'background'
+
+
+def _buckets(name):
+    spec = METRICS.get(name, ())
+    return spec[2] if len(spec) > 2 else BUCKETS
+
+
+class Registry:
+    # Counters and histograms keyed by (name, label pairs)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        self.observe_many(name, labels, (value,))
+
+    def observe_many(self, name, labels, values):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            buckets = _buckets(name)
+            if histogram is None:
+                # One count per bucket plus +Inf, then the sum
+                histogram = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            for value in values:
+                histogram[bisect_left(buckets, value)] += 1
+                histogram[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, labels, list(histogram)] for (name, labels), histogram in self._histograms.items()],
+            }
+
+
+registry = Registry()
+_local = threading.local()
+
+
+def _labels(**labels):
+    return tuple(labels.items())
+
+
+def record_sql(sql, seconds):
+    kind = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    kind = kind if kind in SQL_KINDS else 'OTHER'
+    pending = getattr(_local, 'sql', None)
+    if pending is not None:
+        # Inside a request: folded into the registry once, when it ends
+        pending.append((kind, seconds))
+        return
+    registry.inc('clinic_sql_statements_total', _labels(route=BACKGROUND, kind=kind))
+    registry.inc('clinic_sql_seconds_total', _labels(route=BACKGROUND, kind=kind), seconds)
+    registry.observe('clinic_sql_duration_seconds', _labels(kind=kind), seconds)
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Times the statement up to its first row; rows fetched later are not counted
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+
+    def executescript(self, script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            record_sql(script, time.perf_counter() - started)
+
+
+class TimedConnection(sqlite3.Connection):
+    # sqlite3.connect(factory=TimedConnection). The execute shortcuts are
+    # routed through cursor() since the C implementation bypasses it.
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+
+def observe_export(kind, seconds):
+    registry.observe('clinic_export_seconds', _labels(kind=kind), seconds)
+
+
+def timed_export(kind, chunks):
+    # Wraps a streamed body; observed when the last chunk has been sent
+    started = time.perf_counter()
+    try:
+        yield from chunks
+    finally:
+        observe_export(kind, time.perf_counter() - started)
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    _local.sql = []
+    if PROFILE_TOKEN and request.headers.get('X-Profile') == PROFILE_TOKEN:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def _after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = _route()
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', request.endpoint or 'unmatched')
+        path = os.path.join(PROFILE_DIR, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{name}.prof')
+        profiler.dump_stats(path)
+        response.headers['X-Profile-File'] = path
+    registry.inc('clinic_requests_total', _labels(route=route, method=request.method, status=str(response.status_code)))
+    registry.observe('clinic_request_duration_seconds', _labels(route=route, method=request.method), elapsed)
+    sql = _local.sql or []
+    _local.sql = None
+    by_kind = {}
+    for kind, seconds in sql:
+        by_kind.setdefault(kind, []).append(seconds)
+    for kind, durations in by_kind.items():
+        registry.inc('clinic_sql_statements_total', _labels(route=route, kind=kind), len(durations))
+        registry.inc('clinic_sql_seconds_total', _labels(route=route, kind=kind), sum(durations))
+        registry.observe_many('clinic_sql_duration_seconds', _labels(kind=kind), durations)
+    # Shows up in the browser's network panel without scraping anything
+    sql_ms = sum(seconds for _, seconds in sql) * 1000
+    response.headers['Server-Timing'] = (f'app;dur={elapsed * 1000:.1f}, '
+                                         f'sql;dur={sql_ms:.1f};desc="{len(sql)} statements"')
+    _maybe_flush()
+    return response
+
+
+def _teardown_request(exc=None):
+    _local.sql = None
+
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if starts:
+        registry.observe('clinic_template_render_seconds', _labels(template=template.name or 'string'),
+                         time.perf_counter() - starts.pop())
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_rendered, app)
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f'{pid}.json')
+
+
+def _write_snapshot():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _snapshot_path(os.getpid())
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(f'{path}.tmp', path)
+
+
+_flush_lock = threading.Lock()
+_flushed_at = 0.0
+
+
+def _maybe_flush():
+    global _flushed_at
+    if not METRICS_DIR or time.monotonic() - _flushed_at < FLUSH_SECONDS:
+        return
+    with _flush_lock:
+        if time.monotonic() - _flushed_at < FLUSH_SECONDS:
+            return
+        _flushed_at = time.monotonic()
+        try:
+            _write_snapshot()
+        except OSError:
+            logger.exception('Could not write metrics snapshot')
+
+
+def clear_snapshots():
+    # Called by the Gunicorn master at startup so counts restart with the server
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            os.remove(path)
+
+
+def _snapshots():
+    if not METRICS_DIR:
+        return [registry.snapshot()]
+    _write_snapshot()
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, labels, extra=()):
+    pairs = [(key, value) for key, value in labels] + list(extra)
+    if not pairs:
+        return name
+    return name + '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _number(value):
+    # Every digit: counters run past the six significant figures of :g long
+    # before a restart, and rate() over a rounded counter reads as zero
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def render():
+    # Prometheus text exposition format, summed across worker snapshots
+    counters, histograms = {}, {}
+    for snapshot in _snapshots():
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+    lines = []
+    for name, (kind, help_text, *_) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append(f'{_series(name, labels)} {_number(value)}')
+            continue
+        for (series, labels), values in sorted(histograms.items()):
+            if series != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(_buckets(name) + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{_series(name + "_bucket", labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{_series(name + "_sum", labels)} {_number(values[-1])}')
+            lines.append(f'{_series(name + "_count", labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,109 @@
+from archive import archive_schema
+from auth import users_schema
+from billing import billing_state_schema
+from exports import change_log_schema, export_cursor_schema
+from importer import import_jobs_schema
+from notifications import outbox_schema
+from patient_queue import patient_queue_schema
+from pharmacy import pharmacy_schema
+from reporting import reporting_schema
+from scheduling import scheduling_schema
+from search import patient_search_schema, search_columns_schema, search_schema
+
+# Ordered (version, description, steps) entries. A step is either an SQL string
+# or a callable taking the connection; each version is applied in its own
+# transaction and recorded in PRAGMA user_version. Never edit a shipped
+# migration, append a new one instead.
+MIGRATIONS = [
+    (1, 'baseline schema', [
+        '''CREATE TABLE IF NOT EXISTS patients (
+            patient_id TEXT PRIMARY KEY, name TEXT, mobile_number TEXT UNIQUE, age INTEGER, address TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS appointments (
+            id TEXT PRIMARY KEY, patient_id TEXT, reason TEXT, booking_date TEXT, appointment_date TEXT,
+            booking_type TEXT, confirmed INTEGER, checkin_status TEXT, checkin_time TEXT,
+            FOREIGN KEY (patient_id) REFERENCES patients (patient_id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS diagnoses (
+            appointment_id TEXT PRIMARY KEY, chief_complaints TEXT, symptoms TEXT, mind TEXT, psychology TEXT,
+            diagnosis TEXT, medicines TEXT, tests TEXT, next_visit TEXT, diagnosis_saved INTEGER,
+            medicines_prescribed INTEGER,
+            FOREIGN KEY (appointment_id) REFERENCES appointments (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS billing (
+            appointment_id TEXT PRIMARY KEY, consultation_charge REAL, medicine_charge REAL, courier_charge REAL,
+            delivery_type TEXT, delivered_to TEXT, courier_channel TEXT, courier_tracking TEXT,
+            amount_paid REAL, payment_date TEXT, payment_id TEXT, discount REAL,
+            medicines_prepared INTEGER, medicines_handed_over INTEGER, couriered INTEGER, checkout_done INTEGER,
+            FOREIGN KEY (appointment_id) REFERENCES appointments (id)
+        )''',
+    ]),
+    (2, 'change log for CSV export', change_log_schema()),
+    (3, 'indexes for dashboard and workflow lookups', [
+        # Dashboard date window and keyset order
+        'CREATE INDEX IF NOT EXISTS idx_appointments_date_id ON appointments (appointment_date, id)',
+        # Per-patient history
+        'CREATE INDEX IF NOT EXISTS idx_appointments_patient_date ON appointments (patient_id, appointment_date)',
+        # Checked-in patients only; most appointments are never in this index for long
+        "CREATE INDEX IF NOT EXISTS idx_appointments_checked_in ON appointments (appointment_date, checkin_time) "
+        "WHERE checkin_status != ''",
+        # Pharmacist work list
+        'CREATE INDEX IF NOT EXISTS idx_diagnoses_prescribed ON diagnoses (appointment_id) WHERE medicines_prescribed = 1',
+        # Bills still moving through preparation, hand-over and checkout
+        'CREATE INDEX IF NOT EXISTS idx_billing_open ON billing (medicines_prepared, medicines_handed_over, couriered) '
+        'WHERE checkout_done IS NOT 1',
+        'CREATE INDEX IF NOT EXISTS idx_billing_payment_date ON billing (payment_date)',
+    ]),
+    (4, 'full-text search index', search_schema()),
+    (5, 'users table with salted password hashes', users_schema()),
+    (6, 'notification outbox', outbox_schema()),
+    (7, 'bulk import jobs', import_jobs_schema()),
+    (8, 'daily billing and patient credit summaries', reporting_schema()),
+    (9, 'appointment slots per provider', scheduling_schema()),
+    (10, 'prescription line items and pharmacy inventory', pharmacy_schema()),
+    (11, 'billing workflow state', billing_state_schema()),
+    (12, 'archived visit index and maintenance runs', archive_schema()),
+    (13, 'queue priority and diagnosis save time', patient_queue_schema()),
+    (14, 'search documents for patients without visits', patient_search_schema()),
+    (15, 'CSV export append cursor', export_cursor_schema()),
+    (16, 'drop unused workflow indexes', [
+        # The pharmacist's page reaches diagnoses by primary key from the date
+        # window, which the planner prefers without ANALYZE statistics anyway
+        'DROP INDEX IF EXISTS idx_diagnoses_prescribed',
+        # No query filters on open bills; billing is read by appointment_id or payment_date
+        'DROP INDEX IF EXISTS idx_billing_open',
+    ]),
+    (17, 'search index without reason terms, newest first', search_columns_schema()),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    # Cheap when up to date: a single pragma read
+    if current_version(conn) >= LATEST_VERSION:
+        return []
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-read under the write lock; another worker may have got here first
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append((version, description))
+    return applied
@@ -0,0 +1,160 @@
+import importlib
+import logging
+import os
+import random
+import threading
+import time
+
+from background import BackgroundThread
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.getenv('NOTIFY_BATCH_SIZE', '50'))
+RATE_PER_SECOND = float(os.getenv('NOTIFY_RATE_PER_SECOND', '5'))
+MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', '8'))
+BASE_BACKOFF = float(os.getenv('NOTIFY_BASE_BACKOFF', '2'))
+MAX_BACKOFF = float(os.getenv('NOTIFY_MAX_BACKOFF', '3600'))
+# A claimed message is invisible to other dispatchers for this long; if the
+# process dies mid-send it becomes claimable again afterwards
+LEASE_SECONDS = 60
+SENT_RETENTION_DAYS = 30
+
+
+def outbox_schema():
+    return [
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, dedup_key TEXT UNIQUE, mobile TEXT NOT NULL, message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL, last_error TEXT,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP, sent_at TEXT
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending'",
+    ]
+
+
+def enqueue_message(conn, mobile, message, dedup_key=None):
+    # Runs inside the caller's transaction, so the message exists if and only
+    # if the change it announces was committed. A repeated dedup_key is ignored.
+    conn.execute('INSERT OR IGNORE INTO outbox (dedup_key, mobile, message, next_attempt_at) VALUES (?, ?, ?, ?)',
+                 (dedup_key, mobile, message, time.time()))
+
+
+class ConsoleTransport:
+    def send(self, mobile, message):
+        print(f"Sending WhatsApp to {mobile}: {message}")
+
+
+class FakeTransport:
+    # Records deliveries in memory; set fail_next to make the next N sends raise
+    def __init__(self):
+        self.sent = []
+        self.fail_next = 0
+
+    def send(self, mobile, message):
+        if self.fail_next:
+            self.fail_next -= 1
+            raise RuntimeError('simulated gateway failure')
+        self.sent.append((mobile, message))
+
+
+TRANSPORTS = {'console': ConsoleTransport, 'fake': FakeTransport}
+
+
+def load_transport(name):
+    # A registered name, or 'package.module:ClassName' for a real gateway client
+    if name in TRANSPORTS:
+        return TRANSPORTS[name]()
+    module_name, _, class_name = name.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class NotificationDispatcher:
+    # Background sender draining the outbox in batches, with a token-bucket
+    # rate limit and exponential backoff between attempts
+    def __init__(self, connect, transport, batch_size=BATCH_SIZE, rate_per_second=RATE_PER_SECOND,
+                 max_attempts=MAX_ATTEMPTS, interval=5.0):
+        self.connect = connect
+        self.transport = transport
+        self.batch_size = batch_size
+        self.rate_per_second = rate_per_second
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self._tokens = rate_per_second
+        self._refilled_at = time.monotonic()
+        self._pruned_at = 0.0
+        self._wake = threading.Event()
+        self._worker = BackgroundThread(self._run, 'notification-dispatcher')
+
+    def ensure_started(self):
+        # Started with each worker (see gunicorn.conf.py), so messages left in
+        # the outbox by a restart go out without waiting for the next write
+        self._worker.ensure_started()
+
+    def notify(self):
+        self._worker.ensure_started()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                while self.dispatch_once() == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception('Notification dispatch failed')
+
+    def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.rate_per_second, self._tokens + (now - self._refilled_at) * self.rate_per_second)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self.rate_per_second)
+
+    def _backoff(self, attempts):
+        delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    def dispatch_once(self):
+        # Claim a batch, send it, then record every outcome in one transaction.
+        # Returns the number of messages claimed.
+        conn = self.connect()
+        try:
+            now = time.time()
+            c = conn.cursor()
+            c.execute('''UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?
+                         WHERE id IN (SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?
+                                      ORDER BY next_attempt_at LIMIT ?)
+                         RETURNING id, mobile, message, attempts''',
+                      (now + LEASE_SECONDS, now, self.batch_size))
+            batch = c.fetchall()
+            conn.commit()
+            if not batch:
+                return 0
+            sent, retries, failed = [], [], []
+            for message_id, mobile, message, attempts in batch:
+                self._take_token()
+                try:
+                    self.transport.send(mobile, message)
+                    sent.append((message_id,))
+                except Exception as exc:
+                    logger.warning('Sending notification %s failed (attempt %s): %s', message_id, attempts, exc)
+                    if attempts >= self.max_attempts:
+                        failed.append((str(exc), message_id))
+                    else:
+                        retries.append((time.time() + self._backoff(attempts), str(exc), message_id))
+            c.executemany("UPDATE outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL WHERE id = ?",
+                          sent)
+            c.executemany('UPDATE outbox SET next_attempt_at = ?, last_error = ? WHERE id = ?', retries)
+            c.executemany("UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?", failed)
+            if now - self._pruned_at > 3600:
+                c.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < datetime('now', ?)",
+                          (f'-{SENT_RETENTION_DAYS} days',))
+                self._pruned_at = now
+            conn.commit()
+            return len(batch)
+        finally:
+            conn.close()
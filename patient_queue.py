@@ -0,0 +1,159 @@
+import collections
+import heapq
+import os
+from datetime import datetime
+
+from follower import ChangeFollower
+from scheduling import SLOT_MINUTES
+
+# Booked patients go ahead of walk-ins who checked in at the same moment
+BOOKING_RANK = {'Online Direct': 0, 'Online Manual': 1, 'Manual In-Clinic': 2}
+# Consult length is averaged over the day's last ROLLING_CONSULTS diagnoses;
+# until the first one is saved, a slot's length stands in
+ROLLING_CONSULTS = int(os.getenv('QUEUE_ROLLING_CONSULTS', '10'))
+# Longer gaps between check-in or the previous save and a save are breaks, not consults
+MAX_CONSULT_SECONDS = 2 * 60 * 60
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_QUEUE_SELECT = '''SELECT a.id, a.checkin_time, a.priority, a.booking_type, p.name, a.appointment_date, a.checkin_status,
+                          d.diagnosis_saved, d.saved_at
+                   FROM appointments a JOIN patients p ON a.patient_id = p.patient_id
+                   LEFT JOIN diagnoses d ON a.id = d.appointment_id'''
+
+
+def patient_queue_schema():
+    return [
+        # Higher is seen sooner; set at check-in or later from the queue
+        'ALTER TABLE appointments ADD COLUMN priority INTEGER NOT NULL DEFAULT 0',
+        # When the diagnosis was first saved, i.e. the consult ended
+        'ALTER TABLE diagnoses ADD COLUMN saved_at TEXT',
+    ]
+
+
+def _parse(value):
+    try:
+        return datetime.strptime(value, TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+class PatientQueue(ChangeFollower):
+    # Today's checked-in patients still waiting for a saved diagnosis, in a
+    # heap keyed (-priority, check-in time, booking rank, id). Entries are
+    # never removed from the heap in place: a patient seen or re-prioritised
+    # just has their key in _waiting replaced, and stale tops are popped when
+    # next() meets them, so next() is O(log n) amortised. Kept current from
+    # change_log (see follower.ChangeFollower), so every worker's check-ins
+    # and saves show up; a new day starts from a rebuild.
+    TABLES = ('appointments', 'diagnoses')
+
+    def __init__(self, connect, window=ROLLING_CONSULTS):
+        super().__init__(connect)
+        self.window = window
+        self._heap = []
+        self._waiting = {}
+        self._durations = collections.deque(maxlen=window)
+        self._seen = set()
+        self._last_saved = None
+
+    def _load(self, conn):
+        c = conn.cursor()
+        self._heap = []
+        self._waiting = {}
+        self._durations.clear()
+        self._seen = set()
+        self._last_saved = None
+        # Walks idx_appointments_checked_in; diagnoses and patients by primary key
+        c.execute(_QUEUE_SELECT + " WHERE a.appointment_date = ? AND a.checkin_status != '' ORDER BY d.saved_at",
+                  (self._built_for,))
+        for row in c.fetchall():
+            self._apply(*row)
+
+    def _apply(self, appointment_id, checkin_time, priority, booking_type, name, day, status, saved, saved_at):
+        if day != self._built_for or not status:
+            self._remove(appointment_id)
+        elif saved == 1:
+            self._remove(appointment_id)
+            if appointment_id not in self._seen:
+                self._seen.add(appointment_id)
+                self._record(checkin_time, saved_at)
+        else:
+            key = (-(priority or 0), checkin_time or '', BOOKING_RANK.get(booking_type, len(BOOKING_RANK)), appointment_id)
+            entry = self._waiting.get(appointment_id)
+            if entry is None or entry[0] != key:
+                self._waiting[appointment_id] = (key, name, booking_type, priority or 0, checkin_time)
+                heapq.heappush(self._heap, key)
+
+    def _remove(self, appointment_id):
+        self._waiting.pop(appointment_id, None)
+
+    def _record(self, checkin_time, saved_at):
+        # A consult starts when the patient is in and the previous one is over
+        saved = _parse(saved_at)
+        started = _parse(checkin_time)
+        if saved is None or started is None:
+            return
+        if self._last_saved is not None:
+            started = max(started, self._last_saved)
+            self._last_saved = max(self._last_saved, saved)
+        else:
+            self._last_saved = saved
+        seconds = (saved - started).total_seconds()
+        if 0 < seconds <= MAX_CONSULT_SECONDS:
+            self._durations.append(seconds)
+
+    def _reload(self, conn, ids):
+        # diagnoses rows are keyed by appointment id too
+        c = conn.cursor()
+        c.execute(_QUEUE_SELECT + f" WHERE a.id IN ({','.join('?' * len(ids))})", ids)
+        found = {row[0]: row for row in c.fetchall()}
+        for appointment_id in ids:
+            if appointment_id in found:
+                self._apply(*found[appointment_id])
+            else:
+                self._remove(appointment_id)
+
+    @property
+    def day(self):
+        return self._built_for
+
+    def average_consult(self):
+        # Seconds
+        with self._lock:
+            if not self._durations:
+                return SLOT_MINUTES * 60
+            return sum(self._durations) / len(self._durations)
+
+    def _entry(self, position, appointment_id, average):
+        _, name, booking_type, priority, checkin_time = self._waiting[appointment_id]
+        return {'position': position, 'appointment_id': appointment_id, 'name': name, 'priority': priority,
+                'booking_type': booking_type, 'checkin_time': checkin_time,
+                'estimated_wait_minutes': round(position * average / 60)}
+
+    def _is_current(self, key):
+        entry = self._waiting.get(key[-1])
+        return entry is not None and entry[0] == key
+
+    def next(self):
+        # The patient to see next, or None; stale heap tops are dropped on the way
+        average = self.average_consult()
+        with self._lock:
+            while self._heap and not self._is_current(self._heap[0]):
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None
+            return self._entry(0, self._heap[0][-1], average)
+
+    def snapshot(self):
+        # Everyone waiting, in the order they will be seen
+        average = self.average_consult()
+        with self._lock:
+            keys = sorted(entry[0] for entry in self._waiting.values())
+            # Drop the stale entries too once they outnumber the live ones
+            if len(self._heap) > 2 * len(keys) + 64:
+                self._heap = list(keys)
+            return [self._entry(position, key[-1], average) for position, key in enumerate(keys)]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._waiting)
@@ -0,0 +1,186 @@
+import re
+
+# Free-text prescriptions are split into one item per line (or ';'), each
+# written as "<medicine> [x <quantity>] [- <dosage>]", e.g. "Arnica 30 x 2 - twice daily".
+# The quantity's x and the dosage dash need a space before them, so names
+# such as "Rhus Tox 30", "Nux-vomica 30" or "Kali-phos 6x" stay whole.
+_ITEM = re.compile(r'^(?P<name>.+?)(?:\s+[x×*]\s*(?P<quantity>\d+))?(?:\s+-\s*(?P<dosage>.*))?$', re.IGNORECASE)
+
+
+class StockError(ValueError):
+    pass
+
+
+class PrescriptionError(ValueError):
+    pass
+
+
+class StockChangeError(ValueError):
+    pass
+
+
+def pharmacy_schema():
+    return [
+        '''CREATE TABLE IF NOT EXISTS medicines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE COLLATE NOCASE,
+            unit TEXT NOT NULL DEFAULT 'unit', stock INTEGER NOT NULL DEFAULT 0, reorder_level INTEGER NOT NULL DEFAULT 0
+        )''',
+        '''CREATE TABLE IF NOT EXISTS prescription_items (
+            appointment_id TEXT NOT NULL, line INTEGER NOT NULL, medicine_name TEXT NOT NULL,
+            medicine_id INTEGER, quantity INTEGER NOT NULL DEFAULT 1, dosage TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (appointment_id, line),
+            FOREIGN KEY (appointment_id) REFERENCES appointments (id),
+            FOREIGN KEY (medicine_id) REFERENCES medicines (id)
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_prescription_items_medicine ON prescription_items (medicine_id)',
+        'CREATE INDEX IF NOT EXISTS idx_medicines_low_stock ON medicines (stock) WHERE stock <= reorder_level',
+        _backfill_items,
+    ]
+
+
+def parse_items(text):
+    # Returns [(name, quantity, dosage)] from the doctor's free text
+    items = []
+    for entry in re.split(r'[\n;]+', text or ''):
+        entry = entry.strip(' \t\r,.')
+        if not entry:
+            continue
+        match = _ITEM.match(entry)
+        items.append((match['name'].strip(), int(match['quantity'] or 1), (match['dosage'] or '').strip()))
+    return items
+
+
+def check_items(raw):
+    # Returns [(name, quantity, dosage)] from the structured 'items' a client
+    # may send instead of free text: [{"name": ..., "quantity": n, "dosage": ...}]
+    if not isinstance(raw, list):
+        raise PrescriptionError('items must be a list')
+    items = []
+    for n, item in enumerate(raw, 1):
+        if not isinstance(item, dict) or not isinstance(item.get('name'), str) or not item['name'].strip():
+            raise PrescriptionError(f'Item {n} needs a name')
+        quantity = item.get('quantity')
+        if quantity is None:
+            quantity = 1
+        if _whole_number(quantity) is None or int(quantity) < 1:
+            raise PrescriptionError(f'Item {n}: quantity must be a positive whole number')
+        dosage = item.get('dosage') or ''
+        if not isinstance(dosage, str):
+            raise PrescriptionError(f'Item {n}: dosage must be text')
+        items.append((item['name'].strip(), int(quantity), dosage.strip()))
+    return items
+
+
+def _whole_number(value):
+    # An int or a string of digits, optionally negative, as an int; else None
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    text = str(value).strip()
+    return int(text) if re.fullmatch(r'-?\d+', text) else None
+
+
+def check_stock_change(data):
+    # Returns (name, delta, unit, reorder_level) for adjust_stock() from a
+    # stock API body: {"name": ..., "quantity": n, "unit": ..., "reorder_level": n}
+    if not isinstance(data, dict):
+        raise StockChangeError('Expected a JSON object')
+    name = data.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise StockChangeError('name is required')
+    delta = _whole_number(data.get('quantity'))
+    if delta is None:
+        raise StockChangeError('quantity must be a whole number')
+    unit = data.get('unit') or None
+    if unit is not None and not isinstance(unit, str):
+        raise StockChangeError('unit must be text')
+    reorder_level = data.get('reorder_level')
+    if reorder_level in (None, ''):
+        reorder_level = None
+    else:
+        reorder_level = _whole_number(reorder_level)
+        if reorder_level is None or reorder_level < 0:
+            raise StockChangeError('reorder_level must be a whole number, 0 or more')
+    return name.strip(), delta, unit, reorder_level
+
+
+def save_items(conn, appointment_id, items):
+    # Replaces the appointment's line items in the caller's transaction;
+    # names are matched to inventory case-insensitively, unknown ones are kept
+    # without a medicine_id and are not stock-tracked
+    conn.execute('DELETE FROM prescription_items WHERE appointment_id = ?', (appointment_id,))
+    conn.executemany('''INSERT INTO prescription_items (appointment_id, line, medicine_name, medicine_id, quantity, dosage)
+                        VALUES (?1, ?2, ?3, (SELECT id FROM medicines WHERE name = ?3), ?4, ?5)''',
+                     [(appointment_id, line, name, quantity, dosage)
+                      for line, (name, quantity, dosage) in enumerate(items, 1)])
+
+
+def _backfill_items(conn):
+    c = conn.cursor()
+    c.execute('SELECT appointment_id, medicines FROM diagnoses WHERE medicines_prescribed = 1')
+    for appointment_id, medicines in c.fetchall():
+        save_items(conn, appointment_id, parse_items(medicines))
+
+
+def take_stock(conn, appointment_id):
+    # Decrements inventory for the appointment's items in the caller's
+    # transaction; raises StockError naming every short medicine, in which
+    # case the caller must roll back
+    c = conn.cursor()
+    c.execute('''SELECT pi.medicine_id, m.name, SUM(pi.quantity), m.stock
+                 FROM prescription_items pi JOIN medicines m ON m.id = pi.medicine_id
+                 WHERE pi.appointment_id = ? GROUP BY pi.medicine_id''', (appointment_id,))
+    needed = c.fetchall()
+    short = []
+    for medicine_id, name, quantity, _ in needed:
+        c.execute('UPDATE medicines SET stock = stock - ? WHERE id = ? AND stock >= ?', (quantity, medicine_id, quantity))
+        if c.rowcount == 0:
+            short.append(name)
+    if short:
+        raise StockError(f"Not enough stock: {', '.join(short)}")
+
+
+def adjust_stock(conn, name, delta, unit=None, reorder_level=None):
+    # Adds a medicine on first sight; delta may be negative (write-offs)
+    c = conn.cursor()
+    c.execute('''INSERT INTO medicines (name, unit, stock, reorder_level) VALUES (?, COALESCE(?, 'unit'), ?, COALESCE(?, 0))
+                 ON CONFLICT(name) DO UPDATE SET stock = stock + excluded.stock,
+                     unit = COALESCE(?, unit), reorder_level = COALESCE(?, reorder_level)
+                 RETURNING id, stock''', (name, unit, delta, reorder_level, unit, reorder_level))
+    medicine_id, stock = c.fetchone()
+    if stock < 0:
+        raise StockError(f'Not enough stock: {name}')
+    # Link earlier prescriptions written before this medicine was stocked
+    c.execute('UPDATE prescription_items SET medicine_id = ? WHERE medicine_id IS NULL AND medicine_name = ? COLLATE NOCASE',
+              (medicine_id, name))
+    return stock
+
+
+PICK_LIST_COLUMNS = ['medicine', 'quantity', 'appointments', 'stock', 'unit']
+
+
+def pick_list(conn, day):
+    # Everything still to prepare for the day's appointments, one row per
+    # medicine, so the pharmacy can prepare in batches
+    c = conn.cursor()
+    c.execute('''SELECT COALESCE(m.name, pi.medicine_name) AS medicine, SUM(pi.quantity), COUNT(DISTINCT pi.appointment_id),
+                        m.stock, COALESCE(m.unit, '')
+                 FROM appointments a
+                 JOIN prescription_items pi ON pi.appointment_id = a.id
+                 LEFT JOIN billing b ON b.appointment_id = a.id
+                 LEFT JOIN medicines m ON m.id = pi.medicine_id
+                 WHERE a.appointment_date = ? AND b.medicines_prepared IS NOT 1
+                 GROUP BY COALESCE(pi.medicine_id, pi.medicine_name COLLATE NOCASE)
+                 ORDER BY medicine COLLATE NOCASE''', (day,))
+    return c.fetchall()
+
+
+STOCK_COLUMNS = ['name', 'unit', 'stock', 'reorder_level']
+
+
+def stock_levels(conn, low_only=False):
+    c = conn.cursor()
+    if low_only:
+        c.execute('SELECT name, unit, stock, reorder_level FROM medicines WHERE stock <= reorder_level ORDER BY stock')
+    else:
+        c.execute('SELECT name, unit, stock, reorder_level FROM medicines ORDER BY name')
+    return c.fetchall()
@@ -0,0 +1,143 @@
+from datetime import date, timedelta
+
+# Summary rows are maintained by triggers on billing, inside whichever
+# transaction writes the bill, so they can never drift from it and reports
+# read one row per day (or per patient) instead of scanning billing.
+#
+# A bill counts towards the day it was paid, or the day of the visit while it
+# is unpaid. Credit is what a checked-out bill still owes. Deleting a bill (as
+# the archiver does) leaves the summaries alone: they are history.
+
+DEFAULT_REPORT_DAYS = 30
+MAX_REPORT_DAYS = 366
+
+_DAY = ("substr(COALESCE(NULLIF({b}.payment_date, ''), "
+        "(SELECT appointment_date FROM {a} WHERE id = {b}.appointment_id)), 1, 10)")
+_PATIENT = '(SELECT patient_id FROM {a} WHERE id = {b}.appointment_id)'
+_CREDIT = '''CASE WHEN {b}.checkout_done = 1 THEN MAX(
+    COALESCE({b}.consultation_charge, 0) + COALESCE({b}.medicine_charge, 0) + COALESCE({b}.courier_charge, 0)
+    - COALESCE({b}.discount, 0) - COALESCE({b}.amount_paid, 0), 0) ELSE 0 END'''
+
+
+def _add_bill(b, sign):
+    # Upserts adding (sign=1) or removing (sign=-1) one bill's contribution
+    day, patient = _DAY.format(b=b, a='appointments'), _PATIENT.format(b=b, a='appointments')
+    credit = _CREDIT.format(b=b)
+    s = '' if sign > 0 else '-'
+    return f'''
+        INSERT INTO daily_billing_summary (day, bills, consultation, medicine, courier, discount, collected, credit)
+        SELECT {day}, {sign}, {s}COALESCE({b}.consultation_charge, 0), {s}COALESCE({b}.medicine_charge, 0),
+               {s}COALESCE({b}.courier_charge, 0), {s}COALESCE({b}.discount, 0), {s}COALESCE({b}.amount_paid, 0),
+               {s}({credit})
+        WHERE {day} IS NOT NULL
+        ON CONFLICT(day) DO UPDATE SET
+            bills = bills + excluded.bills, consultation = consultation + excluded.consultation,
+            medicine = medicine + excluded.medicine, courier = courier + excluded.courier,
+            discount = discount + excluded.discount, collected = collected + excluded.collected,
+            credit = credit + excluded.credit;
+        INSERT INTO patient_credit (patient_id, credit, open_bills)
+        SELECT {patient}, {s}({credit}), {sign}
+        WHERE {patient} IS NOT NULL AND ({credit}) > 0
+        ON CONFLICT(patient_id) DO UPDATE SET
+            credit = credit + excluded.credit, open_bills = open_bills + excluded.open_bills;'''
+
+
+def reporting_schema():
+    return [
+        '''CREATE TABLE IF NOT EXISTS daily_billing_summary (
+            day TEXT PRIMARY KEY, bills INTEGER NOT NULL DEFAULT 0, consultation REAL NOT NULL DEFAULT 0,
+            medicine REAL NOT NULL DEFAULT 0, courier REAL NOT NULL DEFAULT 0, discount REAL NOT NULL DEFAULT 0,
+            collected REAL NOT NULL DEFAULT 0, credit REAL NOT NULL DEFAULT 0
+        )''',
+        '''CREATE TABLE IF NOT EXISTS patient_credit (
+            patient_id TEXT PRIMARY KEY, credit REAL NOT NULL DEFAULT 0, open_bills INTEGER NOT NULL DEFAULT 0
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_patient_credit_outstanding ON patient_credit (credit) WHERE open_bills > 0',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_billing_insert_summary AFTER INSERT ON billing
+            BEGIN {_add_bill('NEW', 1)}
+            END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_billing_update_summary
+            AFTER UPDATE OF consultation_charge, medicine_charge, courier_charge, discount, amount_paid, payment_date,
+                checkout_done ON billing
+            BEGIN {_add_bill('OLD', -1)} {_add_bill('NEW', 1)}
+                DELETE FROM daily_billing_summary WHERE day = {_DAY.format(b='OLD', a='appointments')} AND bills = 0;
+                DELETE FROM patient_credit WHERE patient_id = {_PATIENT.format(b='OLD', a='appointments')} AND open_bills = 0;
+            END''',
+        rebuild_summaries,
+    ]
+
+
+def rebuild_summaries(conn, schemas=()):
+    # Backfill from billing; also the repair path ('flask rebuild-reports'),
+    # which passes the attached archives (archive.attach()) so archived bills count too
+    conn.execute('DELETE FROM daily_billing_summary')
+    conn.execute('DELETE FROM patient_credit')
+    for schema in (None,) + tuple(schemas):
+        prefix = f'{schema}.' if schema else ''
+        day, credit = _DAY.format(b='b', a=f'{prefix}appointments'), _CREDIT.format(b='b')
+        patient = _PATIENT.format(b='b', a=f'{prefix}appointments')
+        # A visit caught mid-archive is in both; the live copy counts
+        live = ' AND NOT EXISTS (SELECT 1 FROM main.billing live WHERE live.appointment_id = b.appointment_id)' if schema else ''
+        conn.execute(f'''INSERT INTO daily_billing_summary (day, bills, consultation, medicine, courier, discount, collected, credit)
+                         SELECT {day} AS bill_day, COUNT(*), SUM(COALESCE(b.consultation_charge, 0)),
+                                SUM(COALESCE(b.medicine_charge, 0)), SUM(COALESCE(b.courier_charge, 0)),
+                                SUM(COALESCE(b.discount, 0)), SUM(COALESCE(b.amount_paid, 0)), SUM({credit})
+                         FROM {prefix}billing b WHERE bill_day IS NOT NULL{live} GROUP BY bill_day
+                         ON CONFLICT (day) DO UPDATE SET
+                             bills = bills + excluded.bills, consultation = consultation + excluded.consultation,
+                             medicine = medicine + excluded.medicine, courier = courier + excluded.courier,
+                             discount = discount + excluded.discount, collected = collected + excluded.collected,
+                             credit = credit + excluded.credit''')
+        conn.execute(f'''INSERT INTO patient_credit (patient_id, credit, open_bills)
+                         SELECT {patient} AS bill_patient, SUM({credit}), COUNT(*)
+                         FROM {prefix}billing b WHERE bill_patient IS NOT NULL AND ({credit}) > 0{live} GROUP BY bill_patient
+                         ON CONFLICT (patient_id) DO UPDATE SET
+                             credit = credit + excluded.credit, open_bills = open_bills + excluded.open_bills''')
+
+
+def report_range(args):
+    # ?start=&end= as YYYY-MM-DD, defaulting to the last DEFAULT_REPORT_DAYS days
+    try:
+        end = date.fromisoformat(args.get('end') or date.today().isoformat())
+        start = date.fromisoformat(args.get('start') or (end - timedelta(days=DEFAULT_REPORT_DAYS - 1)).isoformat())
+    except ValueError:
+        return None
+    if start > end or (end - start).days >= MAX_REPORT_DAYS:
+        return None
+    return start.isoformat(), end.isoformat()
+
+
+DAILY_COLUMNS = ['day', 'bills', 'consultation', 'medicine', 'courier', 'discount', 'collected', 'credit']
+
+
+def daily_summary(conn, start, end):
+    # One row per day with billing activity; amounts rounded to paise
+    c = conn.cursor()
+    c.execute('''SELECT day, bills, ROUND(consultation, 2), ROUND(medicine, 2), ROUND(courier, 2), ROUND(discount, 2),
+                        ROUND(collected, 2), ROUND(credit, 2)
+                 FROM daily_billing_summary WHERE day BETWEEN ? AND ? ORDER BY day''', (start, end))
+    return c.fetchall()
+
+
+CREDIT_COLUMNS = ['patient_id', 'name', 'mobile_number', 'credit', 'open_bills']
+
+
+def outstanding_credit(conn, limit=100):
+    c = conn.cursor()
+    c.execute('''SELECT pc.patient_id, p.name, p.mobile_number, ROUND(pc.credit, 2), pc.open_bills
+                 FROM patient_credit pc JOIN patients p ON p.patient_id = pc.patient_id
+                 WHERE pc.open_bills > 0 AND pc.credit > 0.005
+                 ORDER BY pc.credit DESC LIMIT ?''', (limit,))
+    return c.fetchall()
+
+
+def credit_sql(table):
+    # What a checked-out bill still owes, by the same rule the summaries use
+    return _CREDIT.format(b=table)
+
+
+def bill_credit(conn, appointment_id):
+    c = conn.cursor()
+    c.execute(f'SELECT {credit_sql("billing")} FROM billing WHERE appointment_id = ?', (appointment_id,))
+    row = c.fetchone()
+    return row[0] if row else 0
@@ -0,0 +1,129 @@
+import os
+from datetime import datetime, timedelta
+
+from follower import ChangeFollower
+
+SLOT_MINUTES = int(os.getenv('SLOT_MINUTES', '15'))
+CLINIC_OPENS = os.getenv('CLINIC_OPENS', '09:00')
+CLINIC_CLOSES = os.getenv('CLINIC_CLOSES', '17:00')
+# Each provider sees one patient per slot
+PROVIDERS = [name.strip() for name in os.getenv('CLINIC_PROVIDERS', 'doctor').split(',') if name.strip()]
+MAX_SEARCH_DAYS = 366
+
+
+def _minutes(hhmm):
+    hours, minutes = hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+OPENS = _minutes(CLINIC_OPENS)
+SLOTS_PER_DAY = (_minutes(CLINIC_CLOSES) - OPENS) // SLOT_MINUTES
+
+
+def slot_index(slot_time):
+    # Position of an 'HH:MM' slot in the day, or None if it is off the grid
+    try:
+        offset = _minutes(slot_time) - OPENS
+    except (AttributeError, ValueError):
+        return None
+    if offset < 0 or offset % SLOT_MINUTES or offset // SLOT_MINUTES >= SLOTS_PER_DAY:
+        return None
+    return offset // SLOT_MINUTES
+
+
+def slot_time(index):
+    minutes = OPENS + index * SLOT_MINUTES
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+def scheduling_schema():
+    return [
+        'ALTER TABLE appointments ADD COLUMN slot_time TEXT',
+        'ALTER TABLE appointments ADD COLUMN provider TEXT',
+        # The authority on double booking: a second appointment in a taken
+        # slot fails to insert whatever any worker's in-memory view says
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_appointments_slot ON appointments (provider, appointment_date, slot_time) '
+        'WHERE slot_time IS NOT NULL',
+    ]
+
+
+class SlotIndex(ChangeFollower):
+    # Per-process availability map: one bytearray per (provider, day) with a
+    # byte per slot, built from future slotted appointments and kept current
+    # from change_log (see follower.ChangeFollower), so any worker sees every
+    # worker's bookings. Days with no bookings have no entry and are entirely free.
+    TABLES = ('appointments',)
+
+    def __init__(self, connect):
+        super().__init__(connect)
+        self._days = {}
+        self._booked = {}
+
+    def _load(self, conn):
+        c = conn.cursor()
+        c.execute('''SELECT id, provider, appointment_date, slot_time FROM appointments
+                     WHERE slot_time IS NOT NULL AND appointment_date >= ?''', (self._built_for,))
+        self._days = {}
+        self._booked = {}
+        for row in c:
+            self._add(*row)
+
+    def _add(self, appointment_id, provider, day, slot):
+        index = slot_index(slot)
+        if index is None or provider is None:
+            return
+        key = (provider, day[:10])
+        slots = self._days.get(key)
+        if slots is None:
+            slots = self._days[key] = bytearray(SLOTS_PER_DAY)
+        slots[index] = 1
+        self._booked[appointment_id] = (key, index)
+
+    def _remove(self, appointment_id):
+        booked = self._booked.pop(appointment_id, None)
+        if booked:
+            key, index = booked
+            self._days[key][index] = 0
+
+    def _reload(self, conn, ids):
+        for appointment_id in ids:
+            self._remove(appointment_id)
+        c = conn.cursor()
+        c.execute(f'''SELECT id, provider, appointment_date, slot_time FROM appointments
+                      WHERE id IN ({','.join('?' * len(ids))}) AND slot_time IS NOT NULL AND appointment_date >= ?''',
+                  ids + [self._built_for])
+        for row in c.fetchall():
+            self._add(*row)
+
+    def is_free(self, provider, day, slot):
+        index = slot_index(slot)
+        with self._lock:
+            slots = self._days.get((provider, day))
+            return index is not None and (slots is None or not slots[index])
+
+    def next_free(self, count=10, start=None, providers=None):
+        # The next `count` free (day, 'HH:MM', provider) slots from `start`
+        # (a datetime, default now), earliest first and across providers
+        start = start or datetime.now()
+        providers = providers or PROVIDERS
+        found = []
+        first = -(-(start.hour * 60 + start.minute - OPENS) // SLOT_MINUTES)
+        with self._lock:
+            for offset in range(MAX_SEARCH_DAYS):
+                day = (start.date() + timedelta(days=offset)).isoformat()
+                days = [(provider, self._days.get((provider, day))) for provider in providers]
+                index = max(0, first) if offset == 0 else 0
+                while index < SLOTS_PER_DAY:
+                    # bytearray.find jumps over booked runs at C speed
+                    nexts = [(index if slots is None else slots.find(0, index), provider) for provider, slots in days]
+                    nexts = [(i, provider) for i, provider in nexts if i != -1]
+                    if not nexts:
+                        break
+                    index = min(i for i, _ in nexts)
+                    for i, provider in nexts:
+                        if i == index:
+                            found.append((day, slot_time(index), provider))
+                            if len(found) == count:
+                                return found
+                    index += 1
+        return found
@@ -0,0 +1,162 @@
+import re
+
+MAX_RESULTS = 50
+
+# One search document per appointment, with the patient's name and mobile number
+# copied in so a lookup never has to join. The document rowid is the
+# appointment's rowid; 'flask rebuild-search' re-derives the index if a full
+# VACUUM ever renumbers appointments.
+_DOC_SELECT = '''SELECT a.rowid, a.id, a.patient_id, p.name, p.mobile_number, a.appointment_date, a.reason,
+           COALESCE(d.chief_complaints, '') || ' ' || COALESCE(d.symptoms, '') || ' ' || COALESCE(d.diagnosis, '')
+    FROM appointments a
+    LEFT JOIN patients p ON a.patient_id = p.patient_id
+    LEFT JOIN diagnoses d ON a.id = d.appointment_id'''
+
+_DOC_COLUMNS = 'rowid, appointment_id, patient_id, name, mobile_number, appointment_date, reason, clinical'
+
+# Every patient also has a document of their own, with just the name and mobile
+# number, at minus the patient's rowid; it is what finds a patient with no
+# visits (imported, or all visits archived). Searches skip it for patients
+# who have appointments, whose appointment documents already match.
+_PATIENT_DOC_SELECT = 'SELECT -rowid, patient_id, name, mobile_number FROM patients'
+_PATIENT_DOC_COLUMNS = 'rowid, patient_id, name, mobile_number'
+
+
+def search_schema():
+    return [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5 (
+            appointment_id UNINDEXED, patient_id UNINDEXED, name, mobile_number, appointment_date, reason, clinical,
+            prefix = '2 3 4'
+        )''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_appointments_insert_search AFTER INSERT ON appointments
+            BEGIN
+                INSERT INTO search_index ({_DOC_COLUMNS}) {_DOC_SELECT} WHERE a.id = NEW.id;
+            END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_appointments_update_search
+            AFTER UPDATE OF patient_id, appointment_date, reason ON appointments
+            BEGIN
+                DELETE FROM search_index WHERE rowid = OLD.rowid;
+                INSERT INTO search_index ({_DOC_COLUMNS}) {_DOC_SELECT} WHERE a.id = NEW.id;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_appointments_delete_search AFTER DELETE ON appointments
+            BEGIN
+                DELETE FROM search_index WHERE rowid = OLD.rowid;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_patients_update_search AFTER UPDATE OF name, mobile_number ON patients
+            WHEN OLD.name IS NOT NEW.name OR OLD.mobile_number IS NOT NEW.mobile_number
+            BEGIN
+                UPDATE search_index SET name = NEW.name, mobile_number = NEW.mobile_number
+                WHERE rowid IN (SELECT rowid FROM appointments WHERE patient_id = NEW.patient_id);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_diagnoses_insert_search AFTER INSERT ON diagnoses
+            BEGIN
+                UPDATE search_index
+                SET clinical = COALESCE(NEW.chief_complaints, '') || ' ' || COALESCE(NEW.symptoms, '') || ' ' || COALESCE(NEW.diagnosis, '')
+                WHERE rowid = (SELECT rowid FROM appointments WHERE id = NEW.appointment_id);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_diagnoses_update_search
+            AFTER UPDATE OF chief_complaints, symptoms, diagnosis ON diagnoses
+            BEGIN
+                UPDATE search_index
+                SET clinical = COALESCE(NEW.chief_complaints, '') || ' ' || COALESCE(NEW.symptoms, '') || ' ' || COALESCE(NEW.diagnosis, '')
+                WHERE rowid = (SELECT rowid FROM appointments WHERE id = NEW.appointment_id);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_diagnoses_delete_search AFTER DELETE ON diagnoses
+            BEGIN
+                UPDATE search_index SET clinical = ''
+                WHERE rowid = (SELECT rowid FROM appointments WHERE id = OLD.appointment_id);
+            END''',
+        rebuild_index,
+    ]
+
+
+def patient_search_schema():
+    return [
+        f'''CREATE TRIGGER IF NOT EXISTS trg_patients_insert_search AFTER INSERT ON patients
+            BEGIN
+                INSERT INTO search_index ({_PATIENT_DOC_COLUMNS})
+                VALUES (-NEW.rowid, NEW.patient_id, NEW.name, NEW.mobile_number);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_patients_update_patient_search AFTER UPDATE OF name, mobile_number ON patients
+            WHEN OLD.name IS NOT NEW.name OR OLD.mobile_number IS NOT NEW.mobile_number
+            BEGIN
+                UPDATE search_index SET name = NEW.name, mobile_number = NEW.mobile_number WHERE rowid = -NEW.rowid;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_patients_delete_search AFTER DELETE ON patients
+            BEGIN
+                DELETE FROM search_index WHERE rowid = -OLD.rowid;
+            END''',
+        rebuild_index,
+    ]
+
+
+def search_columns_schema():
+    # reason has a handful of values shared by most visits, so as an indexed
+    # column it only swelled every result set; it is still returned
+    return [
+        'DROP TABLE IF EXISTS search_index',
+        '''CREATE VIRTUAL TABLE search_index USING fts5 (
+            appointment_id UNINDEXED, patient_id UNINDEXED, name, mobile_number, appointment_date,
+            reason UNINDEXED, clinical,
+            prefix = '2 3 4'
+        )''',
+        rebuild_index,
+    ]
+
+
+def rebuild_index(conn):
+    conn.execute('DELETE FROM search_index')
+    conn.execute(f'INSERT INTO search_index ({_DOC_COLUMNS}) {_DOC_SELECT}')
+    conn.execute(f'INSERT INTO search_index ({_PATIENT_DOC_COLUMNS}) {_PATIENT_DOC_SELECT}')
+
+
+def _fts_queries(text):
+    # Every word must match, each quoted so user input can never be parsed as
+    # FTS5 operators. Cheapest first: the words as typed; then the last as a
+    # prefix, since it may still be being typed; then every word as a prefix.
+    # A prefix longer than the prefix index's 4 characters makes FTS5 merge
+    # the postings of every term it covers before returning a row, tens of ms
+    # for a common name, so it is only tried when the forms before fall short.
+    terms = ['"' + term.replace('"', '""') + '"' for term in re.split(r'\W+', text) if term]
+    if not terms:
+        return []
+    return list(dict.fromkeys([' '.join(terms), ' '.join(terms[:-1] + [terms[-1] + '*']),
+                               ' '.join(term + '*' for term in terms)]))
+
+
+def search(conn, text, limit=20):
+    text = (text or '').strip()
+    limit = max(1, min(MAX_RESULTS, limit))
+    c = conn.cursor()
+    if text.isdigit() and len(text) >= 3:
+        # Mobile-number prefix: a range scan on the UNIQUE(mobile_number) index;
+        # a patient without appointments is one row with no appointment fields
+        c.execute('''SELECT a.id, p.patient_id, p.name, p.mobile_number, a.appointment_date, a.reason
+                     FROM patients p
+                     LEFT JOIN appointments a ON a.patient_id = p.patient_id
+                     WHERE p.mobile_number >= ? AND p.mobile_number < ?
+                     ORDER BY a.appointment_date DESC LIMIT ?''',
+                  (text, text + '\uffff', limit))
+    else:
+        # Newest visits first, then patients without any: FTS5 walks its
+        # postings backwards and stops at LIMIT, where ORDER BY rank would
+        # score every match first (seconds for a common name). Each form
+        # matches a superset of the one before; the exact words are kept if
+        # they fill the page, the last-word prefix if it finds anything.
+        rows = []
+        for n, query in enumerate(_fts_queries(text)):
+            c.execute('''SELECT appointment_id, patient_id, name, mobile_number, appointment_date, reason
+                         FROM search_index WHERE search_index MATCH ?
+                           AND (search_index.rowid > 0 OR NOT EXISTS (
+                               SELECT 1 FROM appointments a WHERE a.patient_id = search_index.patient_id))
+                         ORDER BY rowid DESC LIMIT ?''', (query, limit))
+            rows = c.fetchall()
+            if len(rows) >= limit or (n and rows):
+                break
+        return [_result(row) for row in rows]
+    return [_result(row) for row in c.fetchall()]
+
+
+def _result(row):
+    return {'appointment_id': row[0], 'patient_id': row[1], 'name': row[2], 'mobile_number': row[3],
+            'appointment_date': row[4], 'reason': row[5]}
@@ -0,0 +1,60 @@
+import pytest
+
+from pharmacy import PrescriptionError, StockChangeError, check_items, check_stock_change, parse_items
+
+
+def test_plain_item():
+    assert parse_items('Arnica 30 x 2 - twice daily') == [('Arnica 30', 2, 'twice daily')]
+
+
+def test_several_items():
+    assert parse_items('Arnica 30\nBelladonna 200 x 3; Rhus Tox 30 - at night') == [
+        ('Arnica 30', 1, ''), ('Belladonna 200', 3, ''), ('Rhus Tox 30', 1, 'at night')]
+
+
+@pytest.mark.parametrize('text, item', [
+    ('Nux-vomica 30', ('Nux-vomica 30', 1, '')),
+    ('Kali-phos 6x x 2 - twice daily', ('Kali-phos 6x', 2, 'twice daily')),
+    ('Vitamin B-12', ('Vitamin B-12', 1, '')),
+    ('Vitamin B-12 - once a day', ('Vitamin B-12', 1, 'once a day')),
+    ('Rhus Tox 30 x 2', ('Rhus Tox 30', 2, '')),
+])
+def test_hyphenated_names(text, item):
+    assert parse_items(text) == [item]
+
+
+def test_check_items():
+    assert check_items([{'name': ' Nux-vomica 30 ', 'quantity': '2', 'dosage': 'daily'}, {'name': 'Arnica 30'}]) == [
+        ('Nux-vomica 30', 2, 'daily'), ('Arnica 30', 1, '')]
+
+
+@pytest.mark.parametrize('raw', [
+    'Arnica 30', [{'quantity': 2}], [{'name': 'Arnica 30', 'quantity': 'two'}], [{'name': 'Arnica 30', 'quantity': -1}],
+    [{'name': 'Arnica 30', 'dosage': 3}], ['Arnica 30'], [{'name': 'Arnica 30', 'quantity': 0}],
+    [{'name': 'Arnica 30', 'quantity': '0'}], [{'name': 'Arnica 30', 'quantity': True}],
+    [{'name': 'Arnica 30', 'quantity': 2.5}],
+])
+def test_check_items_rejects(raw):
+    with pytest.raises(PrescriptionError):
+        check_items(raw)
+
+
+def test_check_items_default_quantity():
+    assert check_items([{'name': 'Arnica 30', 'quantity': None}]) == [('Arnica 30', 1, '')]
+
+
+def test_check_stock_change():
+    assert check_stock_change({'name': ' Arnica 30 ', 'quantity': '-3', 'unit': 'bottle', 'reorder_level': '5'}) == (
+        'Arnica 30', -3, 'bottle', 5)
+    assert check_stock_change({'name': 'Arnica 30', 'quantity': 10, 'reorder_level': ''}) == ('Arnica 30', 10, None, None)
+
+
+@pytest.mark.parametrize('data', [
+    None, [1], {'quantity': 2}, {'name': 3, 'quantity': 2}, {'name': ' ', 'quantity': 2}, {'name': 'Arnica 30'},
+    {'name': 'Arnica 30', 'quantity': 'ten'}, {'name': 'Arnica 30', 'quantity': 1.5},
+    {'name': 'Arnica 30', 'quantity': True}, {'name': 'Arnica 30', 'quantity': 1, 'unit': 5},
+    {'name': 'Arnica 30', 'quantity': 1, 'reorder_level': -1}, {'name': 'Arnica 30', 'quantity': 1, 'reorder_level': 'x'},
+])
+def test_check_stock_change_rejects(data):
+    with pytest.raises(StockChangeError):
+        check_stock_change(data)
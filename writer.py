@@ -0,0 +1,142 @@
+import collections
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH = int(os.getenv('WRITE_BATCH_MAX', '64'))
+# How long a leader lingers for more commands before writing; 0 takes only
+# what queued up while the previous batch was committing, which adds no
+# latency when idle and still batches under load
+BATCH_WINDOW = float(os.getenv('WRITE_BATCH_WINDOW_MS', '0')) / 1000
+# The writer connection's own busy wait is short; longer waits are retries with backoff
+BUSY_TIMEOUT_MS = int(os.getenv('WRITE_BUSY_TIMEOUT_MS', '250'))
+BUSY_RETRIES = int(os.getenv('WRITE_BUSY_RETRIES', '8'))
+BASE_BACKOFF = 0.01
+MAX_BACKOFF = 0.5
+
+
+def is_busy(error):
+    return (isinstance(error, sqlite3.OperationalError)
+            and (getattr(error, 'sqlite_errorname', '') in ('SQLITE_BUSY', 'SQLITE_LOCKED')
+                 or 'database is locked' in str(error)))
+
+
+class WriteQueue:
+    # Group commit. Request threads submit commands (callables taking the
+    # connection); the first to arrive while no batch is being written becomes
+    # the leader and commits everything queued meanwhile, one BEGIN IMMEDIATE
+    # ... COMMIT per batch, until its own command is in. The others wait for
+    # their results. Each command runs inside its own SAVEPOINT, so one that
+    # raises is rolled back alone and its exception re-raised in its caller.
+    # Commands must not commit or roll back themselves, and may be run again
+    # if the batch hits SQLITE_BUSY.
+    #
+    # Each Gunicorn worker has its own queue, coalescing the writes of that
+    # worker's threads; between workers it is SQLite's lock, behind the retries.
+    def __init__(self, connect, max_batch=MAX_BATCH, window=BATCH_WINDOW, retries=BUSY_RETRIES):
+        self.connect = connect
+        self.max_batch = max_batch
+        self.window = window
+        self.retries = retries
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._pending = collections.deque()
+        self._leading = False
+        self._conn = None
+
+    def submit(self, command):
+        # Returns what the command returned, once committed
+        future = Future()
+        with self._cond:
+            if self._pid != os.getpid():
+                # Forked: the parent's connection and queue are not ours
+                self._reset()
+            self._pending.append((command, future, time.perf_counter()))
+            while self._leading and not future.done():
+                self._cond.wait()
+            if future.done():
+                return future.result()
+            self._leading = True
+        try:
+            if self.window:
+                time.sleep(self.window)
+            while not future.done():
+                with self._cond:
+                    batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+                try:
+                    self._commit(self._connection(), batch)
+                except Exception as e:
+                    logger.exception('Write batch failed')
+                    for _, waiting, _ in batch:
+                        if not waiting.done():
+                            waiting.set_exception(e)
+                with self._cond:
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._leading = False
+                self._cond.notify_all()
+        return future.result()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = self.connect()
+            self._conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+        return self._conn
+
+    def _commit(self, conn, batch):
+        started = time.perf_counter()
+        for _, _, queued_at in batch:
+            registry.observe('clinic_write_queue_wait_seconds', (), started - queued_at)
+        registry.observe('clinic_write_batch_size', (), len(batch))
+        attempt = 0
+        while True:
+            try:
+                outcomes = self._apply(conn, batch)
+                break
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                if not is_busy(e) or attempt >= self.retries:
+                    raise
+                attempt += 1
+                registry.inc('clinic_write_busy_retries_total', ())
+                delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1.5))
+        registry.observe('clinic_write_transaction_seconds', (), time.perf_counter() - started)
+        for (_, future, _), (ok, value) in zip(batch, outcomes):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _apply(self, conn, batch):
+        outcomes = []
+        conn.execute('BEGIN IMMEDIATE')
+        for command, _, _ in batch:
+            conn.execute('SAVEPOINT command')
+            try:
+                result = command(conn)
+            except Exception as e:
+                # Lost the lock mid-batch: the whole batch is retried
+                if is_busy(e):
+                    raise
+                conn.execute('ROLLBACK TO command')
+                conn.execute('RELEASE command')
+                outcomes.append((False, e))
+                continue
+            conn.execute('RELEASE command')
+            outcomes.append((True, result))
+        conn.commit()
+        return outcomes